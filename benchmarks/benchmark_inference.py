@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+"""
+Time each stage of the TractSeg inference on synthetic subjects (see synthetic_data.py):
+
+load, crop_pad, load_model, predict_x/y/z, fusion, bundle_specific_postprocessing, inverse_transform,
+postprocessing and save
+
+The stages are run with the same functions and settings as `TractSeg` (default options) uses. The results are
+saved as JSON which can be compared with compare.py (e.g. before and after a change).
+
+Runs offline: if the pretrained weights are not downloaded yet, randomly initialized weights are used
+(--weights auto). Predictions of random weights look different, so the runtime of the postprocessing is
+different too: only compare results with the same weights.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import importlib
+import tempfile
+import subprocess
+from os.path import join
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import nibabel as nib
+
+from tractseg.libs.system_config import SystemConfig as C
+from tractseg.libs.system_config import get_config_name
+from tractseg.libs import cpu_budget
+from tractseg.libs import data_utils
+from tractseg.libs import direction_merger
+from tractseg.libs import exp_utils
+from tractseg.libs import img_utils
+from tractseg.libs import inference_server
+from tractseg.libs import peak_utils
+from tractseg.libs import trainer
+from tractseg.data import dataset_specific_utils
+from tractseg.data.data_loader_inference import DataLoaderInference
+from tractseg.models.base_model import BaseModel
+from tractseg import python_api
+
+import synthetic_data
+
+
+OUTPUT_TYPES = ["tract_segmentation", "endings_segmentation", "TOM", "dm_regression"]
+
+# Pretrained weights run_tractseg uses (TOM: one model for each part)
+WEIGHTS = {
+    "tract_segmentation": join(C.WEIGHTS_DIR, "pretrained_weights_tract_segmentation_v3.npz"),
+    "endings_segmentation": join(C.WEIGHTS_DIR, "pretrained_weights_endings_segmentation_v4.npz"),
+    "dm_regression": join(C.WEIGHTS_DIR, "pretrained_weights_dm_regression_v2.npz"),
+    "TOM_Part1": join(C.TRACT_SEG_HOME, "pretrained_weights_peak_regression_part1_v2.npz"),
+    "TOM_Part2": join(C.TRACT_SEG_HOME, "pretrained_weights_peak_regression_part2_v2.npz"),
+    "TOM_Part3": join(C.TRACT_SEG_HOME, "pretrained_weights_peak_regression_part3_v2.npz"),
+    "TOM_Part4": join(C.TRACT_SEG_HOME, "pretrained_weights_peak_regression_part4_v2.npz"),
+}
+
+
+class Timer(object):
+    """
+    Sums up the time of each stage.
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - start_time
+
+
+def get_parts(output_type):
+    return ["Part1", "Part2", "Part3", "Part4"] if output_type == "TOM" else ["All"]
+
+
+def get_weights(output_type, weights="auto"):
+    """
+    Returns:
+        'pretrained' or 'random'
+    """
+    available = all(os.path.exists(WEIGHTS[output_type if part == "All" else "TOM_" + part])
+                    for part in get_parts(output_type))
+    if weights == "pretrained" and not available:
+        raise ValueError("Pretrained weights for {} not found (download them by running TractSeg once or use "
+                         "--weights random)".format(output_type))
+    if weights == "auto":
+        return "pretrained" if available else "random"
+    return weights
+
+
+def get_config(output_type, part="All", weights="pretrained", nr_cpus=-1):
+    """
+    Read-only Config of the model (same settings as run_tractseg).
+    """
+    config_file = get_config_name("peaks", output_type)
+    Config = getattr(importlib.import_module("tractseg.experiments.pretrained_models." + config_file), "Config")()
+    Config = exp_utils.get_correct_labels_type(Config)
+    Config.TRAIN = False
+    Config.TEST = False
+    Config.SEGMENT = False
+    Config.GET_PROBS = Config.EXPERIMENT_TYPE == "tract_segmentation"  # for bundle specific postprocessing
+    Config.DROPOUT_SAMPLING = False
+    Config.THRESHOLD = 0.5
+    Config.NR_CPUS = nr_cpus
+    Config.INPUT_DIM = dataset_specific_utils.get_correct_input_dim(Config)
+    Config.RESET_LAST_LAYER = False
+    Config.LOAD_WEIGHTS = weights == "pretrained"
+    if output_type == "TOM":
+        classes = "All_" + part
+        return exp_utils.get_inference_config(
+            Config, WEIGHTS_PATH=WEIGHTS["TOM_" + part], CLASSES=classes,
+            NR_OF_CLASSES=3 * len(dataset_specific_utils.get_bundle_names(classes)[1:]))
+    return exp_utils.get_inference_config(
+        Config, WEIGHTS_PATH=WEIGHTS[output_type],
+        NR_OF_CLASSES=len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:]))
+
+
+def benchmark_output_type(peaks_path, tract_seg_dir, output_dir, output_type, weights="pretrained",
+                          single_orientation=False, batch_size=1, nr_cpus=-1):
+    """
+    Run all stages for one output type.
+
+    Args:
+        peaks_path: synthetic peak image
+        tract_seg_dir: bundle segmentations (for masking the TOMs)
+        output_dir: the output is saved here
+
+    Returns:
+        dict: stage -> seconds
+    """
+    timer = Timer()
+    Config = get_config(output_type, get_parts(output_type)[0], weights, nr_cpus)
+    # TOM is always run on one orientation (like TractSeg does)
+    directions = ["x"] if single_orientation or output_type == "TOM" else ["x", "y", "z"]
+    probs = Config.GET_PROBS or Config.EXPERIMENT_TYPE in ["dm_regression", "peak_regression"]
+
+    with timer.stage("load"):
+        data, affine, flip_axis = inference_server.load_peaks(peaks_path)
+    with timer.stage("crop_pad"):
+        data = np.nan_to_num(data)
+        data, _, bbox, original_shape = data_utils.crop_to_nonzero(data)
+        data, transformation = data_utils.pad_and_scale_img_to_square_img(data, target_size=Config.INPUT_DIM[0],
+                                                                          nr_cpus=nr_cpus)
+
+    for part in get_parts(output_type):
+        Config = get_config(output_type, part, weights, nr_cpus)
+        with timer.stage("load_model"):
+            model = BaseModel(Config, inference=True)
+
+        seg_xyz = None
+        for idx, direction in enumerate(directions):
+            with timer.stage("predict_" + direction):
+                Config_dir = exp_utils.get_inference_config(Config, SLICE_DIRECTION=direction)
+                seg, _ = trainer.predict_img(Config_dir, model, DataLoaderInference(Config_dir, data=data),
+                                             probs=probs or len(directions) > 1, scale_to_world_shape=False,
+                                             only_prediction=True, batch_size=batch_size)
+            if len(directions) > 1:
+                if seg_xyz is None:
+                    seg_xyz = np.empty(seg.shape + (3,), dtype=seg.dtype)
+                seg_xyz[..., idx] = seg
+                del seg
+        del model
+        if seg_xyz is not None:
+            with timer.stage("fusion"):
+                seg = direction_merger.mean_fusion(Config.THRESHOLD, seg_xyz, probs=probs)
+            del seg_xyz
+
+        # Postprocessing and saving in groups of bundles (like run_tractseg with output_callback)
+        bundle_names = dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:]
+        channels_per_bundle = seg.shape[3] // len(bundle_names)
+        for start in range(0, len(bundle_names), python_api._OUTPUT_BUNDLE_GROUP_SIZE):
+            bundles = bundle_names[start:start + python_api._OUTPUT_BUNDLE_GROUP_SIZE]
+            seg_group = seg[..., start * channels_per_bundle:(start + len(bundles)) * channels_per_bundle]
+            if Config.EXPERIMENT_TYPE == "tract_segmentation":
+                with timer.stage("bundle_specific_postprocessing"):
+                    seg_group = img_utils.bundle_specific_postprocessing(seg_group, bundles)
+            with timer.stage("inverse_transform"):
+                seg_group = data_utils.cut_and_scale_img_back_to_original_img(seg_group, transformation,
+                                                                              nr_cpus=nr_cpus)
+                seg_group = data_utils.add_original_zero_padding_again(seg_group, bbox, original_shape,
+                                                                       seg_group.shape[3])
+            if Config.EXPERIMENT_TYPE == "peak_regression":
+                with timer.stage("postprocessing"):
+                    seg_group = peak_utils.mask_and_normalize_peaks(seg_group, tract_seg_dir, bundles, 1,
+                                                                    nr_cpus=nr_cpus)
+            elif Config.EXPERIMENT_TYPE == "tract_segmentation":
+                with timer.stage("postprocessing"):
+                    seg_group = img_utils.postprocess_segmentations(seg_group, bundles, blob_thr=50)
+            with timer.stage("save"):
+                inference_server.save_bundles(output_type, Config.CLASSES, seg_group, bundles, affine, output_dir,
+                                              flip_axis, threshold=Config.THRESHOLD)
+        del seg
+
+    timings = OrderedDict((stage, round(seconds, 3)) for stage, seconds in timer.timings.items())
+    timings["total"] = round(sum(timer.timings.values()), 3)
+    return timings
+
+
+def get_environment(nr_cpus=-1):
+    import torch
+
+    try:
+        git_commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                             cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_commit = None
+    return OrderedDict([
+        ("git_commit", git_commit),
+        ("date", time.strftime("%Y-%m-%d %H:%M:%S")),
+        ("hostname", socket.gethostname()),
+        ("python", platform.python_version()),
+        ("numpy", np.__version__),
+        ("torch", torch.__version__),
+        ("device", "cuda" if torch.cuda.is_available() else "cpu"),
+        ("nr_cpus", cpu_budget.get_nr_cpus(nr_cpus)),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the TractSeg inference on synthetic "
+                                                 "subjects.")
+    parser.add_argument("-o", metavar="filepath", dest="output", required=True,
+                        help="Output JSON file")
+    parser.add_argument("--resolutions", nargs="+", choices=sorted(synthetic_data.RESOLUTIONS),
+                        default=["2.5mm", "2mm", "1.25mm"], help="Resolutions of the synthetic subjects")
+    parser.add_argument("--output_types", nargs="+", choices=OUTPUT_TYPES, default=OUTPUT_TYPES,
+                        help="Output types to benchmark (default: all)")
+    parser.add_argument("--weights", choices=["auto", "pretrained", "random"], default="auto",
+                        help="Use pretrained or randomly initialized weights. auto: pretrained if downloaded "
+                             "already (default: auto)")
+    parser.add_argument("--single_orientation", action="store_true",
+                        help="Only run the model along x (like TractSeg --single_orientation)")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of runs of each benchmark (default: 1)")
+    parser.add_argument("--batch_size", type=int, default=1, help="Inference batch size (default: 1)")
+    parser.add_argument("--nr_cpus", type=int, default=-1, help="Number of CPUs to use (default: all available)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic subjects (default: 0)")
+    args = parser.parse_args()
+
+    if args.nr_cpus > 0:
+        cpu_budget.set_budget(args.nr_cpus)
+
+    results = []
+    for resolution in args.resolutions:
+        scratch_dir = tempfile.mkdtemp(prefix="tractseg_benchmark_")
+        try:
+            print("Creating synthetic subject ({})...".format(resolution))
+            peaks_path = synthetic_data.save_subject(join(scratch_dir, "subject"), resolution, args.seed)
+            tract_seg_dir = join(scratch_dir, "bundle_segmentations")
+            if "TOM" in args.output_types:
+                mask_img = nib.load(join(scratch_dir, "subject", "nodif_brain_mask.nii.gz"))
+                synthetic_data.save_bundle_segmentations(np.asarray(mask_img.dataobj), mask_img.affine,
+                                                         dataset_specific_utils.get_bundle_names("All")[1:],
+                                                         tract_seg_dir)
+
+            for output_type in args.output_types:
+                weights = get_weights(output_type, args.weights)
+                for repeat in range(args.repeats):
+                    output_dir = join(scratch_dir, "output")
+                    timings = benchmark_output_type(peaks_path, tract_seg_dir, output_dir, output_type, weights,
+                                                    single_orientation=args.single_orientation,
+                                                    batch_size=args.batch_size, nr_cpus=args.nr_cpus)
+                    shutil.rmtree(output_dir)
+                    print("{} {} ({} weights, run {}): {}s".format(output_type, resolution, weights, repeat + 1,
+                                                                   timings["total"]))
+                    results.append(OrderedDict([
+                        ("output_type", output_type),
+                        ("resolution", resolution),
+                        ("shape", list(synthetic_data.RESOLUTIONS[resolution])),
+                        ("weights", weights),
+                        ("single_orientation", args.single_orientation),
+                        ("batch_size", args.batch_size),
+                        ("repeat", repeat),
+                        ("timings", timings),
+                    ]))
+        finally:
+            shutil.rmtree(scratch_dir)
+
+    with open(args.output, "w") as f:
+        json.dump(OrderedDict([("environment", get_environment(args.nr_cpus)), ("results", results)]), f,
+                  indent=2)
+    print("Results saved to " + args.output)
+
+
+if __name__ == '__main__':
+    main()
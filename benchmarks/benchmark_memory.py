@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+"""
+Peak memory of the main pipelines on synthetic subjects (see synthetic_data.py):
+
+- run_tractseg for each output type (tract_segmentation also with uncertainty)
+- tracking.track (TractSeg probabilistic tracking of one bundle)
+- tractometry.evaluate_along_streamlines (one bundle)
+
+Each case runs in a new process (the peak RSS of a process can not be reset). Measured are the peak RSS of this
+process (resource.getrusage, includes pytorch and everything which is not allocated by python), the peak RSS of
+the largest child process (e.g. tracking workers) and the peak of the memory allocated by python and numpy
+(tracemalloc). The peak RSS is compared to the budgets in memory_budgets.json: if a case needs more memory the
+script exits with an error, so memory improvements are not lost again.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from os.path import join
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+
+import synthetic_data
+
+
+CASES = ["tract_segmentation", "tract_segmentation_uncertainty", "endings_segmentation", "TOM", "dm_regression",
+         "tracking", "tractometry"]
+
+DEFAULT_BUDGETS = join(os.path.dirname(os.path.abspath(__file__)), "memory_budgets.json")
+
+BUNDLE = "CA"  # bundle for tracking and tractometry
+
+
+def _max_rss_gb(who):
+    max_rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss / 1e9 if sys.platform == "darwin" else max_rss * 1024 / 1e9
+
+
+def create_inputs(scratch_dir, resolution, seed=0, nr_fibers=2000):
+    """
+    Save all inputs to scratch_dir (so creating them is not part of the measurement).
+
+    Returns:
+        dict: name -> path
+    """
+    from tractseg.libs import fiber_utils
+    from tractseg.data import dataset_specific_utils
+
+    inputs = {"peaks": synthetic_data.save_subject(join(scratch_dir, "subject"), resolution, seed),
+              "tract_seg_dir": join(scratch_dir, "bundle_segmentations"),
+              "tractseg_output": join(scratch_dir, "tractseg_output"),
+              "streamlines": join(scratch_dir, BUNDLE + ".trk"),
+              "scalar": join(scratch_dir, "scalar.nii.gz")}
+
+    # Masks of all bundles for the TOM
+    mask_img = nib.load(join(scratch_dir, "subject", "nodif_brain_mask.nii.gz"))
+    synthetic_data.save_bundle_segmentations(np.asarray(mask_img.dataobj), mask_img.affine,
+                                             dataset_specific_utils.get_bundle_names("All")[1:],
+                                             inputs["tract_seg_dir"])
+
+    # One straight bundle for tracking and tractometry
+    synthetic_data.save_tractseg_output(inputs["tractseg_output"], resolution, BUNDLE)
+    bundle, _, _, _ = synthetic_data.create_bundle(synthetic_data.RESOLUTIONS[resolution])
+    affine = synthetic_data.get_affine(resolution)
+    streamlines = synthetic_data.create_streamlines(bundle, affine, nr_fibers, np.random.RandomState(seed))
+    fiber_utils.save_streamlines(inputs["streamlines"], streamlines, affine, bundle.shape)
+    peaks = nib.load(inputs["peaks"]).get_fdata(dtype=np.float32)
+    nib.save(nib.Nifti1Image(np.linalg.norm(peaks[..., :3], axis=-1), affine), inputs["scalar"])
+    return inputs
+
+
+def run_case(case, inputs, output_dir, single_orientation=False, nr_fibers=2000, nr_cpus=-1):
+    """
+    Run one case like the command line tools do (including loading the input).
+    """
+    if case == "tracking":
+        from tractseg.libs import tracking
+        shutil.copytree(inputs["tractseg_output"], output_dir)
+        tracking.track(BUNDLE, inputs["peaks"], output_dir, tracking_on_FODs=False, tracking_software="tractseg",
+                       tracking_algorithm="prob", tracking_folder="TOM_trackings", nr_fibers=nr_fibers,
+                       nr_cpus=nr_cpus)
+
+    elif case == "tractometry":
+        from tractseg.libs import img_utils
+        from tractseg.libs import nifti_utils
+        from tractseg.libs import tractometry
+        from tractseg.libs import streamline_io
+        scalar = np.nan_to_num(nifti_utils.get_data(inputs["scalar"], dtype=np.float64, cache=False))
+        streamlines = streamline_io.load(inputs["streamlines"])
+        beginnings = img_utils.load_bundle_data(join(inputs["tractseg_output"], "endings_segmentations"),
+                                                BUNDLE + "_b")
+        tractometry.evaluate_along_streamlines(scalar, streamlines, beginnings, 100, dilate=2,
+                                               affine=nifti_utils.get_affine(inputs["scalar"]))
+
+    else:
+        from tractseg.libs import inference_server
+        from tractseg.python_api import run_tractseg
+        data, affine, flip_axis = inference_server.load_peaks(inputs["peaks"])
+
+        def save(seg, bundle_names, classes="All", threshold=None):
+            output_type = "tract_segmentation" if case == "tract_segmentation_uncertainty" else case
+            inference_server.save_bundles(output_type, classes, seg, bundle_names, affine, output_dir, flip_axis,
+                                          threshold=threshold)
+
+        if case == "tract_segmentation_uncertainty":
+            run_tractseg(data, "tract_segmentation", single_orientation=single_orientation, dropout_sampling=True,
+                         nr_cpus=nr_cpus, output_callback=save)
+        else:
+            # TOM is masked with the bundle segmentations in the output directory
+            shutil.copytree(inputs["tract_seg_dir"], join(output_dir, "bundle_segmentations"))
+            options = {"single_orientation": single_orientation, "get_probabilities": False, "postprocess": True,
+                       "tract_definition": "TractQuerier+", "bundles": None}
+            inference_server.run_model(data, case, output_dir, options, save, nr_cpus=nr_cpus)
+
+
+def _measure(case, inputs, output_dir, options, result_queue):
+    """
+    Runs in a new process.
+    """
+    if sys.platform.startswith("linux"):
+        # The process was started with spawn, but its workers have to be started like in a normal process (the
+        # tracking workers rely on fork)
+        multiprocessing.set_start_method("fork", force=True)
+    try:
+        tracemalloc.start()
+        start_time = time.time()
+        run_case(case, inputs, output_dir, **options)
+        result_queue.put(OrderedDict([
+            ("peak_rss_gb", round(_max_rss_gb(resource.RUSAGE_SELF), 3)),
+            ("peak_rss_children_gb", round(_max_rss_gb(resource.RUSAGE_CHILDREN), 3)),
+            ("peak_traced_gb", round(tracemalloc.get_traced_memory()[1] / 1e9, 3)),
+            ("runtime", round(time.time() - start_time, 1)),
+        ]))
+    except Exception as e:
+        result_queue.put({"error": "{}: {}".format(type(e).__name__, e)})
+        raise
+
+
+def measure(case, inputs, output_dir, **options):
+    """
+    Run case in a new process and measure its peak memory.
+
+    Returns:
+        dict with peak_rss_gb, peak_rss_children_gb, peak_traced_gb and runtime (or error)
+    """
+    context = multiprocessing.get_context("spawn")  # fork would inherit the memory of this process
+    result_queue = context.Queue()
+    process = context.Process(target=_measure, args=(case, inputs, output_dir, options, result_queue))
+    process.start()
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():  # e.g. killed by the OOM killer
+                result = {"error": "process exited with code {}".format(process.exitcode)}
+                break
+    process.join()
+    return result
+
+
+def load_budgets(path):
+    """
+    Returns:
+        dict: resolution -> dict: case -> peak RSS in GB
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the peak memory of the main TractSeg pipelines on "
+                                                 "synthetic subjects and compare it to a budget.")
+    parser.add_argument("-o", metavar="filepath", dest="output",
+                        help="Output JSON file")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES,
+                        help="Cases to run (default: all)")
+    parser.add_argument("--resolutions", nargs="+", choices=sorted(synthetic_data.RESOLUTIONS),
+                        default=["2.5mm"], help="Resolutions of the synthetic subjects (default: 2.5mm)")
+    parser.add_argument("--budgets", metavar="filepath", default=DEFAULT_BUDGETS,
+                        help="JSON file with the maximum peak RSS in GB for each resolution and case "
+                             "(default: memory_budgets.json)")
+    parser.add_argument("--single_orientation", action="store_true",
+                        help="Only run the model along x (faster, but needs less memory than the default)")
+    parser.add_argument("--nr_fibers", type=int, default=2000,
+                        help="Number of streamlines for tracking and tractometry (default: 2000)")
+    parser.add_argument("--nr_cpus", type=int, default=-1, help="Number of CPUs to use (default: all available)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic subjects (default: 0)")
+    args = parser.parse_args()
+
+    budgets = load_budgets(args.budgets)
+    options = {"single_orientation": args.single_orientation, "nr_fibers": args.nr_fibers,
+               "nr_cpus": args.nr_cpus}
+    results = []
+    for resolution in args.resolutions:
+        scratch_dir = tempfile.mkdtemp(prefix="tractseg_memory_benchmark_")
+        try:
+            print("Creating synthetic inputs ({})...".format(resolution))
+            inputs = create_inputs(scratch_dir, resolution, args.seed, args.nr_fibers)
+            for case in args.cases:
+                output_dir = join(scratch_dir, "output")
+                result = measure(case, inputs, output_dir, **options)
+                shutil.rmtree(output_dir, ignore_errors=True)
+                result = OrderedDict([("case", case), ("resolution", resolution)] + list(result.items()))
+                # Only the default settings are comparable to the budget
+                budget = None if args.single_orientation else budgets.get(resolution, {}).get(case)
+                result["budget_gb"] = budget
+                result["ok"] = "error" not in result and (budget is None or result["peak_rss_gb"] <= budget)
+                results.append(result)
+                if "error" in result:
+                    print("{} {}: ERROR {}".format(case, resolution, result["error"]))
+                else:
+                    print("{} {}: peak RSS {}GB (budget: {}), children {}GB, python/numpy {}GB, {}s{}".format(
+                        case, resolution, result["peak_rss_gb"], "-" if budget is None else str(budget) + "GB",
+                        result["peak_rss_children_gb"], result["peak_traced_gb"], result["runtime"],
+                        "" if result["ok"] else "  -> OVER BUDGET"))
+        finally:
+            shutil.rmtree(scratch_dir)
+
+    if args.output:
+        from benchmark_inference import get_environment
+        with open(args.output, "w") as f:
+            json.dump(OrderedDict([("environment", get_environment(args.nr_cpus)), ("results", results)]), f,
+                      indent=2)
+        print("Results saved to " + args.output)
+
+    failed = [result for result in results if not result["ok"]]
+    if len(failed) > 0:
+        print("\nOver budget or failed: {}".format(", ".join("{} {}".format(r["case"], r["resolution"])
+                                                             for r in failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
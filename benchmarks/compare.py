@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Compare two result files of benchmark_inference.py (e.g. of two commits):
+
+python benchmarks/compare.py before.json after.json
+
+Timings of several runs (--repeats) are averaged. Only benchmarks which are in both files (same output type,
+resolution, weights, orientation and batch size) are compared.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+from collections import OrderedDict
+
+
+def load_results(path):
+    """
+    Returns:
+        environment, dict: (output_type, resolution, weights, single_orientation, batch_size) ->
+                           dict: stage -> mean seconds
+    """
+    with open(path) as f:
+        results = json.load(f, object_pairs_hook=OrderedDict)
+    runs = OrderedDict()
+    for result in results["results"]:
+        key = (result["output_type"], result["resolution"], result["weights"], result["single_orientation"],
+               result["batch_size"])
+        runs.setdefault(key, []).append(result["timings"])
+    mean_timings = OrderedDict()
+    for key, timings in runs.items():
+        mean_timings[key] = OrderedDict((stage, sum(t.get(stage, 0) for t in timings) / len(timings))
+                                        for stage in timings[0])
+    return results["environment"], mean_timings
+
+
+def compare(path_before, path_after, max_slowdown=None):
+    """
+    Print table of the timings of each stage.
+
+    Returns:
+        list of benchmarks where the total time is more than max_slowdown times slower
+    """
+    env_before, before = load_results(path_before)
+    env_after, after = load_results(path_after)
+    print("before: {} ({}, {} CPUs)".format(env_before["git_commit"], env_before["date"], env_before["nr_cpus"]))
+    print("after:  {} ({}, {} CPUs)".format(env_after["git_commit"], env_after["date"], env_after["nr_cpus"]))
+
+    slower = []
+    for key in before:
+        if key not in after:
+            continue
+        output_type, resolution, weights, single_orientation, batch_size = key
+        print("\n{} {} ({} weights{}, batch size {})".format(output_type, resolution, weights,
+                                                             ", single orientation" if single_orientation else "",
+                                                             batch_size))
+        print("  {:<32}{:>10}{:>10}{:>8}".format("stage", "before", "after", "ratio"))
+        for stage in list(OrderedDict.fromkeys(list(before[key]) + list(after[key]))):
+            time_before = before[key].get(stage)
+            time_after = after[key].get(stage)
+            ratio = "" if not time_before or time_after is None else "{:.2f}".format(time_after / time_before)
+            print("  {:<32}{:>10}{:>10}{:>8}".format(stage, "-" if time_before is None else round(time_before, 2),
+                                                     "-" if time_after is None else round(time_after, 2), ratio))
+        if max_slowdown is not None and after[key]["total"] > before[key]["total"] * max_slowdown:
+            slower.append(key)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two result files of benchmark_inference.py.")
+    parser.add_argument("before", help="JSON file of benchmark_inference.py")
+    parser.add_argument("after", help="JSON file of benchmark_inference.py")
+    parser.add_argument("--max_slowdown", metavar="ratio", type=float,
+                        help="Exit with error if the total time of any benchmark is more than this times slower "
+                             "(e.g. 1.1)")
+    args = parser.parse_args()
+
+    slower = compare(args.before, args.after, args.max_slowdown)
+    if len(slower) > 0:
+        print("\nSlower than {}x: {}".format(args.max_slowdown, ", ".join(" ".join(str(k) for k in key[:2])
+                                                                           for key in slower)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
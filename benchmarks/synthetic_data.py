@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Synthetic subjects for benchmarking: brain shaped mask filled with a random (spatially smooth) field of 3 peaks
+per voxel. The images are in MNI orientation with the shape of MNI space at the given resolution (like the
+HCP data TractSeg was trained on), so they go through the same steps as real data.
+
+The peaks are not anatomically meaningful: use them for timing and memory measurements only.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import argparse
+from os.path import join
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+
+# resolution -> shape of MNI space
+RESOLUTIONS = {
+    "1.25mm": (145, 174, 145),
+    "2mm": (91, 109, 91),
+    "2.5mm": (73, 87, 73),
+}
+
+
+def get_affine(resolution):
+    spacing = float(resolution[:-2])
+    return np.array([[-spacing, 0, 0, 90],
+                     [0, spacing, 0, -126],
+                     [0, 0, spacing, -72],
+                     [0, 0, 0, 1]])
+
+
+def _smooth_noise(shape, sigma, rng):
+    noise = ndimage.gaussian_filter(rng.standard_normal(shape).astype(np.float32), sigma)
+    return noise / (noise.std() + 1e-7)
+
+
+def create_brain_mask(shape, rng):
+    """
+    Ellipsoid with an irregular (smooth random) surface and ventricles in the middle.
+
+    Returns:
+        3D uint8 array
+    """
+    coords = np.meshgrid(*[np.arange(s, dtype=np.float32) for s in shape], indexing="ij")
+    center = np.array([0.5, 0.45, 0.45]) * shape
+    brain_radii = np.array([0.36, 0.42, 0.36]) * shape
+    ventricle_radii = np.array([0.06, 0.12, 0.07]) * shape
+
+    def _radius(radii):
+        return np.sqrt(sum(((c - m) / r) ** 2 for c, m, r in zip(coords, center, radii)))
+
+    surface = 1 + 0.06 * _smooth_noise(shape, np.array(shape) / 10., rng)
+    return ((_radius(brain_radii) < surface) & (_radius(ventricle_radii) > 1)).astype(np.uint8)
+
+
+def create_peaks(mask, rng, nr_peaks=3, smoothness=2.):
+    """
+    Random field of peaks: directions are smooth random unit vectors, the first peak is present in all voxels of
+    the mask, the other peaks only in some (crossing fibers) and are shorter.
+
+    Args:
+        mask: brain mask (peaks are 0 outside)
+        smoothness: sigma (in voxels) of the gaussian smoothing of the directions
+
+    Returns:
+        4D float32 array [x, y, z, 3 * nr_peaks]
+    """
+    peaks = np.zeros(mask.shape + (3 * nr_peaks,), dtype=np.float32)
+    for idx in range(nr_peaks):
+        direction = np.stack([_smooth_noise(mask.shape, smoothness, rng) for _ in range(3)], axis=-1)
+        direction /= np.linalg.norm(direction, axis=-1, keepdims=True) + 1e-7
+        length = rng.uniform(0.3, 1.0, mask.shape).astype(np.float32) / (idx + 1)
+        if idx > 0:
+            length[rng.uniform(size=mask.shape) > 0.6 / idx] = 0  # fewer voxels with 2nd and 3rd peak
+        peaks[..., idx * 3:idx * 3 + 3] = direction * (length * mask)[..., None]
+    return peaks
+
+
+def create_subject(resolution="1.25mm", seed=0):
+    """
+    Returns:
+        peaks (4D float32 array), affine, brain mask
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError("Invalid resolution: {} (available: {})".format(resolution, ", ".join(RESOLUTIONS)))
+    rng = np.random.RandomState(seed)
+    mask = create_brain_mask(RESOLUTIONS[resolution], rng)
+    return create_peaks(mask, rng), get_affine(resolution), mask
+
+
+def save_subject(output_dir, resolution="1.25mm", seed=0):
+    """
+    Save peaks.nii.gz and nodif_brain_mask.nii.gz of a synthetic subject.
+
+    Returns:
+        path of peak image
+    """
+    peaks, affine, mask = create_subject(resolution, seed)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    nib.save(nib.Nifti1Image(mask, affine), join(output_dir, "nodif_brain_mask.nii.gz"))
+    nib.save(nib.Nifti1Image(peaks, affine), join(output_dir, "peaks.nii.gz"))
+    return join(output_dir, "peaks.nii.gz")
+
+
+def save_bundle_segmentations(mask, affine, bundle_names, output_dir):
+    """
+    Save the brain mask as segmentation of each bundle (e.g. input for masking the TOMs).
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for bundle in bundle_names:
+        nib.save(nib.Nifti1Image(mask, affine), join(output_dir, bundle + ".nii.gz"))
+
+
+def create_bundle(shape, nr_ending_slices=4):
+    """
+    Straight tube along y (like a simplified CST or IFO) with the TOM pointing along the tube and the two ends of
+    the tube as beginnings and endings. Long enough for the minimum length of the TractSeg tracking at each
+    resolution.
+
+    Returns:
+        bundle mask, beginnings, endings (3D uint8 arrays), TOM (4D float32 array [x, y, z, 3])
+    """
+    start = (np.array([0.4, 0.25, 0.4]) * shape).astype(int)
+    end = (np.array([0.6, 0.75, 0.6]) * shape).astype(int)
+    x, y, z = zip(start, end)
+    bundle = np.zeros(shape, dtype=np.uint8)
+    bundle[x[0]:x[1], y[0]:y[1], z[0]:z[1]] = 1
+    beginnings = np.zeros(shape, dtype=np.uint8)
+    beginnings[x[0]:x[1], y[0]:y[0] + nr_ending_slices, z[0]:z[1]] = 1
+    endings = np.zeros(shape, dtype=np.uint8)
+    endings[x[0]:x[1], y[1] - nr_ending_slices:y[1], z[0]:z[1]] = 1
+    tom = np.zeros(shape + (3,), dtype=np.float32)
+    tom[bundle == 1] = [0, 1, 0]
+    return bundle, beginnings, endings, tom
+
+
+def create_streamlines(bundle, affine, nr_streamlines, rng, nr_points=50):
+    """
+    Streamlines from one end of the bundle (create_bundle) to the other with random smooth deviations.
+
+    Returns:
+        list of 2D float32 arrays [nr_points, 3] (world coordinates)
+    """
+    coords = np.array(np.where(bundle == 1))
+    low, high = coords.min(axis=1).astype(np.float64), coords.max(axis=1).astype(np.float64)
+    t = np.linspace(0, 1, nr_points)
+    streamlines = []
+    for _ in range(nr_streamlines):
+        start = rng.uniform(low, high)
+        end = rng.uniform(low, high)
+        start[1], end[1] = low[1], high[1]
+        points = start + t[:, None] * (end - start)
+        points[:, [0, 2]] += np.sin(np.pi * t)[:, None] * rng.normal(0, 1, 2)
+        points = np.clip(points, low, high)
+        streamlines.append(nib.affines.apply_affine(affine, points).astype(np.float32))
+    return streamlines
+
+
+def save_tractseg_output(output_dir, resolution="1.25mm", bundle_name="CA"):
+    """
+    Save bundle segmentation, beginnings, endings and TOM of a synthetic bundle (create_bundle) like TractSeg does
+    (input for Tracking).
+    """
+    affine = get_affine(resolution)
+    bundle, beginnings, endings, tom = create_bundle(RESOLUTIONS[resolution])
+    for subdir, name, img in [("bundle_segmentations", bundle_name, bundle),
+                              ("endings_segmentations", bundle_name + "_b", beginnings),
+                              ("endings_segmentations", bundle_name + "_e", endings),
+                              ("TOM", bundle_name, tom)]:
+        if not os.path.exists(join(output_dir, subdir)):
+            os.makedirs(join(output_dir, subdir))
+        nib.save(nib.Nifti1Image(img, affine), join(output_dir, subdir, name + ".nii.gz"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create synthetic peak image for benchmarking.")
+    parser.add_argument("-o", metavar="directory", dest="output_dir", required=True,
+                        help="Output directory (peaks.nii.gz and nodif_brain_mask.nii.gz)")
+    parser.add_argument("--resolution", choices=sorted(RESOLUTIONS), default="1.25mm",
+                        help="Resolution (default: 1.25mm)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    args = parser.parse_args()
+    print(save_subject(args.output_dir, args.resolution, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -35,7 +35,8 @@ setup(name='TractSeg',
         scripts=[
             'bin/TractSeg', 'bin/ExpRunner', 'bin/flip_peaks', 'bin/calc_FA', 'bin/Tractometry',
             'bin/download_all_pretrained_weights', 'bin/Tracking', 'bin/rotate_bvecs',
-            'bin/plot_tractometry_results', 'bin/get_image_spacing', 'bin/remove_negative_values'
+            'bin/plot_tractometry_results', 'bin/get_image_spacing', 'bin/remove_negative_values',
+            'bin/convert_pretrained_weights', 'bin/run_cohort', 'bin/tractogram_archive'
         ],
         package_data = {'tractseg.resources': ['MNI_FA_template.nii.gz',
                                       'random_forest_peak_orientation_detection.pkl']},
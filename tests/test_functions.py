@@ -3,9 +3,44 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import sys
+import shutil
+import json
+import tempfile
+import threading
+import subprocess
 import unittest
+import multiprocessing
+
+import numpy as np
 
 from tractseg.data import dataset_specific_utils
+from tractseg.data import data_loader_inference
+from tractseg.libs import exp_utils
+from tractseg.libs import direction_merger
+from tractseg.libs import img_utils
+from tractseg.libs import nifti_utils
+from tractseg.libs import profiler
+from tractseg.experiments.base import Config as BaseConfig
+
+
+def _profiled_worker(idx):
+    with profiler.span("worker", idx=idx):
+        return idx
+
+
+def _archive_writer(archive_path, bundles, streamlines, die_while_writing=False):
+    from tractseg.libs import tractogram_archive
+    if die_while_writing:
+        write_array = tractogram_archive._write_array
+        def write_array_and_die(zip_file, name, array):
+            if name.endswith("/deltas"):
+                os._exit(1)
+            write_array(zip_file, name, array)
+        tractogram_archive._write_array = write_array_and_die
+    for bundle in bundles:
+        tractogram_archive.save_bundle(archive_path, bundle, streamlines)
 
 
 class test_functions(unittest.TestCase):
@@ -17,5 +52,503 @@ class test_functions(unittest.TestCase):
         bundles = dataset_specific_utils.get_bundle_names("CST_right")
         self.assertListEqual(bundles, ["BG", "CST_right"], "Error in list of bundle names")
 
+    def test_bundle_idxs(self):
+        idxs = dataset_specific_utils.get_bundle_idxs("All", ["CC_1", "CA"])
+        self.assertListEqual(idxs, [4, 5], "Error in bundle indices")
+        idxs = dataset_specific_utils.get_bundle_idxs("All_endpoints", ["CA"])
+        self.assertListEqual(idxs, [8, 9], "Error in bundle indices of endings")
+
+    def test_tile_positions(self):
+        positions = data_loader_inference.get_tile_positions(144, 64, overlap=0.5)
+        self.assertListEqual(positions, [0, 27, 53, 80], "Error in tile positions")
+        positions = data_loader_inference.get_tile_positions(48, 64, overlap=0.5)
+        self.assertListEqual(positions, [0], "Error in tile positions for tile bigger than image")
+
+    def test_inference_config(self):
+        Config = BaseConfig()
+        Config_z = exp_utils.get_inference_config(Config, SLICE_DIRECTION="z")
+        self.assertEqual(Config_z.SLICE_DIRECTION, "z", "Error in overriding attribute")
+        self.assertEqual(Config.SLICE_DIRECTION, "y", "Original Config was changed")
+        with self.assertRaises(AttributeError):
+            Config_z.SLICE_DIRECTION = "x"
+        Config_combined = exp_utils.get_inference_config(Config, TYPE="combined", NR_OF_CLASSES=4)
+        self.assertEqual(Config_combined.NR_OF_GRADIENTS, 12, "Number of input channels not set")
+
+    def test_mean_fusion_from_disk(self):
+        probs_xyz = np.random.RandomState(0).rand(10, 10, 10, 5, 3).astype(np.float32)
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for idx in range(3):
+                paths.append(os.path.join(scratch_dir, "probs_{}.npy".format(idx)))
+                np.save(paths[-1], probs_xyz[..., idx].transpose(3, 0, 1, 2).astype(np.float16))
+            probs = direction_merger.mean_fusion_from_disk(0.5, paths, probs=True, channel_group_size=2)
+            seg = direction_merger.mean_fusion_from_disk(0.5, paths, probs=False, channel_group_size=2)
+        finally:
+            shutil.rmtree(scratch_dir)
+        self.assertTrue(np.allclose(probs, direction_merger.mean_fusion(0.5, probs_xyz), atol=1e-3),
+                        "Error in mean fusion of predictions stored on disk")
+        seg_in_memory = direction_merger.mean_fusion(0.5, probs_xyz, probs=False)
+        self.assertEqual(seg.dtype, seg_in_memory.dtype, "Different dtype than mean_fusion")
+        self.assertLess(np.mean(seg != seg_in_memory), 0.01)
+
+    def test_nifti_cache(self):
+        import nibabel as nib
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(scratch_dir, "img.nii.gz")
+            nib.save(nib.Nifti1Image(np.ones((4, 5, 6), dtype=np.float32), np.eye(4)), path)
+            self.assertEqual(nifti_utils.get_shape(path), (4, 5, 6), "Error in shape from header")
+            data = nifti_utils.get_data(path)
+            self.assertIs(nifti_utils.get_data(path), data, "Image was decoded again")
+            self.assertFalse(data.flags.writeable, "Cached image is writable")
+            self.assertTrue(nifti_utils.get_data(path, cache=False).flags.writeable, "Uncached image is read-only")
+            nib.save(nib.Nifti1Image(np.zeros((4, 5, 6), dtype=np.float32), np.eye(4)), path)
+            os.utime(path, ns=(0, 0))  # make sure modification time changed
+            self.assertEqual(nifti_utils.get_data(path).max(), 0, "Changed image was not reloaded")
+        finally:
+            nifti_utils.clear_cache()
+            shutil.rmtree(scratch_dir)
+
+    def test_4D_bundle_file(self):
+        tom = np.random.RandomState(0).rand(4, 5, 6, 6).astype(np.float32)  # 2 bundles with 3 channels
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(scratch_dir, "TOM.nii")
+            img_utils.create_4D_bundle_file(path, (4, 5, 6, 9), np.float32, np.eye(4), ["CA", "CC", "FX_left"])
+            img_utils.save_bundles_to_4D_file(path, tom, ["FX_left", "CA"])
+            fx_left = img_utils.load_bundle_data(os.path.join(scratch_dir, "TOM"), "FX_left")
+            cc = img_utils.load_bundle_data(os.path.join(scratch_dir, "TOM"), "CC")
+        finally:
+            shutil.rmtree(scratch_dir)
+        self.assertTrue(np.array_equal(fx_left, tom[..., :3]), "Error in bundle loaded from 4D file")
+        self.assertEqual(cc.max(), 0, "Bundle which was not saved is not empty")
+
+    def test_flat_checkpoint(self):
+        import torch
+        from tractseg.libs import pytorch_utils
+        net = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.BatchNorm2d(4))
+        net_loaded = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.BatchNorm2d(4))
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(scratch_dir, "weights.npz")
+            pytorch_utils.save_checkpoint(path, unet=net)
+            pytorch_utils.convert_checkpoint(path)
+            pytorch_utils.load_checkpoint(path, assign=True, unet=net_loaded)
+            state_dict = net_loaded.state_dict()
+            for name, value in net.state_dict().items():
+                self.assertTrue(torch.equal(value, state_dict[name]), "Error in flat checkpoint ({})".format(name))
+            del net_loaded, state_dict  # release memory mapped file
+        finally:
+            shutil.rmtree(scratch_dir)
+
+    def test_inference_server_job(self):
+        from tractseg.libs import inference_server
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            input_path = os.path.join(scratch_dir, "peaks.nii.gz")
+            open(input_path, "w").close()
+            job = inference_server.create_job("1", {"input": input_path, "output_types": ["TOM", "tract_segmentation"],
+                                                    "options": {"bundles": ["CA"]}})
+            with self.assertRaises(ValueError):
+                inference_server.create_job("2", {"input": input_path, "options": {"bundles": ["FOO"]}})
+            with self.assertRaises(ValueError):
+                inference_server.create_job("3", {"input": input_path, "output_types": ["TOM"],
+                                                  "options": {"tract_definition": "xtract"}})
+        finally:
+            shutil.rmtree(scratch_dir)
+        self.assertEqual(job.output_dir, os.path.join(scratch_dir, "tractseg_output"))
+        self.assertEqual(job.output_types, ["tract_segmentation", "TOM"], "TOM has to run after tract_segmentation")
+        self.assertEqual(job.options["bundles"], ["CA"])
+        self.assertTrue(job.options["postprocess"], "Default option not set")
+
+    def test_subjects_file(self):
+        from tractseg.libs import cohort
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(scratch_dir, "subjects.txt")
+            with open(path, "w") as f:
+                f.write("# comment\n/data/s1/peaks.nii.gz\n\n/data/s2/peaks.nii.gz  /results/s2\n")
+            subjects = cohort.read_subjects_file(path)
+        finally:
+            shutil.rmtree(scratch_dir)
+        self.assertEqual(subjects, [("/data/s1/peaks.nii.gz", "/data/s1/tractseg_output"),
+                                    ("/data/s2/peaks.nii.gz", "/results/s2")])
+
+    def test_work_queue(self):
+        from tractseg.libs.work_queue import WorkQueue
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            node1 = WorkQueue(scratch_dir, lease_time=60)
+            node2 = WorkQueue(scratch_dir, lease_time=60)
+            self.assertTrue(node1.claim("s1"))
+            self.assertFalse(node2.claim("s1"), "Subject claimed twice")
+            self.assertEqual(node2.claim_next(["s1", "s2"]), "s2")
+            node1.finish("s1", timings={"total": 1.0})
+            self.assertFalse(node2.claim("s1"), "Finished subject claimed again")
+            # node2 dies: lock of s2 expires
+            old = os.path.getmtime(os.path.join(scratch_dir, "s2.lock")) - 120
+            node2.close()
+            os.utime(os.path.join(scratch_dir, "s2.lock"), (old, old))
+            self.assertEqual(node1.get_status("s2"), "expired")
+            self.assertTrue(node1.claim("s2"), "Expired subject not claimed")
+            node1.finish("s2", error="failed")
+            node1.close()
+            status = node1.summary(["s1", "s2", "s3"])
+        finally:
+            shutil.rmtree(scratch_dir)
+        self.assertEqual(status, {"done": 1, "failed": 1, "todo": 1})
+
+    def test_work_queue_retry_failed(self):
+        from tractseg.libs.work_queue import WorkQueue, run_commands, get_subject_id
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            input_path = os.path.join(scratch_dir, "sub 1", "peaks.nii.gz")
+            output_path = os.path.join(scratch_dir, "out'put")
+            subject_id = get_subject_id(input_path)
+            node = WorkQueue(os.path.join(scratch_dir, "queue"), retry_failed=True)
+            # subject which fails during this run is not claimed again
+            nr_processed = run_commands([(input_path, output_path)], node, ["false"])
+            node.close()
+            self.assertEqual(nr_processed, 1)
+            self.assertEqual(node.get_status(subject_id), "failed")
+            # new run retries it; paths with spaces and quotes are passed as one argument each
+            node = WorkQueue(os.path.join(scratch_dir, "queue"), retry_failed=True)
+            nr_processed = run_commands([(input_path, output_path)], node, ["mkdir -p {output}"])
+            node.close()
+            self.assertEqual(nr_processed, 1)
+            self.assertEqual(node.get_status(subject_id), "done")
+            self.assertTrue(os.path.isdir(output_path))
+        finally:
+            shutil.rmtree(scratch_dir)
+
+    def test_cpu_budget(self):
+        from tractseg.libs import cpu_budget
+        available_cpus = cpu_budget._available_cpus
+        budget = os.environ.get(cpu_budget.ENV_VAR)
+        try:
+            cpu_budget._available_cpus = 8
+            cpu_budget.set_budget(-1)
+            self.assertEqual(cpu_budget.get_nr_cpus(), 8)
+            self.assertEqual(cpu_budget.get_nr_cpus(32), 8, "More CPUs than available")
+            cpu_budget.set_budget(6)
+            self.assertEqual(cpu_budget.get_nr_cpus(), 6)
+            self.assertEqual(cpu_budget.get_nr_cpus(4), 4)
+            self.assertEqual(cpu_budget.split_budget(4), 1)
+            self.assertEqual(cpu_budget.split_budget(8), 1)
+            self.assertEqual(cpu_budget.mrtrix_nthreads(), " -nthreads 6")
+        finally:
+            cpu_budget._available_cpus = available_cpus
+            cpu_budget.set_budget(int(budget) if budget else -1)
+
+    def test_cgroup_cpu_limit(self):
+        from tractseg.libs import cpu_budget
+        read = cpu_budget._read
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            # quota of parent cgroup is smaller than quota of the cgroup of the process
+            os.makedirs(os.path.join(scratch_dir, "job", "step"))
+            for cgroup_dir, cpu_max in [("", "max 100000"), ("job", "200000 100000"), ("job/step", "max 100000")]:
+                with open(os.path.join(scratch_dir, cgroup_dir, "cpu.max"), "w") as f:
+                    f.write(cpu_max + "\n")
+            cpu_budget._read = lambda path: "0::/job/step" if path == "/proc/self/cgroup" else read(path)
+            limit = cpu_budget._get_cgroup_cpu_limit(scratch_dir)
+        finally:
+            cpu_budget._read = read
+            shutil.rmtree(scratch_dir)
+        self.assertEqual(limit, 2.0, "Quota of parent cgroup not used")
+
+    def test_cli_import_time(self):
+        """
+        The command line tools must not import heavy dependencies before they are needed (e.g. for --help).
+        """
+        def get_imports(args):
+            stderr = subprocess.run([sys.executable, "-X", "importtime"] + args, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+            imports = {}  # module -> import time in us (without submodules)
+            for line in stderr.splitlines():
+                if line.startswith("import time:") and "|" in line and "self [us]" not in line:
+                    self_time, _, module = line[len("import time:"):].split("|")
+                    imports[module.strip()] = int(self_time)
+            return imports
+
+        bin_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "bin")
+        startup_imports = get_imports(["-c", "pass"])  # e.g. sitecustomize
+        heavy_modules = ["torch", "dipy", "matplotlib", "seaborn", "sklearn", "joblib", "pandas"]
+        for script in ["TractSeg", "Tracking", "Tractometry"]:
+            imports = get_imports([os.path.join(bin_dir, script), "--help"])
+            imports = {module: t for module, t in imports.items() if module not in startup_imports}
+            slow_imports = [module for module in imports if module.split(".")[0] in heavy_modules]
+            self.assertListEqual(slow_imports, [], "{} --help imports heavy modules".format(script))
+            self.assertLess(sum(imports.values()) / 1e6, 2.0, "{} --help: imports too slow".format(script))
+
+    def test_profiler(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with profiler.span("disabled"):
+                pass
+            profiler.start()
+            with profiler.span("outer", size=2):
+                with profiler.span("inner"):
+                    pass
+            thread = threading.Thread(target=_profiled_worker, args=(-1,))
+            thread.start()
+            thread.join()
+            pool = multiprocessing.Pool(2)
+            self.assertListEqual(pool.map(_profiled_worker, range(4)), list(range(4)))
+            pool.close()
+            pool.join()
+            profiler.stop(os.path.join(tmp_dir, "profile.json"), verbose=False)
+            self.assertFalse(profiler.is_enabled())
+
+            with open(os.path.join(tmp_dir, "profile.json")) as f:
+                trace = json.load(f)
+            spans = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+            self.assertEqual(len([e for e in spans if e["name"] == "disabled"]), 0)
+            outer = [e for e in spans if e["name"] == "outer"][0]
+            inner = [e for e in spans if e["name"] == "inner"][0]
+            self.assertDictEqual(outer["args"], {"size": 2})
+            self.assertTrue(outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"])
+            workers = [e for e in spans if e["name"] == "worker"]
+            self.assertEqual(len(workers), 5)
+            self.assertEqual(len([e for e in workers if e["pid"] != os.getpid()]), 4,
+                             "Spans of worker processes missing")
+            self.assertEqual(len(set((e["pid"], e["tid"]) for e in workers if e["pid"] == os.getpid())), 1)
+            summary = {stage["name"]: stage for stage in trace["otherData"]["summary"]}
+            self.assertEqual(summary["worker"]["calls"], 5)
+            self.assertEqual(summary["outer"]["calls"], 1)
+        finally:
+            if profiler.is_enabled():
+                profiler.stop(os.path.join(tmp_dir, "profile.json"), verbose=False)
+            shutil.rmtree(tmp_dir)
+
+    def test_memory_benchmark(self):
+        """
+        benchmarks/benchmark_memory.py has to measure the peak memory and fail if it is over budget.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            budgets_path = os.path.join(tmp_dir, "budgets.json")
+            with open(budgets_path, "w") as f:
+                json.dump({"2.5mm": {"tractometry": 0.01}}, f)
+            script = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "benchmarks",
+                                  "benchmark_memory.py")
+            process = subprocess.run([sys.executable, script, "--cases", "tractometry", "--resolutions", "2.5mm",
+                                      "--nr_fibers", "100", "--budgets", budgets_path,
+                                      "-o", os.path.join(tmp_dir, "memory.json")],
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            self.assertEqual(process.returncode, 1, "Budget exceeded, but no error:\n" + process.stdout)
+            with open(os.path.join(tmp_dir, "memory.json")) as f:
+                result = json.load(f)["results"][0]
+            self.assertNotIn("error", result)
+            self.assertGreater(result["peak_rss_gb"], 0.01)
+            self.assertGreater(result["peak_traced_gb"], 0)
+            self.assertFalse(result["ok"])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_streamline_transforms(self):
+        from tractseg.libs import fiber_utils
+        rng = np.random.RandomState(0)
+        streamlines = [rng.rand(n, 3).astype(np.float32) * 10 for n in [5, 1, 12, 3]]
+        streamlines_as = fiber_utils.to_array_sequence(streamlines)
+        for sls in [streamlines, streamlines_as, streamlines_as[::2]]:
+            sls_list = [np.array(sl) for sl in sls]
+            for result, expected in [
+                    (fiber_utils.add_to_each_streamline(sls, 0.5), [sl + 0.5 for sl in sls_list]),
+                    (fiber_utils.add_to_each_streamline_axis(sls, 2, "y"), [sl + [0, 2, 0] for sl in sls_list]),
+                    (fiber_utils.flip(sls, "z"), [sl * [1, 1, -1] for sl in sls_list])]:
+                self.assertEqual(len(result), len(expected))
+                for sl, sl_expected in zip(result, expected):
+                    np.testing.assert_allclose(sl, sl_expected, rtol=1e-6)
+
+            lengths, spaces = fiber_utils.get_streamline_statistics(sls, raw=True)
+            spaces_expected = [np.linalg.norm(np.diff(sl, axis=0), axis=1) for sl in sls_list]
+            np.testing.assert_allclose(lengths, [s.sum() for s in spaces_expected], rtol=1e-5)
+            np.testing.assert_allclose(spaces, np.concatenate(spaces_expected), rtol=1e-5)
+
+        resampled = fiber_utils.resample_fibers(streamlines_as[[0, 2]], nb_points=7)
+        self.assertListEqual([len(sl) for sl in resampled], [7, 7])
+        np.testing.assert_allclose(resampled[1][[0, -1]], streamlines[2][[0, -1]], rtol=1e-6)
+
+
+    def test_filter_streamlines_leaving_mask(self):
+        from tractseg.libs import fiber_utils
+        mask = np.zeros((10, 10, 10), dtype=np.uint8)
+        mask[2:8, 2:8, 2:8] = 1
+        streamlines = [np.array([[3., 3, 3], [3, 3, 5], [3, 3, 5], [6, 6, 7.5]]),  # repeated point
+                       np.array([[3., 3, 3], [3, 3, 9]]),  # leaves the mask between the points
+                       np.array([[5.5, 5, 5]]),
+                       np.array([[5., 3, 3], [5, 7, 3]])]
+        filtered = fiber_utils.filter_streamlines_leaving_mask(streamlines, mask)
+        self.assertEqual(len(filtered), 3)
+        self.assertEqual(len(filtered[0]), 1 + 20 + 0 + 50)
+        np.testing.assert_allclose(filtered[0][[0, 20, -1]], [[3, 3, 3], [3, 3, 5], [6, 6, 7.5]])
+        np.testing.assert_allclose(filtered[2][:3], [[5, 3, 3], [5, 3.1, 3], [5, 3.2, 3]])
+
+        self.assertListEqual(fiber_utils.get_idxs_of_closest_points(streamlines, np.array([3, 3, 5.1])),
+                             [1, 0, 0, 0])
+
+    def test_finish_streamline(self):
+        from tractseg.libs import fiber_utils
+        from tractseg.libs import tractseg_prob_tracking
+        affine = np.array([[-2., 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72], [0, 0, 0, 1]])
+        reference_img = np.zeros((20, 30, 25))
+        streamline = np.stack([np.linspace(2, 15, 30), np.linspace(5, 25, 30), np.full(30, 10.)], axis=1)
+        affine_final = np.dot(fiber_utils.get_invert_affine(reference_img.shape, affine, axis="x"),
+                              np.dot(affine, [[1, 0, 0, -0.5], [0, 1, 0, -0.5], [0, 0, 1, -0.5], [0, 0, 0, 1]]))
+        finished = tractseg_prob_tracking.finish_streamline(list(streamline), affine_final)
+
+        expected = fiber_utils.add_to_each_streamline([streamline], -0.5)
+        expected = fiber_utils.invert_streamlines(fiber_utils.transform_streamlines(expected, affine), reference_img,
+                                                  affine, axis="x")
+        self.assertEqual(finished.dtype, np.float32)
+        np.testing.assert_allclose(finished, expected[0], rtol=1e-5, atol=1e-4)
+        compressed = tractseg_prob_tracking.finish_streamline(list(streamline), affine_final, compress=True)
+        self.assertLess(len(compressed), 10)  # straight line (segments of at most 10mm)
+        np.testing.assert_allclose(compressed[[0, -1]], finished[[0, -1]])
+
+    def test_prob_tracking_seed(self):
+        from tractseg.libs import tractseg_prob_tracking
+
+        def _track(seed, nr_cpus):
+            # straight tube along x; streamlines have to start and end in the first/last slices
+            peaks = np.zeros((14, 5, 5, 3), dtype=np.float32)
+            peaks[..., 0] = 1
+            bundle_mask = np.zeros((14, 5, 5), dtype=np.uint8)
+            bundle_mask[1:13, 1:4, 1:4] = 1
+            start_mask = np.zeros_like(bundle_mask)
+            start_mask[1] = bundle_mask[1]
+            end_mask = np.zeros_like(bundle_mask)
+            end_mask[12] = bundle_mask[12]
+            affine = np.array([[-10., 0, 0, 90], [0, 10, 0, -126], [0, 0, 10, -72], [0, 0, 0, 1]])
+            return tractseg_prob_tracking.track(peaks, max_nr_fibers=50, bundle_mask=bundle_mask,
+                                                start_mask=start_mask, end_mask=end_mask, nr_cpus=nr_cpus,
+                                                affine=affine, spacing=10, seed=seed, verbose=False)
+
+        streamlines = _track(42, 1)
+        self.assertEqual(len(streamlines), 50)
+        streamlines_2_cpus = _track(42, 2)
+        np.testing.assert_array_equal(streamlines._lengths, streamlines_2_cpus._lengths)
+        np.testing.assert_array_equal(streamlines._data, streamlines_2_cpus._data)
+        # no duplicated streamlines
+        self.assertEqual(len(set(sl.tobytes() for sl in streamlines)), 50)
+        streamlines_other_seed = _track(43, 1)
+        self.assertFalse(np.array_equal(streamlines._data[:10], streamlines_other_seed._data[:10]))
+
+    def test_adaptive_seeding_probs(self):
+        from tractseg.libs import tractseg_prob_tracking
+        # line of 60 voxels: only seeds in the first 20 voxels result in valid streamlines
+        mask_coords = np.stack([np.arange(60), np.full(60, 5), np.full(60, 5)], axis=1)
+        nr_seeds = np.full(60, 20.)
+        nr_accepted = np.zeros(60)
+        self.assertIsNone(tractseg_prob_tracking.get_adaptive_seeding_probs(mask_coords, nr_seeds, nr_accepted))
+        nr_accepted[:20] = 5
+
+        probs = tractseg_prob_tracking.get_adaptive_seeding_probs(mask_coords, nr_seeds, nr_accepted)
+        self.assertAlmostEqual(probs.sum(), 1)
+        self.assertGreater(probs[:15].min(), 5 * probs[-30:].max())
+        self.assertGreaterEqual(probs.min(), 0.1 / 60)  # still some uniform seeding
+
+        probs_pruned = tractseg_prob_tracking.get_adaptive_seeding_probs(mask_coords, nr_seeds, nr_accepted,
+                                                                         prune=True)
+        np.testing.assert_allclose(probs_pruned[:20], 1 / np.count_nonzero(probs_pruned))  # uniform
+        self.assertEqual(probs_pruned[-30:].max(), 0)
+
+    def test_streamline_io(self):
+        import nibabel as nib
+        from tractseg.libs import streamline_io
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            rng = np.random.RandomState(0)
+            streamlines = [np.cumsum(rng.randn(n, 3), axis=0) + 40 for n in [5, 1, 12, 3, 7]]
+            affine = np.array([[-2., 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72], [0, 0, 0, 1]])
+            for filename, legacy in [("a.trk", False), ("a.tck", False), ("legacy.trk", True)]:
+                path = os.path.join(tmp_dir, filename)
+                # written in two chunks
+                with streamline_io.StreamlineWriter(path, affine, (91, 109, 91), legacy=legacy) as writer:
+                    writer.write(streamlines[:2])
+                    writer.write(streamlines[2:])
+                self.assertEqual(streamline_io.get_nr_streamlines(path), 5)
+                loaded = streamline_io.load(path, legacy=legacy)
+                self.assertEqual(len(loaded), 5)
+                for sl, sl_loaded in zip(streamlines, loaded):
+                    np.testing.assert_allclose(sl_loaded, sl, rtol=1e-5)
+                subset = streamline_io.load(path, idxs=[3, 0], legacy=legacy)
+                np.testing.assert_allclose(subset[0], streamlines[3], rtol=1e-5)
+                np.testing.assert_allclose(subset[1], streamlines[0], rtol=1e-5)
+                chunks = list(streamline_io.iter_chunks(path, chunk_size=2, legacy=legacy))
+                self.assertListEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+                if not legacy:  # readable by nibabel
+                    loaded_nib = nib.streamlines.load(path).streamlines
+                    np.testing.assert_allclose(np.concatenate(list(loaded_nib)), np.concatenate(list(loaded)), rtol=1e-6)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_tractogram_archive(self):
+        from tractseg.libs import streamline_io
+        from tractseg.libs import tractogram_archive
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            rng = np.random.RandomState(0)
+            streamlines = [np.cumsum(rng.randn(n, 3), axis=0) + 40 for n in [5, 1, 12, 0, 3, 7]]
+            affine = np.array([[-2., 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72], [0, 0, 0, 1]])
+            archive_path = os.path.join(tmp_dir, tractogram_archive.FILENAME)
+            tractogram_archive.save_bundle(archive_path, "CST_right", streamlines, affine, (91, 109, 91))
+            tractogram_archive.save_bundle(archive_path, "CA", streamlines[:2])
+            self.assertDictEqual(dict(tractogram_archive.get_index(archive_path)), {"CST_right": 6, "CA": 2})
+
+            loaded = tractogram_archive.load_bundle(archive_path, "CST_right")
+            self.assertListEqual([len(sl) for sl in loaded], [5, 1, 12, 0, 3, 7])
+            points = np.concatenate(streamlines)
+            points_loaded = np.concatenate(list(loaded))
+            self.assertLessEqual(np.abs(points_loaded - points).max(), tractogram_archive.PRECISION / 2 + 1e-5)
+            subset = tractogram_archive.load_bundle(archive_path, "CST_right", idxs=[4, 0])
+            np.testing.assert_array_equal(subset[0], loaded[4])
+            np.testing.assert_array_equal(subset[1], loaded[0])
+
+            # replace bundle
+            tractogram_archive.save_bundle(archive_path, "CA", streamlines[2:3])
+            self.assertDictEqual(dict(tractogram_archive.get_index(archive_path)), {"CST_right": 6, "CA": 1})
+            self.assertRaises(KeyError, tractogram_archive.load_bundle, archive_path, "FX_left")
+
+            # process dies while a bundle is appended: the archive is restored when it is opened the next time
+            process = multiprocessing.get_context("fork").Process(
+                target=_archive_writer, args=(archive_path, ["FX_left"], streamlines, True))
+            process.start()
+            process.join()
+            self.assertTrue(os.path.exists(archive_path + ".journal"))
+            self.assertDictEqual(dict(tractogram_archive.get_index(archive_path)), {"CST_right": 6, "CA": 1})
+            self.assertFalse(os.path.exists(archive_path + ".journal"))
+            tractogram_archive.save_bundle(archive_path, "FX_left", streamlines[:3])
+            self.assertDictEqual(dict(tractogram_archive.get_index(archive_path)),
+                                 {"CST_right": 6, "CA": 1, "FX_left": 3})
+
+            # bundles added by several processes at the same time
+            archive_path_parallel = os.path.join(tmp_dir, "parallel.npz")
+            processes = [multiprocessing.get_context("fork").Process(
+                target=_archive_writer, args=(archive_path_parallel, [name + str(idx) for idx in range(5)],
+                                              streamlines)) for name in ["A", "B"]]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual(len(tractogram_archive.get_index(archive_path_parallel)), 10, "Bundle lost")
+
+            # to trk and back
+            tractogram_archive.convert_from_archive(archive_path, tmp_dir, tracking_format="trk")
+            np.testing.assert_allclose(streamline_io.get_trk_reference(os.path.join(tmp_dir, "CST_right.trk"))[0],
+                                       affine)
+            np.testing.assert_allclose(np.concatenate(list(streamline_io.load(os.path.join(tmp_dir, "CST_right.trk")))),
+                                       points_loaded, atol=1e-4)
+            archive_path_2 = os.path.join(tmp_dir, "archive_2.npz")
+            tractogram_archive.convert_to_archive([os.path.join(tmp_dir, "CST_right.trk")], archive_path_2)
+            np.testing.assert_allclose(tractogram_archive.get_reference(archive_path_2)[0], affine)
+            np.testing.assert_array_equal(np.concatenate(list(tractogram_archive.load_bundle(archive_path_2,
+                                                                                             "CST_right"))),
+                                          points_loaded)
+        finally:
+            shutil.rmtree(tmp_dir)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -5,109 +5,225 @@ from __future__ import print_function
 
 from os.path import join
 from builtins import object
+import threading
+from queue import Queue, Full
+
 import numpy as np
+import torch
 
 from tractseg.libs.system_config import SystemConfig as C
 from tractseg.libs import exp_utils
 from tractseg.libs import data_utils
 from tractseg.libs import peak_utils
-from tractseg.data.DLDABG_standalone import ZeroMeanUnitVarianceTransform as ZeroMeanUnitVarianceTransform_Standalone
-from tractseg.data.DLDABG_standalone import SingleThreadedAugmenter
-from tractseg.data.DLDABG_standalone import Compose
-from tractseg.data.DLDABG_standalone import NumpyToTensor
+from tractseg.libs import profiler
+from tractseg.data.DLDABG_standalone import zero_mean_unit_variance_normalization
 
 np.random.seed(1337)
 
 
-class BatchGenerator2D_data_ordered_standalone(object):
+def normalize_slices(data, per_channel=True, epsilon=1e-7):
     """
-    Creates batch of 2D slices from one subject.
+    Zero mean unit variance normalization of each slice (first dimension) of an array (in place).
 
-    Does not depend on DKFZ/BatchGenerators package. Therefore good for inference on windows
-    where DKFZ/Batchgenerators do not work (because of MultiThreading problems)
-    """
-    def __init__(self, data, batch_size):
-        self.Config = None
-        self.batch_size = batch_size
-        self.global_idx = 0
-        self._data = data
+    Gives the same result as applying ZeroMeanUnitVarianceTransform to each batch, but only has to be done once
+    per image instead of once per batch.
 
-    def __iter__(self):
-        return self
+    Args:
+        data: array with shape (nr_slices, channels, x, y, [z])
+        per_channel: Normalize each channel separately
+        epsilon: Prevent division by zero
 
-    def __next__(self):
-        return self.generate_train_batch()
+    Returns:
+        normalized data
+    """
+    axes = tuple(range(1 if per_channel else 0, data.ndim - 1))  # axes of one slice
+    for idx in range(data.shape[0]):
+        # normalize one slice at a time to avoid temporary arrays of the size of the whole image
+        data_slice = data[idx]
+        mean = data_slice.mean(axis=axes, keepdims=True)
+        std = data_slice.std(axis=axes, keepdims=True) + epsilon
+        data_slice -= mean
+        data_slice /= std
+    return data
+
+
+def get_tile_positions(img_size, tile_size, overlap=0.5):
+    """
+    Get start positions of overlapping tiles along one axis so that the whole axis is covered.
 
-    def generate_train_batch(self):
-        data = self._data[0]
-        seg = self._data[1]
+    Args:
+        img_size: size of the image along this axis
+        tile_size: size of the tiles along this axis
+        overlap: overlap of neighbouring tiles (fraction of tile_size)
 
-        if self.Config.SLICE_DIRECTION == "x":
-            end = data.shape[0]
-        elif self.Config.SLICE_DIRECTION == "y":
-            end = data.shape[1]
-        elif self.Config.SLICE_DIRECTION == "z":
-            end = data.shape[2]
+    Returns:
+        list of start positions
+    """
+    if tile_size >= img_size:
+        return [0]
+    step = max(int(tile_size * (1 - overlap)), 1)
+    nr_steps = int(np.ceil((img_size - tile_size) / float(step))) + 1
+    return [int(round(pos)) for pos in np.linspace(0, img_size - tile_size, nr_steps)]
 
-        # Stop iterating if we reached end of data
-        if self.global_idx >= end:
-            self.global_idx = 0
-            raise StopIteration
 
-        new_global_idx = self.global_idx + self.batch_size
+def get_gaussian_importance_map(tile_size, sigma_scale=1. / 8):
+    """
+    Gaussian weights for blending overlapping tiles. Predictions in the center of a tile get a higher weight than
+    predictions at the border of a tile (where the network has less context).
 
-        # If we reach end, make last batch smaller, so it fits exactly for rest
-        if new_global_idx >= end:
-            new_global_idx = end  # not end-1, because this goes into range, and there automatically -1
+    Args:
+        tile_size: shape of the tiles (x, y, z)
+        sigma_scale: sigma of the gaussian relative to tile_size
 
-        slice_idxs = list(range(self.global_idx, new_global_idx))
-        slice_direction = data_utils.slice_dir_to_int(self.Config.SLICE_DIRECTION)
+    Returns:
+        3D array with shape tile_size (maximum is 1)
+    """
+    importance_map = np.ones(tile_size, dtype=np.float32)
+    for axis, size in enumerate(tile_size):
+        coords = np.arange(size, dtype=np.float32) - (size - 1) / 2.
+        sigma = size * sigma_scale
+        shape = [1, 1, 1]
+        shape[axis] = size
+        importance_map *= np.exp(-coords ** 2 / (2 * sigma ** 2)).reshape(shape)
+    importance_map /= importance_map.max()
+    # Avoid weights of (almost) zero at the borders. Otherwise voxels at the border of the image which are only
+    # covered by one tile get numerically unstable
+    importance_map = np.maximum(importance_map, 1e-3)
+    return importance_map
+
+
+class BatchGenerator_data_ordered_inference(object):
+    """
+    Creates batches of 2D slices (or one 3D image for 3D models) from one subject in ordered way.
 
-        if self.Config.NR_SLICES > 1:
-            x, y = data_utils.sample_Xslices(data, seg, slice_idxs, slice_direction=slice_direction,
-                                             labels_type=self.Config.LABELS_TYPE, slice_window=self.Config.NR_SLICES)
+    The data is transposed to (slices, channels, x, y) and normalized only once. The batches are views into this
+    array (converted to torch with torch.from_numpy without copying) and the next batches are prepared by a
+    background thread while the current batch is processed.
+    """
+    def __init__(self, Config, data, seg=None, batch_size=1, nr_prefetch=2):
+        """
+        Args:
+            Config: Config class
+            data: 4D numpy array (x, y, z, channels)
+            seg: 4D numpy array with ground truth (x, y, z, nr_classes) or None (only prediction)
+            batch_size: batch size
+            nr_prefetch: number of batches which are prepared in advance
+        """
+        self.Config = Config
+        self.batch_size = batch_size
+        self.nr_prefetch = nr_prefetch
+        self._seg = seg
+        self._normalize_batches = False
+
+        if Config.DIM == "2D":
+            self.slice_direction = data_utils.slice_dir_to_int(Config.SLICE_DIRECTION)
+            # Same order as in data_utils.sample_slices: (slices, channels, x, y)
+            self._axes_order = [(0, 3, 1, 2), (1, 3, 0, 2), (2, 3, 0, 1)][self.slice_direction]
+            self._data = self._prepare_data_2D(data)
         else:
-            x, y = data_utils.sample_slices(data, seg, slice_idxs,
-                                            slice_direction=slice_direction,
-                                            labels_type=self.Config.LABELS_TYPE)
+            if batch_size != 1:
+                raise ValueError("only batch_size=1 allowed")
+            self.slice_direction = None
+            self._axes_order = (3, 0, 1, 2)
+            x = np.ascontiguousarray(data.transpose(self._axes_order), dtype=np.float32)[np.newaxis, ...]
+            np.nan_to_num(x, copy=False)
+            if self.Config.NORMALIZE_DATA:
+                normalize_slices(x, per_channel=self.Config.NORMALIZE_PER_CHANNEL)
+            self._data = x  # (1, channels, x, y, z)
+
+    def _prepare_data_2D(self, data):
+        sw = self.Config.NR_SLICES  # slice window (only odd numbers allowed)
+        assert sw % 2 == 1, "Slice_window has to be an odd number"
+        pad = int((sw - 1) / 2)
+
+        shape = [data.shape[axis] for axis in self._axes_order]
+        shape[0] += 2 * pad  # padded with zero slices for slice window
+        x = np.zeros(shape, dtype=np.float32)
+        x[pad:shape[0] - pad] = data.transpose(self._axes_order)
+        np.nan_to_num(x, copy=False)
 
-        data_dict = {"data": x,     # (batch_size, channels, x, y, [z])
-                     "seg": y}      # (batch_size, channels, x, y, [z])
-        self.global_idx = new_global_idx
-        return data_dict
-
-
-class BatchGenerator3D_data_ordered_standalone(object):
-    def __init__(self, data, batch_size=1):
-        self.Config = None
-        if batch_size != 1:
-            raise ValueError("only batch_size=1 allowed")
-        self.batch_size = batch_size
-        self.global_idx = 0
-        self._data = data
+        if self.Config.NORMALIZE_DATA:
+            if sw == 1 or self.Config.NORMALIZE_PER_CHANNEL:
+                normalize_slices(x, per_channel=self.Config.NORMALIZE_PER_CHANNEL)
+            else:
+                # statistics are calculated over the whole slice window -> normalize each batch
+                self._normalize_batches = True
+
+        if sw > 1:
+            # View with shape (slices, sw*channels, x, y) where each entry contains the slice window around one
+            # slice (same as data_utils.sample_Xslices but without copying the data)
+            s = x.strides
+            x = np.lib.stride_tricks.as_strided(x, shape=(shape[0] - 2 * pad, sw * shape[1], shape[2], shape[3]),
+                                                strides=(s[0], s[1], s[2], s[3]))
+        return x
+
+    def __len__(self):
+        return int(np.ceil(self._data.shape[0] / float(self.batch_size)))
+
+    def _get_seg(self, start, end):
+        seg = self._seg.transpose(self._axes_order)
+        if self.slice_direction is None:
+            seg = seg[np.newaxis, ...]
+        return np.array(seg[start:end]).astype(self.Config.LABELS_TYPE)
+
+    def generate_batches(self):
+        for start in range(0, self._data.shape[0], self.batch_size):
+            end = min(start + self.batch_size, self._data.shape[0])
+            x = self._data[start:end]
+            if self._normalize_batches:
+                x = zero_mean_unit_variance_normalization(np.array(x), per_channel=False, epsilon=1e-7)
+            x = torch.from_numpy(x).contiguous()  # no copy if already contiguous
+            y = self._get_seg(start, end) if self._seg is not None else None
+            yield {"data": x,   # (batch_size, channels, x, y, [z])
+                   "seg": y}    # (batch_size, channels, x, y, [z]) or None
 
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        return self.generate_train_batch()
-
-    def generate_train_batch(self):
-        data = self._data[0]    # (x, y, z, channels)
-        seg = self._data[1]
-
-        # Stop iterating if we reached end of data
-        if self.global_idx >= 1:
-            self.global_idx = 0
-            raise StopIteration
-        self.global_idx += self.batch_size
-
-        x = data.transpose(3, 0, 1, 2)[np.newaxis,...]  # channels have to be first, add batch_size of 1
-        y = seg.transpose(3, 0, 1, 2)[np.newaxis,...]
-
-        data_dict = {"data": np.array(x),     # (batch_size, channels, x, y, [z])
-                     "seg": np.array(y)}      # (batch_size, channels, x, y, [z])
-        return data_dict
+        """
+        Iterate over the batches. The batches are generated in a background thread.
+        """
+        queue = Queue(maxsize=self.nr_prefetch)
+        stop = threading.Event()
+        end_of_data = object()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def _producer():
+            batches = self.generate_batches()
+            try:
+                while True:
+                    with profiler.span("prepare_batch"):
+                        batch = next(batches, end_of_data)
+                    if batch is end_of_data:
+                        break
+                    if not _put(batch):
+                        return
+            except Exception as e:
+                _put(e)
+                return
+            _put(end_of_data)
+
+        thread = threading.Thread(target=_producer, name="BatchPrefetch")
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                with profiler.span("wait_for_batch"):  # long waits: prefetching is slower than the model
+                    item = queue.get()
+                if item is end_of_data:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
 
 
 class DataLoaderInference():
@@ -127,25 +243,12 @@ class DataLoaderInference():
         self.data = data
         self.subject = subject
 
-    def _augment_data(self, batch_generator, type=None):
-        tfs = []
-
-        if self.Config.NORMALIZE_DATA:
-            tfs.append(ZeroMeanUnitVarianceTransform_Standalone(per_channel=self.Config.NORMALIZE_PER_CHANNEL))
-
-        tfs.append(NumpyToTensor(keys=["data", "seg"], cast_to="float"))
-
-        batch_gen = SingleThreadedAugmenter(batch_generator, Compose(tfs))
-        return batch_gen
-
     def get_batch_generator(self, batch_size=1):
 
         if self.data is not None:
             exp_utils.print_verbose(self.Config.VERBOSE, "Loading data from PREDICT_IMG input file")
-            data = np.nan_to_num(self.data)
-            # Use dummy mask in case we only want to predict on some data (where we do not have ground truth))
-            seg = np.zeros((self.Config.INPUT_DIM[0], self.Config.INPUT_DIM[0],
-                            self.Config.INPUT_DIM[0], self.Config.NR_OF_CLASSES)).astype(self.Config.LABELS_TYPE)
+            data = self.data
+            seg = None  # no ground truth available if we only want to predict
         elif self.subject is not None:
             if self.Config.TYPE == "combined":
                 # Load from npy file for Fusion
@@ -173,12 +276,73 @@ class DataLoaderInference():
         else:
             raise ValueError("Neither 'data' nor 'subject' set.")
 
-        if self.Config.DIM == "2D":
-            batch_gen = BatchGenerator2D_data_ordered_standalone((data, seg), batch_size=batch_size)
-        else:
-            batch_gen = BatchGenerator3D_data_ordered_standalone((data, seg), batch_size=batch_size)
-        batch_gen.Config = self.Config
+        tile_size = getattr(self.Config, "INFERENCE_TILE_SIZE", None)
+        if self.Config.DIM == "3D" and tile_size is not None:
+            return BatchGenerator3D_tiles_inference(self.Config, data, seg=seg, batch_size=batch_size,
+                                                    tile_size=tile_size, overlap=self.Config.INFERENCE_TILE_OVERLAP)
+        return BatchGenerator_data_ordered_inference(self.Config, data, seg=seg, batch_size=batch_size)
+
 
-        batch_gen = self._augment_data(batch_gen, type=type)
-        return batch_gen
+class BatchGenerator3D_tiles_inference(BatchGenerator_data_ordered_inference):
+    """
+    Creates batches of overlapping 3D tiles from one subject (sliding window inference). Needs a lot less memory
+    than running a 3D model on the whole image at once.
 
+    Tiles which only contain zeros (outside of the bounding box of the nonzero input, e.g. the brain) are skipped.
+    """
+    def __init__(self, Config, data, seg=None, batch_size=1, tile_size=64, overlap=0.5, nr_prefetch=2):
+        """
+        Args:
+            Config: Config class
+            data: 4D numpy array (x, y, z, channels)
+            seg: 4D numpy array with ground truth (x, y, z, nr_classes) or None (only prediction)
+            batch_size: number of tiles per batch
+            tile_size: size of the (cubic) tiles; has to be divisible by 8 (because of pooling in the network)
+            overlap: overlap of neighbouring tiles (fraction of tile_size)
+            nr_prefetch: number of batches which are prepared in advance
+        """
+        if tile_size % 8 != 0:
+            raise ValueError("tile_size has to be divisible by 8")
+        super(BatchGenerator3D_tiles_inference, self).__init__(Config, data, seg=seg, batch_size=1,
+                                                               nr_prefetch=nr_prefetch)
+        self.batch_size = batch_size
+        self.tile_size = tuple(min(tile_size, size) for size in data.shape[:3])
+        self.importance_map = get_gaussian_importance_map(self.tile_size)
+
+        self.tiles = []
+        if np.any(data):
+            bbox = data_utils.get_bbox_from_mask(data, 0)
+            positions = [get_tile_positions(data.shape[axis], self.tile_size[axis], overlap) for axis in range(3)]
+            for x in positions[0]:
+                for y in positions[1]:
+                    for z in positions[2]:
+                        if self._tile_overlaps_bbox((x, y, z), bbox):
+                            self.tiles.append((x, y, z))
+
+    def _tile_overlaps_bbox(self, tile_start, bbox):
+        for axis in range(3):
+            if tile_start[axis] >= bbox[axis][1] or tile_start[axis] + self.tile_size[axis] <= bbox[axis][0]:
+                return False
+        return True
+
+    def __len__(self):
+        return int(np.ceil(len(self.tiles) / float(self.batch_size)))
+
+    def _get_tile(self, img, tile_start):
+        x, y, z = tile_start
+        tx, ty, tz = self.tile_size
+        return img[:, x:x + tx, y:y + ty, z:z + tz]
+
+    def generate_batches(self):
+        for start in range(0, len(self.tiles), self.batch_size):
+            tiles = self.tiles[start:start + self.batch_size]
+            x = np.array([self._get_tile(self._data[0], tile) for tile in tiles])
+            x = torch.from_numpy(x)
+            if self._seg is not None:
+                seg = self._seg.transpose(self._axes_order)
+                y = np.array([self._get_tile(seg, tile) for tile in tiles]).astype(self.Config.LABELS_TYPE)
+            else:
+                y = None
+            yield {"data": x,       # (batch_size, channels, x, y, z)
+                   "seg": y,        # (batch_size, channels, x, y, z) or None
+                   "tiles": tiles}  # start position of each tile
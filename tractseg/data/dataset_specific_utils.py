@@ -5,7 +5,6 @@ from __future__ import print_function
 
 import numpy as np
 
-from tractseg.libs import img_utils
 from tractseg.data.subjects import get_all_subjects
 from tractseg.libs import utils
 
@@ -167,6 +166,35 @@ def get_bundle_names(CLASSES):
     return ["BG"] + bundles  # Add Background label (is always beginning of list)
 
 
+def get_bundle_idxs(CLASSES, bundles):
+    """
+    Get the indices of a subset of bundles within the bundles of CLASSES (without background).
+    For endpoint classes (e.g. "All_endpoints") the "_b" and "_e" entries of each bundle are selected.
+
+    Args:
+        CLASSES: name of the set of bundles (e.g. "All")
+        bundles: list of bundle names (e.g. ["CST_right", "AF_left"])
+
+    Returns:
+        list of indices (in the same order as in get_bundle_names(CLASSES))
+    """
+    selected = set()
+    for bundle in bundles:
+        selected.update([bundle, bundle + "_b", bundle + "_e"])
+    return [idx for idx, bundle in enumerate(get_bundle_names(CLASSES)[1:]) if bundle in selected]
+
+
+def get_bundle_names_subset(CLASSES, bundles=None):
+    """
+    Same as get_bundle_names(CLASSES)[1:] but only containing the selected bundles. If bundles is None all bundles
+    are returned.
+    """
+    bundle_names = get_bundle_names(CLASSES)[1:]
+    if bundles is None:
+        return bundle_names
+    return [bundle_names[idx] for idx in get_bundle_idxs(CLASSES, bundles)]
+
+
 def get_ACT_noACT_bundle_names():
     ACT = ['AF_left', 'AF_right', 'ATR_left', 'ATR_right', 'CC_1', 'CC_2', 'CC_3', 'CC_4', 'CC_5', 'CC_6', 'CC_7',
            'CG_left', 'CG_right', 'CST_left', 'CST_right', 'MLF_left', 'MLF_right', 'FPT_left', 'FPT_right', 'FX_left',
@@ -414,6 +442,8 @@ def scale_input_to_unet_shape(img4d, dataset, resolution="1.25mm"):
         img with dim 1mm: (144,144,144,none) or 2mm: (80,80,80,none) or 2.5mm: (80,80,80,none)
         (note: 2.5mm padded with more zeros to reach 80,80,80)
     """
+    from tractseg.libs import img_utils
+
     if resolution == "1.25mm":
         if dataset == "HCP":  # (145,174,145)
             # no resize needed
@@ -485,6 +515,8 @@ def scale_input_to_original_shape(img4d, dataset, resolution="1.25mm"):
     Returns:
         (x_original, y_original, z_original, classes)
     """
+    from tractseg.libs import img_utils
+
     if resolution == "1.25mm":
         if dataset == "HCP":  # (144,144,144)
             # no resize needed
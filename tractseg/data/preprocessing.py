@@ -18,6 +18,7 @@ from tractseg.libs.system_config import SystemConfig as C
 from tractseg.libs import data_utils
 from tractseg.data.subjects import get_all_subjects
 from tractseg.libs import exp_utils
+from tractseg.libs import cpu_budget
 
 
 #todo: adapt
@@ -117,6 +118,6 @@ def create_preprocessed_files(subject):
 if __name__ == "__main__":
     print("Output folder: {}".format(DATASET_FOLDER_PREPROC))
     subjects = get_all_subjects(dataset=dataset)
-    Parallel(n_jobs=12)(delayed(create_preprocessed_files)(subject) for subject in subjects)
+    Parallel(n_jobs=cpu_budget.get_nr_cpus(12))(delayed(create_preprocessed_files)(subject) for subject in subjects)
     # for subject in subjects:
     #     create_preprocessed_files(subject)
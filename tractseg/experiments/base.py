@@ -119,3 +119,5 @@ class Config:
     KEEP_INTERMEDIATE_FILES = False
     CSD_RESOLUTION = "LOW"  # HIGH | LOW
     NR_CPUS = -1
+    INFERENCE_TILE_SIZE = None  # only for 3D models: if set do sliding window inference with tiles of this size
+    INFERENCE_TILE_OVERLAP = 0.5  # overlap of neighbouring tiles (fraction of tile size)
@@ -0,0 +1,215 @@
+"""
+Benchmark inference on this machine for different settings (batch size, number of threads, number of workers)
+and save the fastest settings to a profile file. run_tractseg uses these settings automatically.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import socket
+import datetime
+import platform
+import importlib
+from os.path import join
+from os.path import exists
+
+import numpy as np
+import psutil
+import torch
+
+from tractseg.libs.system_config import SystemConfig as C
+from tractseg.libs.system_config import get_config_name
+from tractseg.libs import exp_utils
+from tractseg.libs import img_utils
+from tractseg.libs import cpu_budget
+from tractseg.data import dataset_specific_utils
+
+
+def get_profile_path():
+    return join(C.TRACT_SEG_HOME, "autotune_profile.json")
+
+
+def get_machine_id():
+    """
+    Identifier for the type of machine. The profile file can contain profiles for different machines (e.g. if
+    the home directory is shared between different nodes of a cluster).
+    """
+    cpu_model = platform.processor()
+    if exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    return "{} ({} cpus)".format(cpu_model if cpu_model else "unknown cpu", psutil.cpu_count())
+
+
+def load_profile(path=None):
+    """
+    Load the autotune profile of this machine.
+
+    Args:
+        path: path of profile file (default: ~/.tractseg/autotune_profile.json)
+
+    Returns:
+        dict with keys "inference_batch_size", "nr_threads", "nr_workers" or None if no profile for this
+        machine exists
+    """
+    path = get_profile_path() if path is None else path
+    if not exists(path):
+        return None
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+    except ValueError:
+        print("WARNING: Could not read autotune profile {}. Ignoring it.".format(path))
+        return None
+    return profiles.get(get_machine_id())
+
+
+def save_profile(profile, path=None):
+    path = get_profile_path() if path is None else path
+    profiles = {}
+    if exists(path):
+        try:
+            with open(path) as f:
+                profiles = json.load(f)
+        except ValueError:
+            pass
+    profiles[get_machine_id()] = profile
+    exp_utils.make_dir(os.path.dirname(path))
+    with open(path, "w") as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+
+
+def _get_candidate_cpu_counts(nr_cpus):
+    """
+    Powers of two up to nr_cpus (and nr_cpus itself).
+    """
+    candidates = []
+    n = 1
+    while n < nr_cpus:
+        candidates.append(n)
+        n *= 2
+    candidates.append(nr_cpus)
+    return candidates
+
+
+def _get_benchmark_model(output_type):
+    from tractseg.models.base_model import BaseModel
+
+    config_file = get_config_name("peaks", output_type)
+    Config = getattr(importlib.import_module("tractseg.experiments.pretrained_models." + config_file), "Config")()
+    Config = exp_utils.get_correct_labels_type(Config)
+    if Config.EXPERIMENT_TYPE == "peak_regression":
+        Config.CLASSES = "All_Part1"
+        Config.NR_OF_CLASSES = 3 * len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
+    else:
+        Config.NR_OF_CLASSES = len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
+    Config.INPUT_DIM = dataset_specific_utils.get_correct_input_dim(Config)
+    Config.LOAD_WEIGHTS = False  # weights do not matter for runtime
+    Config.DROPOUT_SAMPLING = False
+    Config.NR_CPUS = -1
+    Config.VERBOSE = False
+    return Config, BaseModel(Config, inference=True)
+
+
+def benchmark_forward(Config, model, batch_size, nr_threads, min_nr_slices=16):
+    """
+    Measure the throughput of the forward pass.
+
+    Returns:
+        slices per second
+    """
+    torch.set_num_threads(nr_threads)
+    x = np.random.normal(size=(batch_size, Config.NR_OF_GRADIENTS) + tuple(Config.INPUT_DIM)).astype(np.float32)
+    x = torch.from_numpy(x)
+    model.predict(x)  # warm up
+    nr_batches = max(int(np.ceil(min_nr_slices / float(batch_size))), 2)
+    start_time = time.time()
+    for _ in range(nr_batches):
+        model.predict(x)
+    return nr_batches * batch_size / (time.time() - start_time)
+
+
+def benchmark_workers(nr_workers, nr_channels=16):
+    """
+    Measure the runtime of resampling an image with joblib workers (like during pre- and postprocessing).
+
+    Returns:
+        runtime in seconds
+    """
+    img = np.random.random((64, 64, 64, nr_channels)).astype(np.float32)
+    start_time = time.time()
+    img_utils.resize_first_three_dims(img, order=1, zoom=1.5, nr_cpus=nr_workers)
+    return time.time() - start_time
+
+
+def autotune(output_type="tract_segmentation", batch_sizes=(1, 2, 4, 8, 16, 32), nr_cpus=None, path=None):
+    """
+    Benchmark the forward pass for different batch sizes and numbers of threads and the pre-/postprocessing
+    for different numbers of workers. The fastest settings are saved to the profile file.
+
+    The number of inter-op threads of pytorch can only be set once per process. It is not benchmarked because
+    the forward pass of the UNet does not use inter-op parallelism.
+
+    Args:
+        output_type: model to benchmark (tract_segmentation|endings_segmentation|TOM|dm_regression)
+        batch_sizes: batch sizes to try. Larger batch sizes are only tried as long as they are faster and fit
+                     into memory.
+        nr_cpus: maximum number of threads/workers to try (default: all CPUs)
+        path: path of profile file (default: ~/.tractseg/autotune_profile.json)
+
+    Returns:
+        profile (dict)
+    """
+    nr_cpus = cpu_budget.get_nr_cpus(-1 if nr_cpus is None else nr_cpus)
+    Config, model = _get_benchmark_model(output_type)
+
+    print("Benchmarking forward pass...")
+    best_forward = None  # (slices_per_sec, batch_size, nr_threads)
+    for nr_threads in _get_candidate_cpu_counts(nr_cpus):
+        last_speed = 0
+        for batch_size in batch_sizes:
+            try:
+                speed = benchmark_forward(Config, model, batch_size, nr_threads)
+            except (RuntimeError, MemoryError):
+                print("threads: {:3d}  batch_size: {:3d}  -> out of memory".format(nr_threads, batch_size))
+                break
+            print("threads: {:3d}  batch_size: {:3d}  -> {:.2f} slices/s".format(nr_threads, batch_size, speed))
+            if best_forward is None or speed > best_forward[0]:
+                best_forward = (speed, batch_size, nr_threads)
+            if speed < last_speed * 1.05:
+                break  # larger batch sizes do not help anymore
+            last_speed = speed
+    del model
+
+    best_workers = (0, 1)  # (runtime, nr_workers)
+    if nr_cpus > 1:
+        print("Benchmarking workers...")
+        best_workers = None
+        for nr_workers in _get_candidate_cpu_counts(nr_cpus):
+            runtime = benchmark_workers(nr_workers)
+            print("workers: {:3d}  -> {:.2f}s".format(nr_workers, runtime))
+            if best_workers is None or runtime < best_workers[0]:
+                best_workers = (runtime, nr_workers)
+
+    profile = {
+        "inference_batch_size": best_forward[1],
+        "nr_threads": best_forward[2],
+        "nr_workers": best_workers[1],
+        "slices_per_sec": round(best_forward[0], 2),
+        "output_type": output_type,
+        "hostname": socket.gethostname(),
+        "torch_version": torch.__version__,
+        "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    save_profile(profile, path=path)
+    print("Best settings: inference_batch_size={}, threads={}, workers={}".format(
+        profile["inference_batch_size"], profile["nr_threads"], profile["nr_workers"]))
+    print("Saved profile to {}".format(get_profile_path() if path is None else path))
+    return profile
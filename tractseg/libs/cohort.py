@@ -0,0 +1,219 @@
+"""
+Process a cohort of subjects (`TractSeg --subjects_file`) in a pipeline of three stages which run at the same time:
+
+- loader thread: loads the input of the next subject
+- main thread: runs the model on the current subject (the models are only loaded once for all subjects)
+- writer threads: compress and save the output (gzip) of the bundles which are done
+
+The stages are connected by bounded queues, so only a few subjects / groups of bundles are kept in memory. The time
+for loading and saving (especially on network storage) is mostly hidden behind the computation.
+
+With a WorkQueue (`--queue_dir`) several nodes can process the same cohort: each subject is claimed before loading
+and released when all of its output is saved.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import threading
+import traceback
+from os.path import join
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
+
+from tractseg.libs import exp_utils
+from tractseg.libs import inference_server
+from tractseg.libs import work_queue as work_queue_lib
+
+
+def read_subjects_file(path):
+    """
+    Read text file with one subject per line: path of the peak image and optionally the output directory
+    (separated by whitespace, default: tractseg_output next to the peak image). Empty lines and lines starting
+    with # are ignored.
+
+    Returns:
+        list of (input_path, output_dir)
+    """
+    subjects = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            parts = line.split()
+            if len(parts) > 2:
+                raise ValueError("Invalid line in subjects file (expected 'input [output]'): {}".format(line))
+            input_path = os.path.abspath(parts[0])
+            output_dir = os.path.abspath(parts[1]) if len(parts) == 2 else \
+                join(os.path.dirname(input_path), "tractseg_output")
+            subjects.append((input_path, output_dir))
+    return subjects
+
+
+class _Subject(object):
+    """
+    State of a subject in the pipeline. The subject is finished when the model is done and all of its groups of
+    bundles are saved.
+    """
+
+    def __init__(self, input_path, output_dir, subject_id=None, on_finish=None):
+        self.input_path = input_path
+        self.output_dir = output_dir
+        self.subject_id = subject_id
+        self.on_finish = on_finish
+        self.start_time = time.time()
+        self.timings = {}
+        self.error = None
+        self._pending_writes = 0
+        self._computed = False
+        self._lock = threading.Lock()
+
+    def add_write(self):
+        with self._lock:
+            self._pending_writes += 1
+
+    def write_done(self, error=None):
+        with self._lock:
+            self._pending_writes -= 1
+            self.error = self.error or error
+            finished = self._computed and self._pending_writes == 0
+        if finished:
+            self._finish()
+
+    def compute_done(self, error=None):
+        with self._lock:
+            self._computed = True
+            self.error = self.error or error
+            finished = self._pending_writes == 0
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        self.timings["total"] = round(time.time() - self.start_time, 2)
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+
+def _load_subjects(subjects, load_queue, work_queue=None):
+    for input_path, output_dir in subjects:
+        subject_id = None
+        if work_queue is not None:
+            subject_id = work_queue_lib.get_subject_id(input_path)
+            if not work_queue.claim(subject_id):
+                continue  # done or processed by other node
+        subject = _Subject(input_path, output_dir, subject_id,
+                           on_finish=None if work_queue is None else
+                           lambda s: work_queue.finish(s.subject_id, timings=s.timings, error=s.error))
+        try:
+            subject.data = inference_server.load_peaks(input_path)
+        except Exception as e:
+            subject.data = None
+            subject.error = e
+        subject.timings["load"] = round(time.time() - subject.start_time, 2)
+        load_queue.put(subject)
+    load_queue.put(None)
+
+
+def _write_bundles(write_queue, errors):
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        subject, save_args = item
+        error = None
+        try:
+            inference_server.save_bundles(*save_args)
+        except Exception as e:
+            traceback.print_exc()
+            errors.append((subject.output_dir, e))
+            error = e
+        subject.write_done(error)
+
+
+def run_cohort(subjects, output_type="tract_segmentation", bundles=None, single_orientation=False,
+               get_probs=False, postprocess=True, tract_definition="TractQuerier+", nr_cpus=-1, nr_writers=2,
+               write_queue_size=4, work_queue=None, verbose=False):
+    """
+    Run TractSeg for all subjects (see module docstring).
+
+    Args:
+        subjects: list of (input_path, output_dir) (see read_subjects_file)
+        output_type: same as for run_tractseg
+        nr_writers: number of threads which save the output
+        write_queue_size: maximum number of groups of bundles waiting to be saved (limits memory)
+        work_queue: WorkQueue shared with other nodes (only process subjects which can be claimed)
+        (other args same as for run_tractseg)
+
+    Returns:
+        list of (output_dir, error) of the subjects which failed
+    """
+    options = {"bundles": bundles, "single_orientation": single_orientation, "get_probabilities": get_probs,
+               "postprocess": postprocess, "tract_definition": tract_definition}
+    errors = []
+
+    load_queue = Queue(maxsize=1)  # prefetch one subject
+    loader = threading.Thread(target=_load_subjects, args=(subjects, load_queue, work_queue))
+    loader.daemon = True
+    loader.start()
+
+    write_queue = Queue(maxsize=write_queue_size)
+    writers = []
+    for _ in range(nr_writers):
+        writer = threading.Thread(target=_write_bundles, args=(write_queue, errors))
+        writer.daemon = True
+        writer.start()
+        writers.append(writer)
+
+    start_time = time.time()
+    nr_subjects = 0
+    while True:
+        wait_start = time.time()
+        subject = load_queue.get()
+        if subject is None:
+            break
+        nr_subjects += 1
+        print("Subject {}/{}: {}".format(nr_subjects, len(subjects), subject.input_path))
+        if subject.data is None:
+            print("ERROR: Could not load {}: {}".format(subject.input_path, subject.error))
+            errors.append((subject.output_dir, subject.error))
+            subject.compute_done()
+            continue
+        data, affine, flip_axis = subject.data
+        del subject.data
+        subject.timings["wait_for_input"] = round(time.time() - wait_start, 2)
+        exp_utils.make_dir(subject.output_dir)
+
+        def write(seg, bundle_names, classes, threshold):
+            subject.add_write()
+            # Blocks if the writers can not keep up (bounded queue)
+            write_queue.put((subject, (output_type, classes, seg, bundle_names, affine, subject.output_dir,
+                                       flip_axis, threshold)))
+
+        compute_start = time.time()
+        error = None
+        try:
+            inference_server.run_model(data, output_type, subject.output_dir, options, write, nr_cpus=nr_cpus,
+                                       verbose=verbose)
+        except Exception as e:
+            traceback.print_exc()
+            errors.append((subject.output_dir, e))
+            error = e
+        del data
+        subject.timings["compute"] = round(time.time() - compute_start, 2)
+        exp_utils.print_verbose(verbose, "Subject {}: {}".format(nr_subjects, subject.timings))
+        subject.compute_done(error)
+
+    for _ in writers:
+        write_queue.put(None)
+    for writer in writers:
+        writer.join()
+    print("Processed {} subjects in {}s ({} failed)".format(nr_subjects, round(time.time() - start_time, 2),
+                                                           len(set(output_dir for output_dir, _ in errors))))
+    return errors
@@ -0,0 +1,213 @@
+"""
+Number of CPUs TractSeg can use. All parallel parts (joblib, multiprocessing, pytorch threads and MRtrix -nthreads)
+get their number of workers/threads from here:
+
+- available CPUs: CPUs this process may run on (sched affinity, e.g. taskset or cpusets of a cluster job) limited
+  by the CPU quota of the cgroup (e.g. `docker --cpus`). psutil.cpu_count() would return all cores of the host.
+- budget: available CPUs or less if set with set_budget() (e.g. by `--nr_cpus`). The budget is saved in the
+  environment variable TRACTSEG_NR_CPUS, so child processes (workers, MRtrix, TractSeg started by run_cohort)
+  inherit it. The variable can also be set by the user.
+
+If several workers run at the same time, each worker only gets its share of the budget (split_budget), so nested
+parallelism does not use more CPUs than the budget.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import math
+import glob
+import threading
+
+
+ENV_VAR = "TRACTSEG_NR_CPUS"
+
+_available_cpus = None
+_torch_threads = None
+_torch_threads_lock = threading.Lock()
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _get_cgroup_cpu_limit(cgroup_root="/sys/fs/cgroup"):
+    """
+    CPU quota of the cgroup of this process in number of CPUs (cgroup v2 and v1).
+
+    Returns:
+        float or None if there is no limit
+    """
+    cgroup_dir = cgroup_root
+    cgroups = _read("/proc/self/cgroup")
+    if cgroups is not None:
+        for line in cgroups.splitlines():
+            if line.startswith("0::"):  # cgroup v2
+                cgroup_dir = os.path.normpath(cgroup_root + line[3:])
+
+    # v2: the quotas of the parent cgroups also apply -> smallest quota on the path up to the root
+    limits = []
+    found = False
+    while True:
+        cpu_max = _read(os.path.join(cgroup_dir, "cpu.max"))  # "<quota> <period>" or "max <period>"
+        if cpu_max is not None:
+            found = True
+            quota, period = cpu_max.split()
+            if quota != "max":
+                limits.append(int(quota) / int(period))
+        if not cgroup_dir.startswith(cgroup_root + "/"):
+            break
+        cgroup_dir = os.path.dirname(cgroup_dir)
+    if found:
+        return min(limits) if len(limits) > 0 else None
+
+    for cgroup_dir in [os.path.join(cgroup_root, "cpu"), os.path.join(cgroup_root, "cpu,cpuacct")]:  # v1
+        quota = _read(os.path.join(cgroup_dir, "cpu.cfs_quota_us"))
+        period = _read(os.path.join(cgroup_dir, "cpu.cfs_period_us"))
+        if quota is not None and period is not None and int(quota) > 0:
+            return int(quota) / int(period)
+    return None
+
+
+def _get_affinity_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    import psutil
+    try:
+        return len(psutil.Process().cpu_affinity())
+    except (AttributeError, NotImplementedError):  # macOS
+        return psutil.cpu_count()
+
+
+def get_available_cpus():
+    """
+    Number of CPUs this process can use (sched affinity and cgroup quota).
+    """
+    global _available_cpus
+    if _available_cpus is None:
+        nr_cpus = _get_affinity_cpus()
+        cgroup_limit = _get_cgroup_cpu_limit()
+        if cgroup_limit is not None:
+            nr_cpus = min(nr_cpus, int(math.ceil(cgroup_limit)))
+        _available_cpus = max(nr_cpus, 1)
+    return _available_cpus
+
+
+def get_budget():
+    """
+    Number of CPUs TractSeg may use in this process (including its child processes).
+    """
+    budget = os.environ.get(ENV_VAR)
+    if budget is not None and int(budget) > 0:
+        return min(int(budget), get_available_cpus())
+    return get_available_cpus()
+
+
+def set_budget(nr_cpus):
+    """
+    Limit number of CPUs for this process and its child processes. -1: all available CPUs.
+    """
+    if nr_cpus is None or nr_cpus <= 0:
+        os.environ.pop(ENV_VAR, None)
+    else:
+        os.environ[ENV_VAR] = str(nr_cpus)
+
+
+def get_nr_cpus(nr_cpus=-1):
+    """
+    Number of CPUs to use: nr_cpus, but at most the budget. -1: the whole budget.
+    """
+    if nr_cpus is None or nr_cpus <= 0:
+        return get_budget()
+    return min(nr_cpus, get_budget())
+
+
+def split_budget(nr_workers, nr_cpus=-1):
+    """
+    Number of CPUs each of nr_workers workers running at the same time can use.
+    """
+    return max(get_nr_cpus(nr_cpus) // max(nr_workers, 1), 1)
+
+
+def init_torch_threads(nr_threads=-1):
+    """
+    Limit the threads of pytorch (at most the budget). The number of threads is a setting of the whole process which
+    must not change while models are used by other threads, so only the first call has an effect (call at startup).
+
+    Returns:
+        number of threads of pytorch
+    """
+    global _torch_threads
+    with _torch_threads_lock:
+        if _torch_threads is None:
+            import torch
+            _torch_threads = get_nr_cpus(nr_threads)
+            torch.set_num_threads(_torch_threads)
+        return _torch_threads
+
+
+def limit_threads(nr_threads):
+    """
+    Limit threads of pytorch (if imported) and of BLAS/OpenMP (if threadpoolctl is installed) in this process.
+    Use as initializer of worker processes: initializer=limit_threads, initargs=(nr_threads,)
+    """
+    import sys
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(nr_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(nr_threads)
+    except ImportError:
+        pass
+    set_budget(nr_threads)
+
+
+def mrtrix_nthreads(nr_cpus=-1):
+    """
+    -nthreads option for MRtrix commands (MRtrix would use all cores of the host otherwise).
+    """
+    return " -nthreads " + str(get_nr_cpus(nr_cpus))
+
+
+def get_numa_nodes():
+    """
+    CPUs of each NUMA node this process can run on (Linux only).
+
+    Returns:
+        list of sets of CPU ids (one set per NUMA node, empty list if not available)
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return []
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for node_dir in sorted(glob.glob("/sys/devices/system/node/node[0-9]*"),
+                           key=lambda d: int(os.path.basename(d)[4:])):
+        cpus = set()
+        for cpu_range in (_read(os.path.join(node_dir, "cpulist")) or "").split(","):
+            if "-" in cpu_range:
+                start, end = cpu_range.split("-")
+                cpus.update(range(int(start), int(end) + 1))
+            elif cpu_range:
+                cpus.add(int(cpu_range))
+        if len(cpus & allowed) > 0:
+            nodes.append(cpus & allowed)
+    return nodes
+
+
+def bind_to_numa_node(node_idx):
+    """
+    Only run this process (and its child processes) on the CPUs of one NUMA node, so the memory is local. Useful
+    if running one process per NUMA node.
+    """
+    global _available_cpus
+    nodes = get_numa_nodes()
+    if node_idx >= len(nodes):
+        raise ValueError("NUMA node {} not available (only {} nodes)".format(node_idx, len(nodes)))
+    os.sched_setaffinity(0, nodes[node_idx])
+    _available_cpus = None
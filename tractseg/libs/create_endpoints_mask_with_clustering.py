@@ -20,7 +20,6 @@ import sys
 
 import nibabel as nib
 import numpy as np
-from nibabel import trackvis
 
 from dipy.tracking.streamline import transform_streamlines
 from sklearn.cluster import KMeans
@@ -30,6 +29,9 @@ from sklearn.cluster import AgglomerativeClustering
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.utils import shuffle as sk_shuffle
 
+from tractseg.libs import cpu_budget
+from tractseg.libs import streamline_io
+
 
 def select_two_biggest_clusters(labels, points):
     hist = np.histogram(labels, len(np.unique(labels)))[0]  # histogram of cluster sizes
@@ -51,10 +53,12 @@ def cluster(points, algorithm=DBSCAN):
     print("Running {}...".format(algorithm))
     if algorithm == "KMeans":
         # not good at finding clusters if close together
-        labels = KMeans(n_clusters=2, random_state=0, n_jobs=-1).fit_predict(points)
+        # newer sklearn versions have no n_jobs for KMeans (uses OpenMP threads; limited if threadpoolctl is installed)
+        cpu_budget.limit_threads(cpu_budget.get_nr_cpus())
+        labels = KMeans(n_clusters=2, random_state=0).fit_predict(points)
     elif algorithm == "DBSCAN":
         # no fixed number of labels; slow with high eps
-        labels = DBSCAN(eps=3.0, n_jobs=-1).fit_predict(points)
+        labels = DBSCAN(eps=3.0, n_jobs=cpu_budget.get_nr_cpus()).fit_predict(points)
     # labels = SpectralClustering(n_clusters=2, n_jobs=-1).fit_predict(points)  # slow (> 1min)
     # labels = AgglomerativeClustering(n_clusters=2).fit_predict(points)  # fast
     points_start, points_end = select_two_biggest_clusters(labels, points)
@@ -79,10 +83,9 @@ file_in = args[1]
 file_out = args[2]
 
 ref_img = nib.load(ref_img_in)
-ref_img_shape = ref_img.get_fdata().shape
+ref_img_shape = ref_img.shape
 
-streams, hdr = trackvis.read(file_in)
-streamlines = [s[0] for s in streams]
+streamlines = streamline_io.load(file_in, legacy=True)
 streamlines = transform_streamlines(streamlines, np.linalg.inv(ref_img.affine))
 
 mask_start = np.zeros(ref_img_shape)
@@ -118,7 +121,7 @@ if len(streamlines) > 0:
     X = np.concatenate((points_start, points_end), axis=0)
     y = np.concatenate((np.zeros(points_start.shape[0]), np.ones(points_end.shape[0])))
     X, y = sk_shuffle(X, y, random_state=9)
-    clf = RandomForestClassifier(n_estimators=10, n_jobs=-1)
+    clf = RandomForestClassifier(n_estimators=10, n_jobs=cpu_budget.get_nr_cpus())
     clf.fit(X, y)
     labels = clf.predict(points)
 
@@ -3,43 +3,102 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from os.path import join
+
 import numpy as np
 
 from tractseg.data.data_loader_inference import DataLoaderInference
 from tractseg.libs import peak_utils
+from tractseg.libs import exp_utils
+from tractseg.libs import cpu_budget
+from tractseg.libs import profiler
 
 
 def get_seg_single_img_3_directions(Config, model, subject=None, data=None, scale_to_world_shape=True,
-                                    only_prediction=False, batch_size=1):
+                                    only_prediction=False, batch_size=1, channel_idxs=None):
     from tractseg.libs import trainer
 
-    prob_slices = []
+    probs_combined = None
     directions = ["x", "y", "z"]
     for idx, direction in enumerate(directions):
-        Config.SLICE_DIRECTION = direction
+        # Do not change the Config itself (might be used by other threads at the same time)
+        Config_dir = exp_utils.get_inference_config(Config, SLICE_DIRECTION=direction)
         print("Processing direction ({} of 3)".format(idx+1))
 
         if subject:
-            dataManagerSingle = DataLoaderInference(Config, subject=subject)  # runtime on HCP data 0s
+            dataManagerSingle = DataLoaderInference(Config_dir, subject=subject)  # runtime on HCP data 0s
         else:
-            dataManagerSingle = DataLoaderInference(Config, data=data)  # runtime on HCP data 0s
+            dataManagerSingle = DataLoaderInference(Config_dir, data=data)  # runtime on HCP data 0s
 
-        img_probs, img_y = trainer.predict_img(Config, model, dataManagerSingle, probs=True,
+        img_probs, img_y = trainer.predict_img(Config_dir, model, dataManagerSingle, probs=True,
                                                scale_to_world_shape=scale_to_world_shape,
                                                only_prediction=only_prediction,
-                                               batch_size=batch_size)    # (x, y, z, nr_classes)
-        prob_slices.append(img_probs)
-
-    probs_x, probs_y, probs_z = prob_slices
-    # runtime on HCP data: 0s
-    probs_x = probs_x[..., None]  # (x, y, z, nr_classes, 1)
-    probs_y = probs_y[..., None]
-    probs_z = probs_z[..., None]
-    # runtime on HCP data: 1.4s
-    probs_combined = np.concatenate((probs_x, probs_y, probs_z), axis=4)    # (x, y, z, nr_classes, 3)
+                                               batch_size=batch_size,
+                                               channel_idxs=channel_idxs)    # (x, y, z, nr_classes)
+        # Fill result directly instead of concatenating at the end (would need memory for 2 copies)
+        if probs_combined is None:
+            probs_combined = np.empty(img_probs.shape + (3,), dtype=img_probs.dtype)  # (x, y, z, nr_classes, 3)
+        probs_combined[..., idx] = img_probs
+        del img_probs
+
     return probs_combined, img_y
 
 
+def get_seg_single_img_3_directions_to_disk(Config, model, data, scratch_dir, batch_size=1, channel_idxs=None,
+                                            channel_group_size=8):
+    """
+    Same as get_seg_single_img_3_directions (with only_prediction=True), but the predictions of each direction
+    are stored as float16 in memory mapped files in scratch_dir instead of being kept in memory (low memory mode).
+    The files are channel first, so groups of channels can be read without loading the whole file.
+
+    Returns:
+        list of 3 paths (one .npy file per direction with shape (nr_classes, x, y, z))
+    """
+    from tractseg.libs import trainer
+
+    paths = []
+    directions = ["x", "y", "z"]
+    for idx, direction in enumerate(directions):
+        Config_dir = exp_utils.get_inference_config(Config, SLICE_DIRECTION=direction)
+        print("Processing direction ({} of 3)".format(idx+1))
+
+        dataManagerSingle = DataLoaderInference(Config_dir, data=data)
+        img_probs, _ = trainer.predict_img(Config_dir, model, dataManagerSingle, probs=True,
+                                           scale_to_world_shape=False, only_prediction=True,
+                                           batch_size=batch_size, channel_idxs=channel_idxs,
+                                           dtype=np.float16)    # (x, y, z, nr_classes)
+
+        path = join(scratch_dir, "probs_{}.npy".format(direction))
+        nr_channels = img_probs.shape[3]
+        # Only create the file here. Writing in groups and closing the memmap after each group keeps the written
+        # pages out of the memory of this process.
+        np.lib.format.open_memmap(path, mode="w+", dtype=np.float16, shape=(nr_channels,) + img_probs.shape[:3])
+        for start in range(0, nr_channels, channel_group_size):
+            probs_file = np.load(path, mmap_mode="r+")
+            probs_file[start:start + channel_group_size] = \
+                img_probs[..., start:start + channel_group_size].transpose(3, 0, 1, 2)
+            probs_file.flush()
+            del probs_file
+        del img_probs
+        paths.append(path)
+    return paths
+
+
+def _load_channels(paths, start, end):
+    """
+    Load channels [start, end) of the predictions stored by get_seg_single_img_3_directions_to_disk.
+
+    Returns:
+        5D image (x, y, z, end-start, 3)  (float32)
+    """
+    probs = []
+    for path in paths:
+        probs_file = np.load(path, mmap_mode="r")
+        probs.append(probs_file[start:end].astype(np.float32).transpose(1, 2, 3, 0))
+        del probs_file
+    return np.stack(probs, axis=4)
+
+
 def mean_fusion(threshold, img, probs=True):
     """
     Merge along last axis by mean.
@@ -60,6 +119,27 @@ def mean_fusion(threshold, img, probs=True):
     return probs_mean
 
 
+def mean_fusion_from_disk(threshold, paths, probs=True, channel_group_size=8):
+    """
+    Same as mean_fusion, but for predictions stored by get_seg_single_img_3_directions_to_disk. The channels are
+    merged in groups, so only one group of channels is loaded at a time.
+
+    Returns:
+        4D image (x, y, z, nr_classes)  (float16 for probabilities (converted to float32 by the postprocessing),
+        int16 for binary like mean_fusion)
+    """
+    shape = np.load(paths[0], mmap_mode="r").shape
+    nr_channels = shape[0]
+    probs_mean = np.empty(shape[1:] + (nr_channels,), dtype=np.float16 if probs else np.int16)
+    for start in range(0, nr_channels, channel_group_size):
+        end = min(start + channel_group_size, nr_channels)
+        probs_group = _load_channels(paths, start, end).mean(axis=4)
+        if not probs:
+            probs_group = probs_group >= threshold
+        probs_mean[..., start:end] = probs_group
+    return probs_mean
+
+
 def mean_fusion_peaks(img, nr_cpus=-1):
     """
     Calculating mean in tensor space (if simply taking mean in peak space most voxels look fine but a few are
@@ -77,16 +157,10 @@ def mean_fusion_peaks(img, nr_cpus=-1):
 
     def process_bundle(idx):
         print("idx: {}".format(idx))
-        dirs_per_bundle = []
-        for jdx in range(3):  # 3 orientations
-            peak = img[:, :, :, idx*3:idx*3+3, jdx]
-            tensor = peak_utils.peaks_to_tensors(peak)
-            dirs_per_bundle.append(tensor)
-        merged_tensor = np.array(dirs_per_bundle).mean(axis=0)
-        merged_peak = peak_utils.tensors_to_peaks(merged_tensor)
-        return merged_peak
-
-    n_jobs = 5 if nr_cpus == -1 else min(nr_cpus, 5)
+        with profiler.span("merge_peaks", bundle_idx=idx):
+            return _merge_peaks(img[:, :, :, idx*3:idx*3+3])
+
+    n_jobs = min(cpu_budget.get_nr_cpus(nr_cpus), 5)
     merged_peaks_all = Parallel(n_jobs=n_jobs)(delayed(process_bundle)(idx) for idx in range(nr_classes))
 
     merged_peaks_all = np.array(merged_peaks_all).transpose(1, 2, 3, 0, 4)
@@ -96,6 +170,37 @@ def mean_fusion_peaks(img, nr_cpus=-1):
     return merged_peaks_all
 
 
+def mean_fusion_peaks_from_disk(paths):
+    """
+    Same as mean_fusion_peaks, but for predictions stored by get_seg_single_img_3_directions_to_disk. Runs
+    bundle by bundle in this process, so only the peaks of one bundle are loaded at a time.
+
+    Returns:
+        4D image (x, y, z, nr_classes)  (float32)
+    """
+    shape = np.load(paths[0], mmap_mode="r").shape
+    merged_peaks_all = np.empty(shape[1:] + (shape[0],), dtype=np.float32)
+    for idx in range(int(shape[0] / 3)):
+        merged_peaks_all[..., idx*3:idx*3+3] = _merge_peaks(_load_channels(paths, idx*3, idx*3+3))
+    return merged_peaks_all
+
+
+def _merge_peaks(peaks):
+    """
+    Args:
+        peaks: 5D Image with peak of one bundle per direction (x, y, z, 3, 3)
+
+    Returns:
+        4D image (x, y, z, 3)
+    """
+    dirs_per_bundle = []
+    for jdx in range(3):  # 3 orientations
+        tensor = peak_utils.peaks_to_tensors(peaks[..., jdx])
+        dirs_per_bundle.append(tensor)
+    merged_tensor = np.array(dirs_per_bundle).mean(axis=0)
+    return peak_utils.tensors_to_peaks(merged_tensor)
+
+
 def majority_fusion(threshold, img, probs=None):
     """
     Use majority voting instead of mean.
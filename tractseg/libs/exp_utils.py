@@ -68,6 +68,60 @@ def print_Configs(Config):
     pprint(dict)
 
 
+class InferenceConfig(object):
+    """
+    Read-only copy of a Config class.
+
+    Used during inference so that settings which are different for each call (e.g. SLICE_DIRECTION) do not have to
+    be changed in a Config object which is shared with other calls (e.g. in other threads).
+    """
+    def __init__(self, Config, **overrides):
+        values = {attr: getattr(Config, attr) for attr in dir(Config)
+                  if not callable(getattr(Config, attr)) and not attr.startswith("__")}
+        for attr, value in overrides.items():
+            if attr not in values:
+                raise AttributeError("Config has no attribute {}".format(attr))
+            values[attr] = value
+        self.__dict__.update(values)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("InferenceConfig is read-only. Use get_inference_config(Config, {}=...) to get a "
+                             "copy with a different value.".format(attr))
+
+    def __delattr__(self, attr):
+        raise AttributeError("InferenceConfig is read-only.")
+
+
+def get_inference_config(Config, **overrides):
+    """
+    Get a read-only copy of Config with some attributes set to different values.
+
+    Args:
+        Config: Config class
+        overrides: attributes which should have a different value in the copy (e.g. SLICE_DIRECTION="y")
+
+    Returns:
+        InferenceConfig
+    """
+    Config = InferenceConfig(Config, **overrides)
+    if "NR_OF_GRADIENTS" not in overrides:
+        # depends on NR_OF_CLASSES (can not be set by BaseModel because the copy is read-only)
+        Config = InferenceConfig(Config, NR_OF_GRADIENTS=get_nr_of_gradients(Config))
+    return Config
+
+
+def get_nr_of_gradients(Config):
+    """
+    Number of input channels of the model.
+    """
+    if Config.SEG_INPUT == "Peaks" and Config.TYPE == "single_direction":
+        return Config.NR_OF_GRADIENTS
+    elif Config.SEG_INPUT == "Peaks" and Config.TYPE == "combined":
+        return 3 * Config.NR_OF_CLASSES
+    else:
+        return 33
+
+
 def get_best_weights_path(exp_path, load_weights):
     if load_weights:
         return glob.glob(exp_path + "/best_weights_ep*.npz")[0]
@@ -6,17 +6,19 @@ from __future__ import print_function
 import multiprocessing
 from os import getpid
 import numpy as np
-import nibabel as nib
+from nibabel.affines import apply_affine
 from dipy.tracking.streamline import compress_streamlines as compress_streamlines_dipy
-from dipy.segment.metric import ResampleFeature
 from dipy.tracking.metrics import spline
-from dipy.tracking import utils as utils_trk
+from dipy.tracking.streamline import Streamlines
 from dipy.tracking.streamline import transform_streamlines
 from dipy.tracking.streamline import set_number_of_points
 from dipy.tracking.streamline import length as sl_length
 
 from tractseg.libs import utils
 from tractseg.libs import peak_utils
+from tractseg.libs import nifti_utils
+from tractseg.libs import cpu_budget
+from tractseg.libs import profiler
 
 # Global variables needed for shared memory of parallel fiber compression
 global _COMPRESSION_ERROR_THRESHOLD
@@ -25,6 +27,118 @@ global _FIBER_BATCHES
 _FIBER_BATCHES = None
 
 
+def to_array_sequence(streamlines, dtype=None):
+    """
+    Streamlines as ArraySequence (dipy Streamlines): the points of all streamlines are stored in one array and each
+    streamline is a view of it (offset and length). Operations on all points (e.g. affine, offset, flip) are then
+    a single operation on this array instead of a loop over the streamlines.
+
+    Args:
+        streamlines: list of 2D arrays [nr_points, 3] or ArraySequence (not copied if dtype does not change)
+        dtype: dtype of the points (default: keep)
+
+    Returns:
+        ArraySequence
+    """
+    if isinstance(streamlines, Streamlines):
+        if dtype is None or streamlines._data.dtype == dtype:
+            return streamlines
+        points, offsets, lengths = get_points(streamlines)
+        return _from_points(points.astype(dtype), lengths)
+    streamlines = [np.asarray(sl).reshape(-1, 3) for sl in streamlines]
+    if len(streamlines) == 0:
+        return Streamlines()
+    points = np.concatenate(streamlines)
+    if dtype is not None:
+        points = points.astype(dtype, copy=False)
+    return _from_points(points, np.array([len(sl) for sl in streamlines], dtype=np.intp))
+
+
+def _from_points(points, lengths):
+    """
+    ArraySequence from the points of all streamlines (one after the other) and the number of points of each
+    streamline (no copy).
+    """
+    streamlines = Streamlines()
+    streamlines._data = points
+    streamlines._lengths = np.asarray(lengths, dtype=np.intp)
+    streamlines._offsets = np.concatenate([[0], np.cumsum(streamlines._lengths)[:-1]]).astype(np.intp) \
+        if len(lengths) > 0 else np.zeros(0, dtype=np.intp)
+    return streamlines
+
+
+def get_points(streamlines):
+    """
+    Points of all streamlines in one array.
+
+    Args:
+        streamlines: list of 2D arrays or ArraySequence
+
+    Returns:
+        points [nr_points_all_streamlines, 3] (streamline after streamline; not a copy if the ArraySequence is
+        contiguous), offsets (index of first point of each streamline), lengths (number of points of each streamline)
+    """
+    streamlines = to_array_sequence(streamlines)
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.intp) if len(lengths) > 0 \
+        else np.zeros(0, dtype=np.intp)
+    old_offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    if np.array_equal(old_offsets, offsets) and len(streamlines._data) == lengths.sum():
+        return streamlines._data, offsets, lengths
+    # e.g. slice or subset of an ArraySequence: gather the points of the selected streamlines
+    idxs = np.repeat(old_offsets - offsets, lengths) + np.arange(lengths.sum())
+    return streamlines._data[idxs], offsets, lengths
+
+
+def _get_streamline_idxs(lengths):
+    """
+    Index of the streamline of each point (for the points returned by get_points()).
+    """
+    return np.repeat(np.arange(len(lengths)), lengths)
+
+
+def _get_segments(points, offsets, lengths):
+    """
+    Segments (two following points of one streamline) of all streamlines.
+
+    Returns:
+        index of the first point of each segment, vector from the first to the second point of each segment
+    """
+    is_start = np.ones(len(points), dtype=bool)
+    is_start[(offsets + lengths - 1)[lengths > 0]] = False  # last point of each streamline
+    starts = np.flatnonzero(is_start)
+    return starts, points[starts + 1] - points[starts]
+
+
+def subsegment(streamlines, max_segment_length):
+    """
+    Same as dipy.tracking.utils.subsegment, but for all streamlines at once: split each segment into the smallest
+    number of equally long segments which are not longer than max_segment_length (segments of length 0 are removed).
+
+    Returns:
+        ArraySequence (float64)
+    """
+    points, offsets, lengths = get_points(streamlines)
+    points = np.asarray(points, dtype=np.float64)
+    starts, vectors = _get_segments(points, offsets, lengths)
+    nr_segments = np.zeros(len(points), dtype=np.intp)
+    nr_segments[starts] = np.ceil(np.linalg.norm(vectors, axis=1) / max_segment_length)
+    steps = np.zeros_like(points)
+    steps[starts] = vectors / np.maximum(nr_segments[starts], 1)[:, None]
+
+    # Each point is followed by the new points of the segment starting at it; the first point of each streamline
+    # is kept as it is
+    is_first = np.zeros(len(points), dtype=np.intp)
+    is_first[offsets[lengths > 0]] = 1
+    nr_new_points = is_first + nr_segments
+    idxs = np.repeat(np.arange(len(points)), nr_new_points)
+    nr_steps = np.arange(len(idxs)) - np.repeat(np.cumsum(nr_new_points) - nr_new_points, nr_new_points) + 1 - \
+        is_first[idxs]
+    new_points = points[idxs] + steps[idxs] * nr_steps[:, None]
+    new_lengths = np.bincount(_get_streamline_idxs(lengths), weights=nr_new_points, minlength=len(lengths))
+    return _from_points(new_points, new_lengths.astype(np.intp))
+
+
 def compress_fibers_worker_shared_mem(idx):
     """
     Worker Functions for multithreaded compression.
@@ -33,17 +147,14 @@ def compress_fibers_worker_shared_mem(idx):
     not be pickled.
     """
     streamlines_chunk = _FIBER_BATCHES[idx]  # shared memory; by using indices each worker accesses only his part
-    result = compress_streamlines_dipy(streamlines_chunk, tol_error=_COMPRESSION_ERROR_THRESHOLD)
+    with profiler.span("compress_streamlines_chunk", streamlines=len(streamlines_chunk)):
+        result = compress_streamlines_dipy(streamlines_chunk, tol_error=_COMPRESSION_ERROR_THRESHOLD)
     # print('PID {}, DONE'.format(getpid()))
     return result
 
 
 def compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=-1):
-    import psutil
-    if nr_cpus == -1:
-        nr_processes = psutil.cpu_count()
-    else:
-        nr_processes = nr_cpus
+    nr_processes = cpu_budget.get_nr_cpus(nr_cpus)
     number_streamlines = len(streamlines)
 
     if nr_processes >= number_streamlines:
@@ -63,7 +174,7 @@ def compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=-1):
     _FIBER_BATCHES = fiber_batches
 
     # print("Main program using: {} GB".format(round(Utils.mem_usage(print_usage=False), 3)))
-    pool = multiprocessing.Pool(processes=nr_processes)
+    pool = multiprocessing.Pool(processes=nr_processes, initializer=cpu_budget.limit_threads, initargs=(1,))
 
     #Do not pass in data (doubles amount of memory needed), but only idx of shared memory
     #  (needs only as much memory as single thread version (only main thread needs memory, others almost 0).
@@ -80,7 +191,7 @@ def compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=-1):
 def save_streamlines_as_trk_legacy(out_file, streamlines, affine, shape):
     """
     This function saves tracts in Trackvis '.trk' format.
-    Uses the old nib.trackvis API (streamlines are saved in coordinate space. Affine is not applied.)
+    Same as the old nib.trackvis API (streamlines are saved in coordinate space. Affine is not applied.)
 
     Args:
         out_file: string with filepath of the output file
@@ -91,18 +202,8 @@ def save_streamlines_as_trk_legacy(out_file, streamlines, affine, shape):
     Returns:
         void
     """
-    affine = np.abs(affine)
-    #offset not needed (already part of streamline coordinates?)
-    affine[0, 3] = 0
-    affine[1, 3] = 0
-    affine[2, 3] = 0
-    # Make a trackvis header so we can save streamlines
-    trackvis_header = nib.trackvis.empty_header()
-    trackvis_header['voxel_order'] = 'RAS'
-    trackvis_header['dim'] = shape
-    nib.trackvis.aff_to_hdr(affine, trackvis_header, pos_vox=False, set_order=False)
-    streamlines_trk_format = [(sl, None, None) for sl in streamlines]
-    nib.trackvis.write(out_file, streamlines_trk_format, trackvis_header, points_space="rasmm")
+    from tractseg.libs import streamline_io
+    streamline_io.save(out_file, streamlines, affine, shape, legacy=True)
 
 
 def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=None, vox_order='RAS'):
@@ -116,11 +217,9 @@ def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=N
                                       [   0.  ,    0.  ,    1.25,  -72.  ],
                                       [   0.  ,    0.  ,    0.  ,    1.  ]],
                                      dtype=float32)
-    Uses the new nib.streamlines API (streamlines are saved in voxel space and affine is applied to transform them to
+    Same as the nib.streamlines API (streamlines are saved in voxel space and affine is applied to transform them to
     coordinate space).
 
-    todo: use dipy.io.streamline.save_tractogram to save streamlines
-
     Args:
         out_file: string with filepath of the output file
         streamlines: sequence of streamlines in RASmm coordinate
@@ -132,57 +231,35 @@ def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=N
     Returns:
         void
     """
-    if affine is None:
-        affine = np.array([[-1.25, 0., 0., 90.],
-                           [0., 1.25, 0., -126.],
-                           [0., 0., 1.25, -72.],
-                           [0., 0., 0., 1.]],
-                          dtype=np.float32)
-
-    if shape is None:
-        shape = np.array([145, 174, 145], dtype=np.int16)
-
-    if vox_sizes is None:
-        vox_sizes = np.array([abs(affine[0,0]), abs(affine[1,1]), abs(affine[2,2])], dtype=np.float32)
-
-    # Create a new header with the correct affine and nr of streamlines
-    hdr = {}
-    hdr['voxel_sizes'] = vox_sizes
-    hdr['voxel_order'] = vox_order
-    hdr['dimensions'] = shape
-    hdr['voxel_to_rasmm'] = affine
-    hdr['nb_streamlines'] = len(streamlines)
-
-    nib.streamlines.save(nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4)), out_file, header=hdr)
+    from tractseg.libs import streamline_io
+    streamline_io.save(out_file, streamlines, affine, shape, vox_sizes=vox_sizes, vox_order=vox_order)
 
 
 def convert_tck_to_trk(filename_in, filename_out, reference_affine, reference_shape,
                        compress_err_thr=0.1, smooth=None, nr_cpus=-1, tracking_format="trk_legacy"):
+    """
+    Convert tck to trk (optionally smoothing and compressing the streamlines). Large files are converted in chunks.
+    """
+    from tractseg.libs import streamline_io
+    with streamline_io.StreamlineWriter(filename_out, reference_affine, reference_shape,
+                                        legacy=tracking_format == "trk_legacy") as writer:
+        for streamlines in streamline_io.iter_chunks(filename_in):
+            if smooth is not None:
+                streamlines = smooth_streamlines(streamlines, smoothing_factor=smooth)
 
-    streamlines = nib.streamlines.load(filename_in).streamlines  # Load Fibers (Tck)
+            #Compressing also good to remove checkerboard artefacts from tracking on peaks
+            if compress_err_thr is not None:
+                streamlines = compress_streamlines(streamlines, compress_err_thr, nr_cpus=nr_cpus)
 
-    if smooth is not None:
-        streamlines_smooth = []
-        for sl in streamlines:
-            streamlines_smooth.append(spline(sl, s=smooth))
-        streamlines = streamlines_smooth
-
-    #Compressing also good to remove checkerboard artefacts from tracking on peaks
-    if compress_err_thr is not None:
-        streamlines = compress_streamlines(streamlines, compress_err_thr, nr_cpus=nr_cpus)
-
-    if tracking_format == "trk_legacy":
-        save_streamlines_as_trk_legacy(filename_out, streamlines, reference_affine, reference_shape)
-    else:
-        save_streamlines(filename_out, streamlines, reference_affine, reference_shape)
+            writer.write(streamlines)
 
 
 def create_empty_tractogram(filename_out, reference_file,
                             tracking_format="trk_legacy"):
 
-    ref_img = nib.load(reference_file)
+    ref_img = nifti_utils.load(reference_file)
     reference_affine = ref_img.affine
-    reference_shape = ref_img.get_fdata().shape[:3]
+    reference_shape = ref_img.shape[:3]
 
     streamlines = []
 
@@ -193,11 +270,16 @@ def create_empty_tractogram(filename_out, reference_file,
 
 
 def resample_fibers(streamlines, nb_points=12):
-    streamlines_new = []
-    for sl in streamlines:
-        feature = ResampleFeature(nb_points=nb_points)
-        streamlines_new.append(feature.extract(sl))
-    return streamlines_new
+    """
+    Resample each streamline to nb_points equidistant points (float32).
+
+    Returns:
+        ArraySequence
+    """
+    if len(streamlines) == 0:
+        return Streamlines()
+    # all streamlines at once in compiled code
+    return set_number_of_points(to_array_sequence(streamlines, dtype=np.float32), nb_points)
 
 
 def smooth_streamlines(streamlines, smoothing_factor=10):
@@ -209,12 +291,11 @@ def smooth_streamlines(streamlines, smoothing_factor=10):
         smoothing_factor: 10: slight smoothing,  100: very smooth from beginning to end
 
     Returns:
-        smoothed streamlines
+        smoothed streamlines (ArraySequence)
     """
-    streamlines_smooth = []
-    for sl in streamlines:
-        streamlines_smooth.append(spline(sl, s=smoothing_factor))
-    return streamlines_smooth
+    # Fitting a spline is different for each streamline: only the fitting runs per streamline, the result is
+    # collected in one array
+    return to_array_sequence([spline(sl, s=smoothing_factor) for sl in to_array_sequence(streamlines)])
 
 
 def get_streamline_statistics(streamlines, subsample=False, raw=False):
@@ -234,39 +315,36 @@ def get_streamline_statistics(streamlines, subsample=False, raw=False):
     else:
         STEP_SIZE = 1
 
-    lengths = []
-    spaces = []  # spaces between 2 points
-    for j in range(0, len(streamlines), STEP_SIZE):
-        sl = streamlines[j]
-        length = 0
-        for i in range(len(sl)):
-            if i < (len(sl)-1):
-                space = np.linalg.norm(sl[i+1] - sl[i])
-                spaces.append(space)
-                length += space
-        lengths.append(length)
+    streamlines = to_array_sequence(streamlines)[::STEP_SIZE]
+    points, offsets, nr_points = get_points(streamlines)
+    starts, vectors = _get_segments(points, offsets, nr_points)
+    spaces = np.linalg.norm(vectors, axis=1)  # spaces between 2 points
+    lengths = np.bincount(_get_streamline_idxs(nr_points)[starts], weights=spaces, minlength=len(nr_points))
 
     if raw:
-        return lengths, spaces
+        return list(lengths), list(spaces)
     else:
-        return np.array(lengths).mean(), np.array(spaces).mean(), np.array(spaces).max()
+        return lengths.mean(), spaces.mean(), spaces.max()
 
 
 def filter_streamlines_leaving_mask(streamlines, mask):
     """
     Remove all streamlines that exit the mask
+
+    Returns:
+        remaining streamlines subsegmented to a point distance of at most 0.1 (ArraySequence)
     """
     max_seq_len = 0.1
-    streamlines = list(utils_trk.subsegment(streamlines, max_seq_len))
+    streamlines = subsegment(streamlines, max_seq_len)
 
-    new_str_idxs = []
-    for i, streamline in enumerate(streamlines):
-        new_str_idxs.append(i)
-        for point in streamline:
-            if mask[int(point[0]), int(point[1]), int(point[2])] == 0:
-                new_str_idxs.pop()
-                break
-    return [streamlines[idx] for idx in new_str_idxs]
+    # mask value at the points of all streamlines at once
+    points, offsets, lengths = get_points(streamlines)
+    voxels = points.astype(np.intp)
+    inside = mask[voxels[:, 0], voxels[:, 1], voxels[:, 2]] != 0
+    keep = np.ones(len(lengths), dtype=bool)
+    not_empty = lengths > 0
+    keep[not_empty] = np.logical_and.reduceat(inside, offsets[not_empty])
+    return streamlines[keep]
 
 
 def get_best_original_peaks(peaks_pred, peaks_orig, peak_len_thr=0.1):
@@ -330,41 +408,29 @@ def get_weighted_mean_of_peaks(best_orig, tom, weight=0.5):
 def add_to_each_streamline(streamlines, scalar):
     """
     Add scalar value to each coordinate of each streamline
+
+    Returns:
+        ArraySequence
     """
-    sl_new = []
-    for sl in streamlines:
-        sl_new.append(np.array(sl) + scalar)
-    return sl_new
+    points, offsets, lengths = get_points(streamlines)
+    return _from_points(points + scalar, lengths)
 
 
 def add_to_each_streamline_axis(streamlines, scalar, axis="x"):
-    sl_new = []
-    for sl in streamlines:
-        s = np.array(sl)
-        if axis == "x":
-            s[:, 0] += scalar
-        elif axis == "y":
-            s[:, 1] += scalar
-        elif axis == "z":
-            s[:, 2] += scalar
-        sl_new.append(s)
-    return sl_new
+    points, offsets, lengths = get_points(streamlines)
+    points = np.array(points)
+    if axis in ["x", "y", "z"]:
+        points[:, "xyz".index(axis)] += scalar
+    return _from_points(points, lengths)
 
 
 def flip(streamlines, axis="x"):
-    new_sl = []
-    for sl in streamlines:
-        tmp = np.copy(sl)
-        if axis == "x":
-            tmp[:, 0] = tmp[:, 0] * -1
-        elif axis == "y":
-            tmp[:, 1] = tmp[:, 1] * -1
-        elif axis == "z":
-            tmp[:, 2] = tmp[:, 2] * -1
-        else:
-            raise ValueError("Unsupported axis")
-        new_sl.append(tmp)
-    return new_sl
+    if axis not in ["x", "y", "z"]:
+        raise ValueError("Unsupported axis")
+    points, offsets, lengths = get_points(streamlines)
+    points = np.array(points)
+    points[:, "xyz".index(axis)] *= -1
+    return _from_points(points, lengths)
 
 
 def transform_point(p, affine):
@@ -383,22 +449,19 @@ def transform_point(p, affine):
     return M.dot(p) + offset
 
 
-def invert_streamlines(streamlines, reference_img, affine, axis="x"):
+def get_invert_affine(img_shape, affine, axis="x"):
     """
-    Invert streamlines. If inverting image voxel order (img[::-1]) we can do this inversion to the streamlines and
-    the result properly fits to the inverted image.
+    Affine which inverts streamlines in coordinate space along axis (see invert_streamlines()).
 
     Args:
-        streamlines:
-        reference_img: 3d array
+        img_shape: shape of the reference image
         affine: 4x4 matrix
         axis: x | y | z
 
     Returns:
-        streamlines
+        4x4 matrix
     """
-
-    img_shape = np.array(reference_img.shape)
+    img_shape = np.array(img_shape)
     img_center_voxel_space = (img_shape - 1) / 2.
     img_center_mm_space = transform_point(img_center_voxel_space, affine)
 
@@ -423,15 +486,33 @@ def invert_streamlines(streamlines, reference_img, affine, axis="x"):
         affine_invert[2, 3] = img_center_mm_space[1] * 2
     else:
         raise ValueError("invalid axis")
+    return affine_invert
 
-    return list(transform_streamlines(streamlines, affine_invert))
+
+def invert_streamlines(streamlines, reference_img, affine, axis="x"):
+    """
+    Invert streamlines. If inverting image voxel order (img[::-1]) we can do this inversion to the streamlines and
+    the result properly fits to the inverted image.
+
+    Args:
+        streamlines:
+        reference_img: 3d array
+        affine: 4x4 matrix
+        axis: x | y | z
+
+    Returns:
+        streamlines
+    """
+    affine_invert = get_invert_affine(reference_img.shape, affine, axis=axis)
+    points, offsets, lengths = get_points(streamlines)
+    return _from_points(apply_affine(affine_invert, points), lengths)
 
 
 def resample_to_same_distance(streamlines, max_nr_points=10, ANTI_INTERPOL_MULT=1):
-    dist = sl_length(streamlines).max() / max_nr_points
+    lengths = sl_length(streamlines)
+    dist = lengths.max() / max_nr_points
     new_streamlines = []
-    for sl in streamlines:
-        l = sl_length(sl)
+    for sl, l in zip(streamlines, lengths):
         nr_segments = int(l / dist)
         sl_new = set_number_of_points(sl, nb_points=nr_segments * ANTI_INTERPOL_MULT)
         new_streamlines.append(sl_new)
@@ -447,11 +528,14 @@ def pad_sl_with_zeros(streamlines, target_len, pad_point):
 
 
 def get_idxs_of_closest_points(streamlines, target_point):
-    idxs = []
-    for sl in streamlines:
-        dists = []
-        for idx, p in enumerate(sl):
-            dist = abs(np.linalg.norm(p - target_point))
-            dists.append(dist)
-        idxs.append(np.array(dists).argmin())
-    return idxs
+    """
+    Index of the point of each streamline which is closest to target_point.
+    """
+    points, offsets, lengths = get_points(streamlines)
+    dists = np.linalg.norm(points - target_point, axis=1)
+    not_empty = lengths > 0
+    min_dists = np.repeat(np.minimum.reduceat(dists, offsets[not_empty]), lengths[not_empty])
+    # first point with the minimal distance (like argmin)
+    closest = np.flatnonzero(dists == min_dists)
+    sl_idxs, first = np.unique(_get_streamline_idxs(lengths)[closest], return_index=True)
+    return list(closest[first] - offsets[sl_idxs])
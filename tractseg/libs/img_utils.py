@@ -3,21 +3,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import sys
-import joblib
-from joblib import Parallel, delayed
 from os.path import join
-from pkg_resources import resource_filename
+from os.path import exists
 
-import psutil
 import numpy as np
 import nibabel as nib
 from scipy import ndimage
 from scipy.ndimage.morphology import binary_dilation
-from dipy.align.imaffine import AffineMap
 
 from tractseg.libs.system_config import SystemConfig as C
 from tractseg.libs import exp_utils
+from tractseg.libs import nifti_utils
+from tractseg.libs import cpu_budget
+from tractseg.libs import profiler
 from tractseg.data import dataset_specific_utils
 
 
@@ -224,11 +224,13 @@ def bundle_specific_postprocessing(data, bundles):
 
 
 def resize_first_three_dims(img, order=0, zoom=0.62, nr_cpus=-1):
+    from joblib import Parallel, delayed
 
+    @profiler.traced("resize_channel")
     def _process_gradient(grad_idx):
         return ndimage.zoom(img[:, :, :, grad_idx], zoom, order=order)
 
-    nr_cpus = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    nr_cpus = cpu_budget.get_nr_cpus(nr_cpus)
     img_sm = Parallel(n_jobs=nr_cpus)(delayed(_process_gradient)(grad_idx) for grad_idx in range(img.shape[3]))
     return np.array(img_sm).transpose(1, 2, 3, 0)  # grads channel was in front -> put to back
 
@@ -282,16 +284,19 @@ def create_multilabel_mask(classes, subject, labels_type=np.int16, dataset_folde
     return mask_ml.astype(labels_type)
 
 
-def save_multilabel_img_as_multiple_files(classes, img, affine, path, name="bundle_segmentations"):
-    bundles = dataset_specific_utils.get_bundle_names(classes)[1:]
+@profiler.traced()
+def save_multilabel_img_as_multiple_files(classes, img, affine, path, name="bundle_segmentations", bundles=None):
+    bundles = dataset_specific_utils.get_bundle_names_subset(classes, bundles)
     for idx, bundle in enumerate(bundles):
         img_seg = nib.Nifti1Image(img[:,:,:,idx], affine)
         exp_utils.make_dir(join(path, name))
         nib.save(img_seg, join(path, name, bundle + ".nii.gz"))
 
 
-def save_multilabel_img_as_multiple_files_peaks(flip_output_peaks, classes, img, affine, path, name="TOM"):
-    bundles = dataset_specific_utils.get_bundle_names(classes)[1:]
+@profiler.traced()
+def save_multilabel_img_as_multiple_files_peaks(flip_output_peaks, classes, img, affine, path, name="TOM",
+                                                bundles=None):
+    bundles = dataset_specific_utils.get_bundle_names_subset(classes, bundles)
     for idx, bundle in enumerate(bundles):
         data = img[:, :, :, (idx*3):(idx*3)+3]
 
@@ -306,14 +311,100 @@ def save_multilabel_img_as_multiple_files_peaks(flip_output_peaks, classes, img,
         nib.save(img_seg, join(path, name, filename))
 
 
-def save_multilabel_img_as_multiple_files_endings(classes, img, affine, path, name="endings_segmentations"):
-    bundles = dataset_specific_utils.get_bundle_names(classes)[1:]
+@profiler.traced()
+def save_multilabel_img_as_multiple_files_endings(classes, img, affine, path, name="endings_segmentations",
+                                                  bundles=None):
+    bundles = dataset_specific_utils.get_bundle_names_subset(classes, bundles)
     for idx, bundle in enumerate(bundles):
         img_seg = nib.Nifti1Image(img[:,:,:,idx], affine)
         exp_utils.make_dir(join(path, name))
         nib.save(img_seg, join(path, name, bundle + ".nii.gz"))
 
 
+def _get_bundle_list_path(path_4D):
+    return path_4D[:-len(".nii")] + "_bundles.txt"
+
+
+def create_4D_bundle_file(path, shape, dtype, affine, bundles):
+    """
+    Create uncompressed 4D image for all bundles (e.g. tractseg_output/bundle_segmentations.nii) which can be
+    filled group by group with save_bundles_to_4D_file. The names of the bundles are saved in
+    <name>_bundles.txt next to it.
+
+    Args:
+        path: path of image (.nii)
+        shape: (x, y, z, nr_bundles * nr_channels_per_bundle)
+        dtype: dtype of image
+        affine: affine of image
+        bundles: names of all bundles in the order they are saved in the image
+
+    Returns:
+        Void
+    """
+    nifti_utils.create_memmap(path, shape, dtype, affine)
+    with open(_get_bundle_list_path(path), "w") as f:
+        f.write("\n".join(bundles) + "\n")
+
+
+def get_bundles_of_4D_file(path):
+    with open(_get_bundle_list_path(path)) as f:
+        return f.read().split()
+
+
+def remove_4D_bundle_file(path):
+    os.remove(path)
+    if exists(_get_bundle_list_path(path)):
+        os.remove(_get_bundle_list_path(path))
+
+
+def save_bundles_to_4D_file(path, img, bundles):
+    """
+    Args:
+        path: image created by create_4D_bundle_file
+        img: (x, y, z, len(bundles) * nr_channels_per_bundle)
+        bundles: names of bundles in img
+
+    Returns:
+        Void
+    """
+    all_bundles = get_bundles_of_4D_file(path)
+    data = nifti_utils.get_memmap(path, mode="r+")
+    nr_channels = data.shape[3] // len(all_bundles)
+    for idx, bundle in enumerate(bundles):
+        start = all_bundles.index(bundle) * nr_channels
+        data[:, :, :, start:start + nr_channels] = img[:, :, :, idx * nr_channels:(idx + 1) * nr_channels]
+    data.flush()
+    del data
+
+
+def load_bundle_data(bundle_dir, bundle, dtype=np.float32, cache=False):
+    """
+    Load image of one bundle. If the uncompressed 4D image of all bundles exists (<bundle_dir>.nii, created
+    by TractSeg --uncompressed_4D_output) the bundle is read from this image (memory mapped, no decompression).
+    Otherwise <bundle_dir>/<bundle>.nii.gz is loaded.
+
+    Args:
+        bundle_dir: directory with one image per bundle (e.g. tractseg_output/TOM)
+        bundle: name of bundle (e.g. CST_right or CST_right_b for endings)
+        dtype: float dtype of returned data
+        cache: passed to nifti_utils.get_data if the image of the bundle is loaded (read-only array if True)
+
+    Returns:
+        3D or 4D image (x, y, z[, nr_channels])
+    """
+    path_4D = bundle_dir.rstrip("/") + ".nii"
+    if exists(path_4D) and exists(_get_bundle_list_path(path_4D)):
+        all_bundles = get_bundles_of_4D_file(path_4D)
+        if bundle in all_bundles:
+            data = nifti_utils.get_memmap(path_4D)
+            nr_channels = data.shape[3] // len(all_bundles)
+            start = all_bundles.index(bundle) * nr_channels
+            bundle_data = np.array(data[:, :, :, start:start + nr_channels], dtype=dtype)
+            del data
+            return bundle_data[:, :, :, 0] if nr_channels == 1 else bundle_data
+    return nifti_utils.get_data(join(bundle_dir, bundle + ".nii.gz"), dtype=dtype, cache=cache)
+
+
 def simple_brain_mask(data):
     """
     Simple brain mask (for peak image). Does not matter if has holes
@@ -408,8 +499,8 @@ def probs_to_binary_bundle_specific(seg, bundles):
 
 
 def dilate_binary_mask(file_in, file_out, dilation=2):
-    img = nib.load(file_in)
-    data = img.get_fdata()
+    img = nifti_utils.load(file_in)
+    data = nifti_utils.get_data(file_in)
 
     for i in range(dilation):
         data = binary_dilation(data)
@@ -504,6 +595,8 @@ def change_spacing_4D(img_in, new_spacing=1.25):
     """
     Note: Only works properly if affine is all 0 except for diagonal and offset (=no rotation and sheering)
     """
+    from dipy.align.imaffine import AffineMap
+
     data = img_in.get_fdata()
     old_shape = data.shape
     img_spacing = abs(img_in.affine[0, 0])
@@ -514,7 +607,7 @@ def change_spacing_4D(img_in, new_spacing=1.25):
     new_affine[1, 1] = new_spacing if img_in.affine[1, 1] > 0 else -new_spacing
     new_affine[2, 2] = new_spacing if img_in.affine[2, 2] > 0 else -new_spacing
 
-    new_shape = np.floor(np.array(img_in.get_fdata().shape) * (img_spacing / new_spacing))
+    new_shape = np.floor(np.array(img_in.shape) * (img_spacing / new_spacing))
     new_shape = new_shape[:3]  # drop last dim
 
     new_data = []
@@ -625,6 +718,8 @@ def flip_peaks_to_correct_orientation_if_needed(peaks_input, do_flip=False):
         X = [list(peaks_x.flatten()) + list(peaks_y.flatten()) + list(peaks_z.flatten())]
         X = np.nan_to_num(X)
 
+        import joblib
+        from pkg_resources import resource_filename
         random_forest_path = resource_filename('tractseg.resources', 'random_forest_peak_orientation_detection.pkl')
         clf = joblib.load(random_forest_path)
         predicted_label = clf.predict(X)[0]
@@ -652,8 +747,7 @@ def flip_peaks_to_correct_orientation_if_needed(peaks_input, do_flip=False):
 
 
 def get_image_spacing(img_path):
-    img = nib.load(img_path)
-    affine = img.affine
+    affine = nifti_utils.get_affine(img_path)
     return str(abs(round(affine[0, 0], 2)))
 
 
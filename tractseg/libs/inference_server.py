@@ -0,0 +1,383 @@
+"""
+Local inference server (`TractSeg --serve`). Keeps the models in memory and processes jobs from a queue, so
+starting python, importing pytorch and loading the weights is only done once instead of for every subject.
+
+Jobs are submitted as JSON over HTTP (only listening on localhost):
+
+    POST /jobs        {"input": "/abs/path/peaks.nii.gz", "output": "/abs/path/tractseg_output",
+                       "output_types": ["tract_segmentation", "endings_segmentation", "TOM"],
+                       "options": {"bundles": ["CST_right"], "single_orientation": false}}
+                      -> {"id": "1", "status": "queued", ...}
+    GET  /jobs/<id>   -> status ("queued"|"running"|"done"|"failed"), progress and timings of the job
+    GET  /jobs        -> all jobs
+
+Only peak images are supported as input (no preprocessing). The output is saved like by `TractSeg`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import importlib
+import time
+import threading
+import traceback
+from os.path import join
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from queue import Queue
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+except ImportError:  # Python 2
+    ThreadingHTTPServer = None
+
+from tractseg.libs import exp_utils
+from tractseg.libs import img_utils
+from tractseg.libs import nifti_utils
+from tractseg.libs import cpu_budget
+from tractseg.libs.system_config import get_config_name
+from tractseg.data import dataset_specific_utils
+
+
+DEFAULT_PORT = 8765
+
+OUTPUT_DIRS = OrderedDict([
+    ("tract_segmentation", "bundle_segmentations"),
+    ("endings_segmentation", "endings_segmentations"),
+    ("TOM", "TOM"),
+    ("dm_regression", "dm_regression"),
+])
+
+# Options of a job and their defaults (same meaning as the options of TractSeg)
+JOB_OPTIONS = {
+    "bundles": None,
+    "single_orientation": False,
+    "get_probabilities": False,
+    "postprocess": True,
+    "tract_definition": "TractQuerier+",
+}
+
+
+class Job(object):
+
+    def __init__(self, job_id, input_path, output_dir, output_types, options):
+        self.id = job_id
+        self.input_path = input_path
+        self.output_dir = output_dir
+        self.output_types = output_types
+        self.options = options
+        self.status = "queued"
+        self.progress = ""
+        self.error = None
+        self.timings = OrderedDict()
+        self.submit_time = time.time()
+
+    def to_dict(self):
+        return OrderedDict([("id", self.id), ("status", self.status), ("progress", self.progress),
+                            ("input", self.input_path), ("output", self.output_dir),
+                            ("output_types", self.output_types), ("options", self.options),
+                            ("timings", self.timings), ("error", self.error)])
+
+
+def create_job(job_id, request):
+    """
+    Validate job request (dict, see module docstring) and create job.
+    """
+    if not isinstance(request, dict) or "input" not in request:
+        raise ValueError("Job needs at least 'input'")
+    input_path = request["input"]
+    if not os.path.isabs(input_path):
+        raise ValueError("'input' has to be an absolute path")
+    if not os.path.exists(input_path):
+        raise ValueError("Input {} does not exist".format(input_path))
+    output_dir = request.get("output", join(os.path.dirname(input_path), "tractseg_output"))
+    if not os.path.isabs(output_dir):
+        raise ValueError("'output' has to be an absolute path")
+
+    output_types = request.get("output_types", ["tract_segmentation"])
+    for output_type in output_types:
+        if output_type not in OUTPUT_DIRS:
+            raise ValueError("Invalid output type: {}".format(output_type))
+    # Run in the order of OUTPUT_DIRS: TOM is masked with the output of tract_segmentation
+    output_types = [output_type for output_type in OUTPUT_DIRS if output_type in output_types]
+
+    options = dict(JOB_OPTIONS)
+    for key, value in request.get("options", {}).items():
+        if key not in JOB_OPTIONS:
+            raise ValueError("Invalid option: {}".format(key))
+        options[key] = value
+    if options["tract_definition"] not in ["TractQuerier+", "xtract"]:
+        raise ValueError("Invalid tract definition: {}".format(options["tract_definition"]))
+    if options["tract_definition"] == "xtract" and \
+            any(output_type not in ["tract_segmentation", "dm_regression"] for output_type in output_types):
+        raise ValueError("'xtract' only works for output type 'tract_segmentation' and 'dm_regression'")
+    if options["bundles"] is not None:
+        all_bundles = dataset_specific_utils.get_bundle_names(
+            "xtract" if options["tract_definition"] == "xtract" else "All")[1:]
+        for bundle in options["bundles"]:
+            if bundle not in all_bundles:
+                raise ValueError("Invalid bundle name: {}".format(bundle))
+    return Job(job_id, input_path, output_dir, output_types, options)
+
+
+def load_peaks(path):
+    """
+    Load peak image and flip axes to match MNI space (like TractSeg does).
+
+    Returns:
+        data (float32), affine, flip_axis
+    """
+    data_img = nifti_utils.load(path)
+    if len(data_img.shape) != 4 or data_img.shape[3] != 9:
+        raise ValueError("Input image must be a peak image (nifti 4D image with dimensions [x,y,z,9])")
+    data_affine = data_img.affine
+    data = data_img.get_fdata(dtype=np.float32)
+    del data_img
+    data, flip_axis = img_utils.flip_axis_to_match_MNI_space(data, data_affine)
+    return data, data_affine, flip_axis
+
+
+def get_config(output_type, tract_definition="TractQuerier+"):
+    config_file = get_config_name("peaks", output_type, tract_definition=tract_definition)
+    return getattr(importlib.import_module("tractseg.experiments.pretrained_models." + config_file), "Config")()
+
+
+def get_parts(output_type, bundles=None):
+    """
+    Parts run_tractseg has to be run for (only the TOM models containing the selected bundles).
+    """
+    if output_type != "TOM":
+        return ["All"]
+    return [part for part in ["Part1", "Part2", "Part3", "Part4"]
+            if len(dataset_specific_utils.get_bundle_names_subset("All_" + part, bundles)) > 0]
+
+
+def save_bundles(output_type, classes, seg, bundle_names, affine, output_dir, flip_axis, threshold=None):
+    """
+    Save group of bundles returned by run_tractseg (like TractSeg does).
+
+    Args:
+        classes: classes of the model (Config.CLASSES, for TOM of the part)
+        threshold: density maps are set to 0 below this threshold (Config.THRESHOLD)
+    """
+    for axis in flip_axis:
+        seg = img_utils.flip_axis(seg, axis)
+    name = OUTPUT_DIRS[output_type]
+    if output_type == "endings_segmentation":
+        img_utils.save_multilabel_img_as_multiple_files_endings(classes, seg, affine, output_dir, name=name,
+                                                                bundles=bundle_names)
+    elif output_type == "TOM":
+        img_utils.save_multilabel_img_as_multiple_files_peaks(False, classes, seg, affine, output_dir,
+                                                              name=name, bundles=bundle_names)
+    else:
+        if output_type == "dm_regression":
+            seg[seg < threshold] = 0
+        img_utils.save_multilabel_img_as_multiple_files(classes, seg, affine, output_dir, name=name,
+                                                        bundles=bundle_names)
+
+
+def run_model(data, output_type, output_dir, options, output_callback, nr_cpus=-1, verbose=False):
+    """
+    Run run_tractseg for all parts of output_type. output_callback is called with
+    (seg, bundle_names, classes, threshold) for each group of bundles.
+    """
+    from tractseg.python_api import run_tractseg
+
+    Config = get_config(output_type, options["tract_definition"])
+    for part in get_parts(output_type, options["bundles"]):
+        classes = "All_" + part if output_type == "TOM" else Config.CLASSES
+
+        def save(seg, bundle_names):
+            output_callback(seg, bundle_names, classes, Config.THRESHOLD)
+
+        run_tractseg(data, output_type,
+                     single_orientation=options["single_orientation"] or output_type == "TOM",
+                     get_probs=options["get_probabilities"], postprocess=options["postprocess"],
+                     peak_regression_part=part, nr_cpus=nr_cpus, verbose=verbose,
+                     tract_definition=options["tract_definition"],
+                     tract_segmentations_path=join(output_dir, "bundle_segmentations"),
+                     bundles=options["bundles"], cache_models=True, output_callback=save)
+
+
+def process_job(job, nr_cpus=-1, verbose=False):
+    """
+    Run all output types of a job and save the output. Updates status, progress and timings of the job.
+    """
+    start_time = time.time()
+    job.timings["queued"] = round(start_time - job.submit_time, 2)
+    job.status = "running"
+    job.progress = "loading input"
+
+    data, data_affine, flip_axis = load_peaks(job.input_path)
+    exp_utils.make_dir(job.output_dir)
+    job.timings["load_input"] = round(time.time() - start_time, 2)
+
+    for output_type in job.output_types:
+        output_type_start = time.time()
+        classes = "All" if output_type == "TOM" else get_config(output_type, job.options["tract_definition"]).CLASSES
+        nr_bundles = len(dataset_specific_utils.get_bundle_names_subset(classes, job.options["bundles"]))
+        nr_saved = [0]
+
+        def save(seg, bundle_names, classes, threshold):
+            save_bundles(output_type, classes, seg, bundle_names, data_affine, job.output_dir, flip_axis,
+                         threshold=threshold)
+            nr_saved[0] += len(bundle_names)
+            job.progress = "{}: {}/{} bundles saved".format(output_type, nr_saved[0], nr_bundles)
+
+        job.progress = "{}: running model".format(output_type)
+        run_model(data, output_type, job.output_dir, job.options, save, nr_cpus=nr_cpus, verbose=verbose)
+        job.timings[output_type] = round(time.time() - output_type_start, 2)
+
+    job.timings["total"] = round(time.time() - start_time, 2)
+    job.progress = ""
+    job.status = "done"
+
+
+class InferenceServer(object):
+    """
+    Queue of jobs which are processed by nr_workers threads. The models are shared by all threads.
+    """
+
+    def __init__(self, nr_workers=1, nr_cpus=-1, verbose=False):
+        self.nr_workers = nr_workers
+        # CPUs for pre- and postprocessing of each job (the forward passes share the threads of pytorch)
+        self.nr_cpus = cpu_budget.split_budget(nr_workers, nr_cpus)
+        cpu_budget.init_torch_threads(nr_cpus)
+        self.verbose = verbose
+        self.jobs = OrderedDict()
+        self.queue = Queue()
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._workers = []
+
+    def start(self):
+        for _ in range(self.nr_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, request):
+        with self._lock:
+            job = create_job(str(self._next_id), request)
+            self._next_id += 1
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                process_job(job, nr_cpus=self.nr_cpus, verbose=self.verbose)
+                print("Job {} done ({}s)".format(job.id, job.timings["total"]))
+            except Exception as e:
+                job.status = "failed"
+                job.error = "{}: {}".format(type(e).__name__, e)
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+
+def _get_handler_class(server):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, code, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            if path == "/jobs":
+                self._send_json(200, [job.to_dict() for job in list(server.jobs.values())])
+            elif path.startswith("/jobs/") and path[len("/jobs/"):] in server.jobs:
+                self._send_json(200, server.jobs[path[len("/jobs/"):]].to_dict())
+            else:
+                self._send_json(404, {"error": "Not found: {}".format(self.path)})
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                self._send_json(404, {"error": "Not found: {}".format(self.path)})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+                job = server.submit(request)
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            self._send_json(201, job.to_dict())
+
+        def log_message(self, format, *args):
+            if server.verbose:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    return Handler
+
+
+def serve(port=DEFAULT_PORT, nr_workers=1, nr_cpus=-1, verbose=False):
+    """
+    Start server and process jobs until interrupted (Ctrl+C).
+    """
+    server = InferenceServer(nr_workers=nr_workers, nr_cpus=nr_cpus, verbose=verbose)
+    server.start()
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), _get_handler_class(server))
+    print("TractSeg server listening on http://127.0.0.1:{} ({} worker(s))".format(port, nr_workers))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping server")
+    finally:
+        httpd.server_close()
+
+
+def _request(url, data=None):
+    if data is not None:
+        data = json.dumps(data).encode("utf-8")
+    request = Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        return json.loads(urlopen(request).read().decode("utf-8"))
+    except HTTPError as e:
+        raise ValueError("Server error: {}".format(json.loads(e.read().decode("utf-8"))["error"]))
+
+
+def submit_job(server_url, request):
+    """
+    Submit job to a running server.
+
+    Returns:
+        job (dict)
+    """
+    return _request(server_url.rstrip("/") + "/jobs", data=request)
+
+
+def get_job(server_url, job_id):
+    return _request(server_url.rstrip("/") + "/jobs/" + job_id)
+
+
+def wait_for_job(server_url, job_id, poll_interval=1.0, print_progress=True):
+    """
+    Wait until job is done or failed.
+
+    Returns:
+        job (dict)
+    """
+    last_progress = None
+    while True:
+        job = get_job(server_url, job_id)
+        if print_progress and job["progress"] and job["progress"] != last_progress:
+            print(job["progress"])
+            last_progress = job["progress"]
+        if job["status"] in ["done", "failed"]:
+            return job
+        time.sleep(poll_interval)
@@ -4,8 +4,6 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
-from sklearn.metrics import f1_score
-from sklearn.linear_model import LinearRegression
 
 from tractseg.data import dataset_specific_utils
 from tractseg.libs import peak_utils
@@ -164,6 +162,8 @@ def calculate_metrics_onlyLoss(metrics, loss, type="train"):
 
 
 def calculate_metrics_each_bundle(metrics, y, class_probs, bundles, f1=None, threshold=0.5):
+    from sklearn.metrics import f1_score
+
     if f1 is None:
         pred_class = (class_probs >= threshold).astype(np.int16)
         y = (y >= threshold).astype(np.int16)
@@ -181,6 +181,8 @@ def calc_peak_dice_onlySeg(classes, y_pred, y_true):
     """
     Create binary mask of peaks by simple thresholding. Then calculate Dice.
     """
+    from sklearn.metrics import f1_score
+
     score_per_bundle = {}
     bundles = dataset_specific_utils.get_bundle_names(classes)[1:]
     for idx, bundle in enumerate(bundles):
@@ -199,6 +201,8 @@ def calc_peak_dice_onlySeg(classes, y_pred, y_true):
 
 
 def calc_peak_dice(classes, y_pred, y_true, max_angle_error=[0.9]):
+    from sklearn.metrics import f1_score
+
     score_per_bundle = {}
     bundles = dataset_specific_utils.get_bundle_names(classes)[1:]
     for idx, bundle in enumerate(bundles):
@@ -369,6 +373,8 @@ def unconfound(y, confound, group_data=False):
     Returns:
         y_correct: [samples, targets]
     """
+    from sklearn.linear_model import LinearRegression
+
     # Demeaning beforehand or using intercept=True has similar effect
     #y = demean(y)
     #confound = demean(confound)
@@ -0,0 +1,134 @@
+"""
+Access to NIfTI images which only reads what is needed:
+
+- shape, affine, zooms and dtype are read from the header (for .nii.gz files only the beginning of the file has to
+  be decompressed)
+- voxel data is only decoded when needed and is cached per process (keyed by path and modification time). Images
+  which are needed several times (e.g. the peaks for tracking of each bundle) are only decoded once.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+
+
+_DATA_CACHE = OrderedDict()  # least recently used first
+_DATA_CACHE_LOCK = threading.Lock()
+_DATA_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+def load(path):
+    """
+    Load image without decoding the voxel data (only the header is read). The voxel data is decoded when calling
+    get_fdata() on the image. Use get_data() instead to make use of the cache.
+    """
+    return nib.load(path)
+
+
+def get_shape(path):
+    return load(path).shape
+
+
+def get_affine(path):
+    return load(path).affine
+
+
+def get_zooms(path):
+    return load(path).header.get_zooms()
+
+
+def get_dtype(path):
+    """
+    dtype the voxel data is stored with on disk.
+    """
+    return load(path).get_data_dtype()
+
+
+def _get_cache_key(path, dtype):
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size, np.dtype(dtype).str
+
+
+def get_data(path, dtype=np.float32, cache=True):
+    """
+    Voxel data of image (with scaling from the header applied, like nibabel get_fdata()).
+
+    Args:
+        path: path of image
+        dtype: float dtype of returned data
+        cache: If True, the data is cached for later calls and the returned array is read-only (make a copy if you
+            want to change it). If False, a new writable array is returned.
+
+    Returns:
+        numpy array
+    """
+    if not cache:
+        return load(path).get_fdata(dtype=dtype, caching="unchanged")
+
+    key = _get_cache_key(path, dtype)
+    with _DATA_CACHE_LOCK:
+        if key in _DATA_CACHE:
+            _DATA_CACHE.move_to_end(key)
+            return _DATA_CACHE[key]
+
+    data = load(path).get_fdata(dtype=dtype, caching="unchanged")
+    data.setflags(write=False)  # shared by all callers
+
+    with _DATA_CACHE_LOCK:
+        if data.nbytes <= _DATA_CACHE_MAX_BYTES:
+            _DATA_CACHE[key] = data
+            while sum(cached.nbytes for cached in _DATA_CACHE.values()) > _DATA_CACHE_MAX_BYTES:
+                _DATA_CACHE.popitem(last=False)
+    return data
+
+
+def set_cache_size(max_bytes):
+    """
+    Set maximum size of the cache for decoded images (default: 2GB). 0 disables caching.
+    """
+    global _DATA_CACHE_MAX_BYTES
+    with _DATA_CACHE_LOCK:
+        _DATA_CACHE_MAX_BYTES = max_bytes
+        while len(_DATA_CACHE) > 0 and sum(cached.nbytes for cached in _DATA_CACHE.values()) > max_bytes:
+            _DATA_CACHE.popitem(last=False)
+
+
+def clear_cache():
+    with _DATA_CACHE_LOCK:
+        _DATA_CACHE.clear()
+
+
+def create_memmap(path, shape, dtype, affine):
+    """
+    Create uncompressed NIfTI image (.nii) without writing the voxel data (reads as zeros until written).
+
+    Returns:
+        voxel data as writable memory map
+    """
+    img = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype), affine)
+    img.update_header()
+    header = img.header
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header["vox_offset"] = 352  # header + 4 bytes extension flag
+    with open(path, "wb") as f:
+        header.write_to(f)
+        f.truncate(352 + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return get_memmap(path, mode="r+")
+
+
+def get_memmap(path, mode="r"):
+    """
+    Voxel data of uncompressed NIfTI image (.nii) as memory map (data is only read from disk when accessed).
+    Scaling from the header is not applied.
+    """
+    img = load(path)
+    return np.memmap(path, dtype=img.get_data_dtype(), mode=mode, offset=img.dataobj.offset,
+                     shape=img.shape, order="F")
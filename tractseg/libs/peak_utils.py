@@ -7,13 +7,14 @@ from os.path import join
 from os.path import dirname
 from os.path import exists
 
-import psutil
 import numpy as np
 import nibabel as nib
-from joblib import Parallel, delayed
 from scipy.ndimage.morphology import binary_dilation
 
 from tractseg.libs import img_utils
+from tractseg.libs import nifti_utils
+from tractseg.libs import cpu_budget
+from tractseg.libs import profiler
 
 
 def angle_last_dim(a, b):
@@ -258,16 +259,20 @@ def mask_and_normalize_peaks(peaks, tract_seg_path, bundles, dilation, nr_cpus=-
     """
     runtime TOM: 2min 40s  (~8.5GB)
     """
+    from joblib import Parallel, delayed
+
+    @profiler.traced("mask_and_normalize_bundle")
     def _process_bundle(idx, bundle):
         bundle_peaks = np.copy(peaks[:, :, :, idx * 3:idx * 3 + 3])  # [x, y, z, 3]
-        img = nib.load(join(tract_seg_path, bundle + ".nii.gz"))
-        mask, flip_axis = img_utils.flip_axis_to_match_MNI_space(img.get_fdata(), img.affine)
+        mask_path = join(tract_seg_path, bundle + ".nii.gz")
+        mask, flip_axis = img_utils.flip_axis_to_match_MNI_space(nifti_utils.get_data(mask_path, cache=False),
+                                                                 nifti_utils.get_affine(mask_path))
         mask = binary_dilation(mask, iterations=dilation).astype(np.uint8)  # [x, y, z]
         bundle_peaks[mask == 0] = 0
         bundle_peaks = normalize_peak_to_unit_length(bundle_peaks)
         return bundle_peaks
 
-    nr_cpus = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    nr_cpus = cpu_budget.get_nr_cpus(nr_cpus)
     results_peaks = Parallel(n_jobs=nr_cpus)(delayed(_process_bundle)(idx, bundle)
                                              for idx, bundle in enumerate(bundles))
 
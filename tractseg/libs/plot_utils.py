@@ -7,8 +7,6 @@ from os.path import join
 import math
 
 import numpy as np
-import nibabel as nib
-from nibabel import trackvis
 from dipy.tracking.streamline import transform_streamlines
 from scipy.ndimage.morphology import binary_dilation
 from dipy.tracking.streamline import set_number_of_points
@@ -20,7 +18,10 @@ from scipy.spatial import cKDTree
 
 from tractseg.data import dataset_specific_utils
 from tractseg.libs import fiber_utils
+from tractseg.libs import nifti_utils
 from tractseg.libs import img_utils
+from tractseg.libs import streamline_io
+from tractseg.libs import tractogram_archive
 
 import matplotlib
 matplotlib.use('Agg')  # Solves error with ssh and plotting
@@ -124,7 +125,7 @@ def plot_tracts(classes, bundle_segmentations, affine, out_dir, brain_mask=None)
 
 
 def plot_tracts_matplotlib(classes, bundle_segmentations, background_img, out_dir,
-                           threshold=0.001, exp_type="tract_segmentation"):
+                           threshold=0.001, exp_type="tract_segmentation", bundles=None):
 
     def plot_single_tract(bg, data, orientation, bundle, exp_type):
         if orientation == "coronal":
@@ -159,6 +160,8 @@ def plot_tracts_matplotlib(classes, bundle_segmentations, background_img, out_di
         plt.imshow(data, cmap="autumn")  # even with cmap=autumn peaks still RGB
         plt.title(bundle, fontsize=7)
 
+    bundle_names = dataset_specific_utils.get_bundle_names_subset(classes, bundles)
+
     if classes.startswith("xtract"):
         bundles = ["cst_r", "cst_s_r", "ifo_r", "fx_l", "fx_r", "or_l", "fma"]
     else:
@@ -172,6 +175,12 @@ def plot_tracts_matplotlib(classes, bundle_segmentations, background_img, out_di
         bundle_segmentations = bundle_segmentations.reshape([s[0], s[1], s[2], int(s[3]/3), 3])
         bundles = ["CST_right", "CST_s_right", "CA", "CC_1", "AF_left"]  # can only use bundles from part1
 
+    # Only show bundles which are contained in the segmentation (in case only a subset of bundles was segmented)
+    bundles = [bundle for bundle in bundles if bundle.replace("_s", "") in bundle_names]
+    if len(bundles) == 0:
+        print("WARNING: None of the preview bundles was selected. Skipping preview.")
+        return
+
     aggregation = "max"
     cols = 4
     rows = math.ceil(len(bundles) / cols)
@@ -192,7 +201,7 @@ def plot_tracts_matplotlib(classes, bundle_segmentations, background_img, out_di
         else:
             raise ValueError("invalid bundle")
 
-        bundle_idx = dataset_specific_utils.get_bundle_names(classes)[1:].index(bundle)
+        bundle_idx = bundle_names.index(bundle)
         mask_data = bundle_segmentations[:, :, :, bundle_idx]
         mask_data = np.copy(mask_data)  # copy data otherwise will also threshold data outside of plot function
         # mask_data[mask_data < threshold] = 0
@@ -374,21 +383,17 @@ def plot_bundles_with_metric(bundle_path, endings_path, brain_mask_path, bundle,
     orientation = dataset_specific_utils.get_optimal_orientation_for_bundle(bundle)
 
     # Load mask
-    beginnings_img = nib.load(endings_path)
-    beginnings = beginnings_img.get_fdata().astype(np.uint8)
+    beginnings_img = nifti_utils.load(endings_path)
+    beginnings = nifti_utils.get_data(endings_path).astype(np.uint8)
     for i in range(1):
         beginnings = binary_dilation(beginnings)
 
-    # Load trackings
-    if tracking_format == "trk_legacy":
-        streams, hdr = trackvis.read(bundle_path)
-        streamlines = [s[0] for s in streams]
+    # Load trackings (reduce streamline count: only every second streamline)
+    if tracking_format == "archive":
+        streamlines = tractogram_archive.load_bundle(bundle_path, bundle, idxs=slice(None, None, 2))
     else:
-        sl_file = nib.streamlines.load(bundle_path)
-        streamlines = sl_file.streamlines
-
-    # Reduce streamline count
-    streamlines = streamlines[::2]
+        streamlines = streamline_io.load(bundle_path, idxs=slice(None, None, 2),
+                                         legacy=tracking_format == "trk_legacy")
 
     # Reorder to make all streamlines have same start region
     streamlines = fiber_utils.add_to_each_streamline(streamlines, 0.5)
@@ -469,7 +474,7 @@ def plot_bundles_with_metric(bundle_path, endings_path, brain_mask_path, bundle,
     renderer.add(sl_actor)
 
     # plot brain mask
-    mask = nib.load(brain_mask_path).get_fdata().astype(np.uint8)
+    mask = nifti_utils.get_data(brain_mask_path).astype(np.uint8)
     cont_actor = vtk_utils.contour_from_roi_smooth(mask, affine=beginnings_img.affine, color=[.9, .9, .9], opacity=.2,
                                                    smoothing=50)
     renderer.add(cont_actor)
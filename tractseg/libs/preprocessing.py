@@ -5,10 +5,10 @@ from __future__ import print_function
 
 import os
 from os.path import join
-from pkg_resources import resource_filename
 from tqdm import tqdm
 
 from tractseg.libs import img_utils
+from tractseg.libs import cpu_budget
 
 
 def reorient_to_std_space(input_file, bvals, bvecs, brain_mask, output_dir):
@@ -46,6 +46,7 @@ def move_to_MNI_space(input_file, bvals, bvecs, brain_mask, output_dir):
 
     dwi_spacing = img_utils.get_image_spacing(input_file)
 
+    from pkg_resources import resource_filename
     template_path = resource_filename('tractseg.resources', 'MNI_FA_template.nii.gz')
 
     os.system("flirt -ref " + template_path + " -in " + output_dir + "/FA.nii.gz -out " + output_dir +
@@ -126,10 +127,7 @@ def create_brain_mask(input_file, output_dir):
 
 def create_fods(input_file, output_dir, bvals, bvecs, brain_mask, csd_type, nr_cpus=-1):
 
-    if nr_cpus > 0:
-        nthreads = " -nthreads " + str(nr_cpus)
-    else:
-        nthreads = ""
+    nthreads = cpu_budget.mrtrix_nthreads(nr_cpus)
 
     if csd_type == "csd_msmt_5tt":
         # MSMT 5TT
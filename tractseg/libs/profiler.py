@@ -0,0 +1,216 @@
+"""
+Lightweight tracing of the stages of TractSeg (`--profile`).
+
+Stages are recorded as spans (name, start, duration, process, thread) with the context manager span() or the
+decorator traced(). start() enables profiling by setting the environment variable TRACTSEG_PROFILE_DIR: worker
+processes (multiprocessing, joblib) inherit it and write their spans to the same directory (one file per process,
+each span is written when it ends, so spans of workers which are terminated are not lost). stop() merges the spans
+of all processes into a Chrome trace file (open in https://ui.perfetto.dev or chrome://tracing) and prints a
+summary table.
+
+If profiling is not enabled, span() only checks the environment variable (negligible overhead).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import tempfile
+import functools
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+
+ENV_VAR = "TRACTSEG_PROFILE_DIR"
+
+_lock = threading.Lock()
+_file = None  # trace file of this process
+_named_threads = set()
+_start_time = None
+
+
+def _reset_after_fork():
+    global _lock, _file
+    _lock = threading.Lock()  # might have been held by another thread during the fork
+    _file = None
+    _named_threads.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def is_enabled():
+    return ENV_VAR in os.environ
+
+
+def _now():
+    return time.time() * 1e6  # microseconds; wall clock, so spans of different processes can be compared
+
+
+def _get_thread_id():
+    if hasattr(threading, "get_native_id"):
+        return threading.get_native_id()
+    return threading.current_thread().ident
+
+
+def _get_process_name():
+    name = multiprocessing.current_process().name
+    if name == "MainProcess":
+        return os.path.basename(sys.argv[0]) or name
+    return name
+
+
+def _write(event):
+    global _file
+    pid = os.getpid()
+    tid = _get_thread_id()
+    event.update({"pid": pid, "tid": tid})
+    with _lock:
+        lines = []
+        if _file is None:
+            trace_dir = os.environ.get(ENV_VAR)
+            if trace_dir is None:
+                return  # profiling stopped while the span was running
+            _file = open(os.path.join(trace_dir, "{}.jsonl".format(pid)), "a")
+            lines.append({"name": "process_name", "ph": "M", "pid": pid, "tid": tid,
+                          "args": {"name": _get_process_name()}})
+        if tid not in _named_threads:
+            _named_threads.add(tid)
+            lines.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                          "args": {"name": threading.current_thread().name}})
+        lines.append(event)
+        _file.write("".join(json.dumps(line) + "\n" for line in lines))
+        _file.flush()
+
+
+@contextmanager
+def span(name, **args):
+    """
+    Record the time of a stage, e.g.
+
+    with profiler.span("postprocessing", bundles=len(bundles)):
+        ...
+
+    Args:
+        name: name of the stage
+        args: shown in the trace viewer when selecting the span
+    """
+    if ENV_VAR not in os.environ:
+        yield
+        return
+    start_time = _now()
+    try:
+        yield
+    finally:
+        _write({"name": name, "ph": "X", "ts": start_time, "dur": _now() - start_time, "args": args})
+
+
+def traced(name=None):
+    """
+    Decorator to record each call of a function as span (default name: name of the function).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start():
+    """
+    Enable profiling for this process and all processes started from now on.
+    """
+    global _start_time
+    os.environ[ENV_VAR] = tempfile.mkdtemp(prefix="tractseg_profile_")
+    _start_time = _now()
+
+
+def _read_events(trace_dir):
+    events = []
+    for path in glob.glob(os.path.join(trace_dir, "*.jsonl")):
+        with open(path) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass  # incomplete last line of a worker which was killed while writing
+    return events
+
+
+def get_summary(events):
+    """
+    Total, mean and maximum duration of each stage over all processes and threads. Nested stages are included in
+    the time of their parent stage.
+
+    Returns:
+        list of dicts (sorted by total time)
+    """
+    stages = {}
+    for event in events:
+        if event["ph"] != "X":
+            continue
+        stage = stages.setdefault(event["name"], {"name": event["name"], "calls": 0, "total": 0., "max": 0.,
+                                                  "threads": set()})
+        stage["calls"] += 1
+        stage["total"] += event["dur"] / 1e6
+        stage["max"] = max(stage["max"], event["dur"] / 1e6)
+        stage["threads"].add((event["pid"], event["tid"]))
+    summary = []
+    for stage in sorted(stages.values(), key=lambda s: -s["total"]):
+        summary.append({"name": stage["name"], "calls": stage["calls"], "total": round(stage["total"], 3),
+                        "mean": round(stage["total"] / stage["calls"], 3), "max": round(stage["max"], 3),
+                        "threads": len(stage["threads"])})
+    return summary
+
+
+def print_summary(summary, wall_time):
+    print("Profile (wall time: {:.2f}s, times in seconds summed over all processes and threads):".format(
+        wall_time))
+    print("{:<40}{:>8}{:>10}{:>10}{:>10}{:>8}{:>9}".format("stage", "calls", "total", "mean", "max", "% wall",
+                                                          "threads"))
+    for stage in summary:
+        print("{:<40}{:>8}{:>10.2f}{:>10.3f}{:>10.3f}{:>8.1f}{:>9}".format(
+            stage["name"][:39], stage["calls"], stage["total"], stage["mean"], stage["max"],
+            100 * stage["total"] / max(wall_time, 1e-6), stage["threads"]))
+
+
+def stop(output_path, verbose=True):
+    """
+    Disable profiling and save the spans of all processes as Chrome trace (JSON). The summary is included in the
+    file ("otherData") and printed.
+    """
+    global _file
+    if not is_enabled():
+        return
+    trace_dir = os.environ.pop(ENV_VAR)
+    end_time = _now()
+    with _lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+        _named_threads.clear()
+
+    events = _read_events(trace_dir)
+    shutil.rmtree(trace_dir, ignore_errors=True)
+    if _start_time is not None:
+        events.append({"name": _get_process_name(), "ph": "X", "ts": _start_time, "dur": end_time - _start_time,
+                       "pid": os.getpid(), "tid": _get_thread_id(), "args": {}})
+    wall_time = (end_time - _start_time) / 1e6 if _start_time is not None else 0.
+    summary = get_summary(events)
+    with open(output_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                   "otherData": {"command": " ".join(sys.argv), "wall_time": round(wall_time, 3),
+                                 "summary": summary}}, f)
+    if verbose:
+        print_summary(summary, wall_time)
+        print("Profile saved to {}".format(output_path))
@@ -3,6 +3,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import json
+import struct
+import inspect
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -16,12 +22,145 @@ def save_checkpoint(path, **kwargs):
     torch.save(kwargs, path)
 
 
-def load_checkpoint(path, **kwargs):
+# dtype names of the safetensors format
+_FLAT_DTYPES = OrderedDict([("F64", np.float64), ("I64", np.int64), ("F32", np.float32), ("I32", np.int32),
+                            ("F16", np.float16), ("I16", np.int16), ("U8", np.uint8), ("I8", np.int8),
+                            ("BOOL", np.bool_)])
+
+
+# Using tensors of a state dict directly as parameters needs pytorch >= 2.1
+_ASSIGN_SUPPORTED = "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def get_flat_checkpoint_path(path):
+    return os.path.splitext(path)[0] + ".safetensors"
+
+
+def _get_up_to_date_flat_checkpoint_path(path):
+    """
+    Path of the flat version of the checkpoint or None if it does not exist or is older than the checkpoint.
+    """
+    if path.endswith(".safetensors"):
+        return path
+    flat_path = get_flat_checkpoint_path(path)
+    if os.path.exists(flat_path) and \
+            (not os.path.exists(path) or os.path.getmtime(flat_path) >= os.path.getmtime(path)):
+        return flat_path
+    return None
+
+
+def can_assign_checkpoint(path):
+    """
+    True if load_checkpoint(path, assign=True) uses the memory mapped tensors directly as parameters.
+    """
+    return _ASSIGN_SUPPORTED and _get_up_to_date_flat_checkpoint_path(path) is not None
+
+
+def save_flat_checkpoint(path, **kwargs):
+    """
+    Save state dicts of networks in a flat format which can be memory mapped (same layout as safetensors):
+    8 bytes header size, json header (name, dtype, shape and position of each tensor), raw data of all tensors.
+    The file is written to a temporary file first, so other processes never see an incomplete file.
+
+    Args:
+        path: output path
+        kwargs: e.g. {"unet": a_pytorch_network} (or state dict)
+    """
+    flat_dtypes = {np.dtype(dtype): name for name, dtype in _FLAT_DTYPES.items()}
+    arrays = []
+    for key, value in kwargs.items():
+        if isinstance(value, torch.nn.Module):
+            value = value.state_dict()
+        for name, tensor in value.items():
+            arrays.append((key + "." + name, np.ascontiguousarray(tensor.detach().cpu().numpy())))
+    # Largest dtypes first: keeps all tensors aligned without padding
+    arrays.sort(key=lambda item: -item[1].dtype.itemsize)
+
+    header = OrderedDict()
+    offset = 0
+    for name, array in arrays:
+        header[name] = {"dtype": flat_dtypes[array.dtype], "shape": list(array.shape),
+                        "data_offsets": [offset, offset + array.nbytes]}
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    tmp_path = path + ".tmp{}".format(os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays:
+            f.write(array.tobytes())
+    os.rename(tmp_path, path)
+
+
+def load_flat_checkpoint(path):
+    """
+    Load file saved by save_flat_checkpoint (or any safetensors file) memory mapped. The tensors are not copied,
+    so all processes loading the same file share the memory of the weights (copy-on-write).
+
+    Returns:
+        dict: key -> state dict (e.g. {"unet": state_dict})
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size).decode("utf-8"), object_pairs_hook=OrderedDict)
+    header.pop("__metadata__", None)
+
+    checkpoint = {}
+    if len(header) == 0:
+        return checkpoint
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=8 + header_size)
+    for name, info in header.items():
+        key, param_name = name.split(".", 1)
+        start, end = info["data_offsets"]
+        array = data[start:end].view(_FLAT_DTYPES[info["dtype"]]).reshape(info["shape"])
+        checkpoint.setdefault(key, OrderedDict())[param_name] = torch.from_numpy(array)
+    return checkpoint
+
+
+def convert_checkpoint(path):
+    """
+    Convert checkpoint saved by save_checkpoint to the flat format (get_flat_checkpoint_path(path)). Only state
+    dicts of networks are converted.
+
+    Returns:
+        path of converted checkpoint
+    """
     checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    state_dicts = {key: value for key, value in checkpoint.items()
+                   if isinstance(value, dict) and all(torch.is_tensor(v) for v in value.values())}
+    flat_path = get_flat_checkpoint_path(path)
+    save_flat_checkpoint(flat_path, **state_dicts)
+    return flat_path
+
+
+def _read_checkpoint(path):
+    """
+    Read checkpoint. Uses the flat version of the checkpoint (memory mapped) if it exists and is up to date.
+    """
+    flat_path = _get_up_to_date_flat_checkpoint_path(path)
+    if flat_path is not None:
+        return load_flat_checkpoint(flat_path), True
+    return torch.load(path, map_location=lambda storage, loc: storage), False
+
+
+def load_checkpoint(path, assign=False, **kwargs):
+    """
+    Args:
+        path: path of checkpoint
+        assign: If True and the checkpoint is in the flat format the networks use the memory mapped tensors
+            directly instead of copying them (see can_assign_checkpoint). Only use this for inference: the
+            parameters are replaced by new tensors (optimizers created before still use the old ones).
+        kwargs: e.g. {"unet": a_pytorch_network}
+    """
+    checkpoint, is_flat = _read_checkpoint(path)
 
     for key, value in list(kwargs.items()):
         if key in checkpoint:
-            if isinstance(value, torch.nn.Module) or isinstance(value, torch.optim.Optimizer):
+            if isinstance(value, torch.nn.Module) and assign and is_flat and _ASSIGN_SUPPORTED:
+                value.load_state_dict(checkpoint[key], assign=True)
+            elif isinstance(value, torch.nn.Module) or isinstance(value, torch.optim.Optimizer):
                 value.load_state_dict(checkpoint[key])
             else:
                 kwargs[key] = checkpoint[key]
@@ -30,7 +169,7 @@ def load_checkpoint(path, **kwargs):
 
 
 def load_checkpoint_selectively(path, **kwargs):
-    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    checkpoint, _ = _read_checkpoint(path)
 
     # kwargs e.g. {"unet": a_pytorch_network}
     for key, value in list(kwargs.items()):
@@ -0,0 +1,341 @@
+"""
+Reading and writing of streamlines in TrackVis (.trk) and MRtrix (.tck) format.
+
+The points of all streamlines are read and written as whole blocks (numpy views of the file, memory mapped when
+reading) instead of one streamline at a time. Only the streamlines which are needed are read (idxs, iter_chunks)
+and large tractograms can be written in chunks (StreamlineWriter).
+
+Streamlines are returned as ArraySequence in coordinate space (RAS+ mm). The files are the same as written by
+nibabel.streamlines. "legacy" trk files are the same as written by the old nibabel.trackvis API (points are stored
+in coordinate space, the affine is not applied).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import numpy.linalg as npl
+from nibabel.affines import apply_affine
+from nibabel.streamlines.trk import header_2_dtype
+from nibabel.streamlines.trk import get_affine_rasmm_to_trackvis
+from nibabel.streamlines.trk import get_affine_trackvis_to_rasmm
+
+from tractseg.libs import fiber_utils
+
+
+TRK_HEADER_SIZE = 1000
+TCK_MAGIC_NUMBER = "mrtrix tracks"
+TCK_DTYPES = {"Float32LE": "<f4", "Float32BE": ">f4", "Float64LE": "<f8", "Float64BE": ">f8"}
+
+# HCP (1.25mm) is used if no affine and shape are given
+DEFAULT_AFFINE = np.array([[-1.25, 0., 0., 90.],
+                           [0., 1.25, 0., -126.],
+                           [0., 0., 1.25, -72.],
+                           [0., 0., 0., 1.]], dtype=np.float32)
+DEFAULT_SHAPE = (145, 174, 145)
+
+
+def _get_format(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in [".trk", ".tck"]:
+        raise ValueError("Unsupported streamline format: {} (supported: .trk, .tck)".format(filename))
+    return ext[1:]
+
+
+def _read_trk_header(filename):
+    with open(filename, "rb") as f:
+        header_bytes = f.read(TRK_HEADER_SIZE)
+    for dtype in [header_2_dtype, header_2_dtype.newbyteorder()]:  # little or big endian
+        header = np.frombuffer(header_bytes, dtype=dtype)[0]
+        if header["hdr_size"] == TRK_HEADER_SIZE:
+            return header
+    raise ValueError("Not a valid trk file: {}".format(filename))
+
+
+def _read_tck_header(filename):
+    header = {}
+    with open(filename, "rb") as f:
+        if f.readline().decode("latin1").strip() != TCK_MAGIC_NUMBER:
+            raise ValueError("Not a valid tck file: {}".format(filename))
+        for line in f:
+            line = line.decode("latin1").strip()
+            if line == "END":
+                break
+            key, value = line.split(":", 1)
+            header[key.strip()] = value.strip()
+    if not header.get("file", "").startswith(". "):
+        raise ValueError("Only tck files with the data in the same file are supported: {}".format(filename))
+    return header
+
+
+def _trk_index(words, nr_streamlines, nr_scalars, nr_properties):
+    """
+    Position (in words of 4 bytes) of the first point and number of points of each streamline in the data block
+    of a trk file.
+
+    The number of points is stored before the points of each streamline, so the streamlines have to be walked
+    through (only the counts are read, not the points).
+    """
+    words = np.asarray(words)
+    words_per_point = 3 + nr_scalars
+    starts = []
+    lengths = []
+    pos = 0
+    while pos < len(words) and (nr_streamlines <= 0 or len(lengths) < nr_streamlines):
+        nr_points = int(words[pos])
+        starts.append(pos + 1)
+        lengths.append(nr_points)
+        pos += 1 + nr_points * words_per_point + nr_properties
+    return np.array(starts, dtype=np.intp), np.array(lengths, dtype=np.intp)
+
+
+def _tck_index(rows):
+    """
+    Index of the first point and number of points of each streamline in the data block of a tck file
+    (streamlines are separated by a row of NaN and the data ends with a row of inf).
+    """
+    first_column = np.asarray(rows[:, 0])
+    end = np.flatnonzero(np.isinf(first_column))
+    end = end[0] if len(end) > 0 else len(rows)
+    delimiters = np.flatnonzero(np.isnan(first_column[:end]))
+    if end > 0 and (len(delimiters) == 0 or delimiters[-1] != end - 1):
+        delimiters = np.append(delimiters, end)  # last streamline not terminated by NaN
+    starts = np.concatenate([[0], delimiters[:-1] + 1]).astype(np.intp) if len(delimiters) > 0 \
+        else np.zeros(0, dtype=np.intp)
+    return starts, (delimiters - starts).astype(np.intp)
+
+
+class _StreamlineFile(object):
+    """
+    Memory mapped streamline file: index of the streamlines and view of the points (nothing is read yet).
+    """
+
+    def __init__(self, filename, legacy=False):
+        if _get_format(filename) == "trk":
+            header = _read_trk_header(filename)
+            byteorder = header.dtype["hdr_size"].byteorder
+            words = np.memmap(filename, dtype=np.dtype("i4").newbyteorder(byteorder), mode="r",
+                              offset=TRK_HEADER_SIZE)
+            nr_scalars = int(header["nb_scalars_per_point"])
+            self.starts, self.lengths = _trk_index(words, int(header["nb_streamlines"]), nr_scalars,
+                                                   int(header["nb_properties_per_streamline"]))
+            # rows [x, y, z] starting at each word of the file; each point starts 3 + nr_scalars rows after the
+            # previous one
+            floats = words.view(np.dtype("f4").newbyteorder(byteorder))
+            self.rows = np.lib.stride_tricks.as_strided(floats, shape=(max(len(floats) - 2, 0), 3),
+                                                        strides=(floats.strides[0],) * 2, writeable=False)
+            self.row_step = 3 + nr_scalars
+            self.affine = None if legacy else get_affine_trackvis_to_rasmm(header)
+        else:
+            header = _read_tck_header(filename)
+            data = np.memmap(filename, dtype=TCK_DTYPES[header.get("datatype", "Float32LE")], mode="r",
+                             offset=int(header["file"].split()[1]))
+            self.rows = data[:len(data) // 3 * 3].reshape(-1, 3)
+            self.starts, self.lengths = _tck_index(self.rows)
+            self.row_step = 1
+            self.affine = None  # always coordinate space
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def get(self, idxs=None):
+        """
+        Read the streamlines idxs.
+
+        Returns:
+            ArraySequence (float32, coordinate space)
+        """
+        starts = self.starts if idxs is None else self.starts[idxs]
+        lengths = self.lengths if idxs is None else self.lengths[idxs]
+        point_streamline_idxs = fiber_utils._get_streamline_idxs(lengths)
+        first_point = np.cumsum(lengths) - lengths
+        rows = starts[point_streamline_idxs] + \
+            (np.arange(len(point_streamline_idxs)) - first_point[point_streamline_idxs]) * self.row_step
+        points = np.asarray(self.rows[rows], dtype=np.float32).reshape(-1, 3)
+        if self.affine is not None:
+            points = apply_affine(self.affine, points).astype(np.float32)
+        return fiber_utils._from_points(points, lengths)
+
+
+def load(filename, idxs=None, legacy=False):
+    """
+    Load streamlines from trk or tck file.
+
+    Args:
+        filename: path of .trk or .tck file
+        idxs: only load these streamlines (anything which can index a numpy array, e.g. slice(None, None, 2) or
+            array of indices)
+        legacy: trk file written with the old nibabel.trackvis API (e.g. by TractSeg with output format
+            "trk_legacy"): points are returned as stored in the file (like nibabel.trackvis.read)
+
+    Returns:
+        ArraySequence (float32, coordinate space)
+    """
+    return _StreamlineFile(filename, legacy=legacy).get(idxs)
+
+
+def iter_chunks(filename, chunk_size=100000, legacy=False):
+    """
+    Load streamlines from trk or tck file in chunks (only one chunk is in memory at a time).
+
+    Yields:
+        ArraySequence with at most chunk_size streamlines
+    """
+    streamline_file = _StreamlineFile(filename, legacy=legacy)
+    for start in range(0, len(streamline_file), chunk_size):
+        yield streamline_file.get(slice(start, start + chunk_size))
+
+
+def get_nr_streamlines(filename):
+    """
+    Number of streamlines in trk or tck file (the points are not read).
+    """
+    return len(_StreamlineFile(filename))
+
+
+def get_trk_reference(filename):
+    """
+    Reference image of a trk file (e.g. to write the streamlines to another file with the same header).
+
+    Returns:
+        affine (voxel to coordinate space), shape
+    """
+    header = _read_trk_header(filename)
+    return header["voxel_to_rasmm"].astype(np.float64), tuple(int(d) for d in header["dimensions"])
+
+
+def _get_legacy_trk_header(affine, shape):
+    """
+    Header of the old nibabel.trackvis API (empty_header() and aff_to_hdr(pos_vox=False, set_order=False)).
+    """
+    affine = np.abs(affine)
+    affine[:3, 3] = 0  # offset not needed (already part of streamline coordinates)
+    header = np.zeros((), dtype=header_2_dtype)
+    header["magic_number"] = b"TRACK"
+    header["dimensions"] = shape
+    header["voxel_order"] = b"RAS"
+    header["version"] = 2
+    header["hdr_size"] = TRK_HEADER_SIZE
+    header["voxel_to_rasmm"] = affine
+    # RAS to DICOM LPS (DPCS)
+    affine = np.dot(np.diag([-1, -1, 1, 1]), affine)
+    zooms = np.sqrt(np.sum(affine[:3, :3] * affine[:3, :3], axis=0))
+    rotation_zooms = affine[:3, :3] / zooms
+    if npl.det(rotation_zooms) < 0:
+        zooms[0] *= -1
+        rotation_zooms[:, 0] *= -1
+    P, S, Qs = npl.svd(rotation_zooms)
+    rotation = np.dot(P, Qs)
+    header["origin"] = affine[:3, 3]
+    header["voxel_sizes"] = zooms
+    header["image_orientation_patient"] = rotation[:, 0:2].T.ravel()
+    return header
+
+
+class StreamlineWriter(object):
+    """
+    Write streamlines to a trk or tck file in chunks, e.g.
+
+    with streamline_io.StreamlineWriter("CST_right.trk", affine, shape) as writer:
+        for streamlines in chunks:
+            writer.write(streamlines)
+
+    The number of streamlines is written to the header when closing.
+    """
+
+    def __init__(self, filename, affine=None, shape=None, vox_sizes=None, vox_order="RAS", legacy=False):
+        """
+        Args:
+            filename: path of .trk or .tck file
+            affine: 4x4 matrix (voxel to coordinate space) of the reference image (only for trk; default: HCP)
+            shape: shape of the reference image (only for trk; default: HCP)
+            vox_sizes: voxel sizes (default: absolute values of the diagonal of the affine)
+            vox_order: orientation convention
+            legacy: write trk like the old nibabel.trackvis API (streamlines are stored in coordinate space and
+                the affine is not applied)
+        """
+        self.format = _get_format(filename)
+        self.nr_streamlines = 0
+        self._file = open(filename, "wb")
+
+        if self.format == "trk":
+            affine = DEFAULT_AFFINE if affine is None else np.asarray(affine)
+            shape = DEFAULT_SHAPE if shape is None else shape
+            if legacy:
+                self._header = _get_legacy_trk_header(affine, shape)
+                voxel_to_trackvis = np.diag(self._header["voxel_sizes"].tolist() + [1])
+                self._affine = np.dot(voxel_to_trackvis, npl.inv(self._header["voxel_to_rasmm"])).astype("f4")
+            else:
+                if vox_sizes is None:
+                    vox_sizes = np.abs(np.diag(affine)[:3])
+                self._header = np.zeros((), dtype=header_2_dtype)
+                self._header["magic_number"] = b"TRACK"
+                self._header["dimensions"] = shape
+                self._header["voxel_sizes"] = vox_sizes
+                self._header["voxel_to_rasmm"] = affine
+                self._header["voxel_order"] = vox_order.encode("latin1")
+                self._header["version"] = 2
+                self._header["hdr_size"] = TRK_HEADER_SIZE
+                self._affine = get_affine_rasmm_to_trackvis(self._header)
+            self._file.write(self._header.tobytes())
+        else:
+            # count with fixed width, so it can be updated when closing
+            lines = [TCK_MAGIC_NUMBER, "count: {:010}".format(0), "datatype: Float32LE"]
+            text = "\n".join(lines) + "\nfile: . "
+            offset = len(text) + len("\nEND\n")
+            offset += len(str(offset + len(str(offset))))
+            self._file.write((text + str(offset) + "\nEND\n").encode("latin1"))
+            self._count_position = len(lines[0]) + 1 + len("count: ")
+
+    def write(self, streamlines):
+        """
+        Append streamlines (list of 2D arrays or ArraySequence in coordinate space).
+        """
+        points, offsets, lengths = fiber_utils.get_points(streamlines)
+        if len(lengths) == 0:
+            return
+        if self.format == "trk":
+            points = apply_affine(self._affine, points)
+            # [nr_points, x1, y1, z1, x2, ...] for each streamline
+            block = np.empty(len(lengths) + 3 * len(points), dtype="<f4")
+            count_positions = 3 * offsets + np.arange(len(lengths))
+            is_point = np.ones(len(block), dtype=bool)
+            is_point[count_positions] = False
+            block.view("<i4")[count_positions] = lengths
+            block[is_point] = points.ravel()
+        else:
+            # [x, y, z] of each point, each streamline followed by NaN
+            block = np.full((len(points) + len(lengths), 3), np.nan, dtype="<f4")
+            block[np.arange(len(points)) + fiber_utils._get_streamline_idxs(lengths)] = points
+        self._file.write(block.tobytes())
+        self.nr_streamlines += len(lengths)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self.format == "trk":
+            self._file.seek(header_2_dtype.fields["nb_streamlines"][1])
+            self._file.write(np.array(self.nr_streamlines, dtype="<i4").tobytes())
+        else:
+            self._file.write(np.full(3, np.inf, dtype="<f4").tobytes())
+            self._file.seek(self._count_position)
+            self._file.write("{:010}".format(self.nr_streamlines).encode("latin1"))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def save(filename, streamlines, affine=None, shape=None, vox_sizes=None, vox_order="RAS", legacy=False):
+    """
+    Save streamlines to trk or tck file (see StreamlineWriter for the arguments).
+    """
+    with StreamlineWriter(filename, affine=affine, shape=shape, vox_sizes=vox_sizes, vox_order=vox_order,
+                          legacy=legacy) as writer:
+        writer.write(streamlines)
@@ -11,19 +11,29 @@ import nibabel as nib
 import numpy as np
 
 from tractseg.libs import fiber_utils
+from tractseg.libs import nifti_utils
 from tractseg.libs import img_utils
 from tractseg.libs import tractseg_prob_tracking
 from tractseg.libs import peak_utils
+from tractseg.libs import cpu_budget
+from tractseg.libs import streamline_io
+from tractseg.libs import tractogram_archive
 
 
 def _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus):
-    ref_img = nib.load(output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz")
+    ref_img = nifti_utils.load(output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz")
     reference_affine = ref_img.affine
-    reference_shape = ref_img.get_fdata().shape[:3]
-    fiber_utils.convert_tck_to_trk(output_dir + "/" + tracking_folder + "/" + bundle + ".tck",
-                                   output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
-                                   reference_affine, reference_shape, compress_err_thr=0.1, smooth=None,
-                                   nr_cpus=nr_cpus, tracking_format=output_format)
+    reference_shape = ref_img.shape[:3]
+    if output_format == "archive":
+        streamlines = streamline_io.load(output_dir + "/" + tracking_folder + "/" + bundle + ".tck")
+        streamlines = fiber_utils.compress_streamlines(streamlines, 0.1, nr_cpus=nr_cpus)
+        tractogram_archive.save_bundle(output_dir + "/" + tracking_folder + "/" + tractogram_archive.FILENAME,
+                                       bundle, streamlines, reference_affine, reference_shape)
+    else:
+        fiber_utils.convert_tck_to_trk(output_dir + "/" + tracking_folder + "/" + bundle + ".tck",
+                                       output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
+                                       reference_affine, reference_shape, compress_err_thr=0.1, smooth=None,
+                                       nr_cpus=nr_cpus, tracking_format=output_format)
     subprocess.call("rm -f " + output_dir + "/" + tracking_folder + "/" + bundle + ".tck", shell=True)
 
 
@@ -45,7 +55,7 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
           use_best_original_peaks=False, use_as_prior=False, filter_by_endpoints=True,
           tracking_folder="auto", dir_postfix="", dilation=1,
           next_step_displacement_std=0.15,
-          output_format="trk", nr_fibers=2000, nr_cpus=-1):
+          output_format="trk", nr_fibers=2000, nr_cpus=-1, seed=None, seeding="uniform"):
 
     ################### Preparing ###################
 
@@ -55,10 +65,7 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
     TOM_folder = "TOM" + dir_postfix
 
     # Set nr threads for MRtrix
-    if nr_cpus > 0:
-        nthreads = " -nthreads " + str(nr_cpus)
-    else:
-        nthreads = ""
+    nthreads = cpu_budget.mrtrix_nthreads(nr_cpus)
 
     # Misc
     subprocess.call("export PATH=/code/mrtrix3/bin:$PATH", shell=True)
@@ -67,10 +74,13 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
 
     # Check if bundle masks are valid
     if filter_by_endpoints:
-        bundle_mask_ok = nib.load(output_dir + "/bundle_segmentations" + dir_postfix
-                                  + "/" + bundle + ".nii.gz").get_fdata().max() > 0
-        beginnings_mask_ok = nib.load(output_dir + "/endings_segmentations/" + bundle + "_b.nii.gz").get_fdata().max() > 0
-        endings_mask_ok = nib.load(output_dir + "/endings_segmentations/" + bundle + "_e.nii.gz").get_fdata().max() > 0
+        # Decoded masks are cached by nifti_utils (needed again for tracking)
+        bundle_mask_ok = img_utils.load_bundle_data(output_dir + "/bundle_segmentations" + dir_postfix, bundle,
+                                                    cache=True).max() > 0
+        beginnings_mask_ok = img_utils.load_bundle_data(output_dir + "/endings_segmentations", bundle + "_b",
+                                                        cache=True).max() > 0
+        endings_mask_ok = img_utils.load_bundle_data(output_dir + "/endings_segmentations", bundle + "_e",
+                                                     cache=True).max() > 0
 
         if not bundle_mask_ok:
             print("WARNING: tract mask of {} empty. Creating empty tractogram.".format(bundle))
@@ -85,11 +95,16 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
     ################### Tracking ###################
 
     if not bundle_mask_ok or not beginnings_mask_ok or not endings_mask_ok:
-        fiber_utils.create_empty_tractogram(output_dir + "/" + tracking_folder + "/" +
-                                            bundle + "." + output_format,
-                                            output_dir + "/bundle_segmentations" + dir_postfix + "/" +
-                                            bundle + ".nii.gz",
-                                            tracking_format=output_format)
+        if output_format == "archive":
+            ref_img = nifti_utils.load(output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz")
+            tractogram_archive.save_bundle(output_dir + "/" + tracking_folder + "/" + tractogram_archive.FILENAME,
+                                           bundle, [], ref_img.affine, ref_img.shape[:3])
+        else:
+            fiber_utils.create_empty_tractogram(output_dir + "/" + tracking_folder + "/" +
+                                                bundle + "." + output_format,
+                                                output_dir + "/bundle_segmentations" + dir_postfix + "/" +
+                                                bundle + ".nii.gz",
+                                                tracking_format=output_format)
     else:
         # Filtering
         if filter_by_endpoints:
@@ -125,7 +140,7 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                     " -minlength 40 -maxlength 250 -seeds " + str(seeds) +
                                     " -select " + str(nr_fibers) + " -cutoff 0.05 -force" + nthreads,
                                     shell=True)
-                    if output_format == "trk" or output_format == "trk_legacy":
+                    if output_format != "tck":
                         _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
 
                 else:
@@ -142,7 +157,7 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                         " -minlength 40 -maxlength 250 -select " + str(nr_fibers) +
                                         " -force -quiet" + nthreads,
                                         shell=True)
-                        if output_format == "trk" or output_format == "trk_legacy":
+                        if output_format != "tck":
                             _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
 
                     # iFOD2 tracking on TOMs
@@ -161,7 +176,7 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                         " -minlength 40 -maxlength 250 -select " + str(nr_fibers) +
                                         " -force -quiet" + nthreads,
                                         shell=True)
-                        if output_format == "trk" or output_format == "trk_legacy":
+                        if output_format != "tck":
                             _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
 
                     else:
@@ -172,29 +187,34 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
             else:
 
                 # Prepare files
-                bundle_mask_img = nib.load(output_dir + "/bundle_segmentations" + dir_postfix + "/"
-                                           + bundle + ".nii.gz")
-                beginnings_img = nib.load(output_dir + "/endings_segmentations/" + bundle + "_b.nii.gz")
-                endings_img = nib.load(output_dir + "/endings_segmentations/" + bundle + "_e.nii.gz")
-                tom_peaks_img = nib.load(output_dir + "/" + TOM_folder + "/" + bundle + ".nii.gz")
+                bundle_mask_path = output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz"
+                beginnings_path = output_dir + "/endings_segmentations/" + bundle + "_b.nii.gz"
+                endings_path = output_dir + "/endings_segmentations/" + bundle + "_e.nii.gz"
+                tom_peaks_path = output_dir + "/" + TOM_folder + "/" + bundle + ".nii.gz"
+                bundle_mask_img = nifti_utils.load(bundle_mask_path)
 
                 # Ensure same orientation as MNI space
-                bundle_mask, flip_axis = img_utils.flip_axis_to_match_MNI_space(bundle_mask_img.get_fdata().astype(np.uint8),
-                                                                                bundle_mask_img.affine)
-                beginnings, flip_axis = img_utils.flip_axis_to_match_MNI_space(beginnings_img.get_fdata().astype(np.uint8),
-                                                                                beginnings_img.affine)
-                endings, flip_axis = img_utils.flip_axis_to_match_MNI_space(endings_img.get_fdata().astype(np.uint8),
-                                                                                endings_img.affine)
-                tom_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(tom_peaks_img.get_fdata(),
-                                                                                  tom_peaks_img.affine)
+                bundle_mask, flip_axis = img_utils.flip_axis_to_match_MNI_space(
+                    img_utils.load_bundle_data(output_dir + "/bundle_segmentations" + dir_postfix, bundle,
+                                               cache=True).astype(np.uint8), bundle_mask_img.affine)
+                beginnings, flip_axis = img_utils.flip_axis_to_match_MNI_space(
+                    img_utils.load_bundle_data(output_dir + "/endings_segmentations", bundle + "_b",
+                                               cache=True).astype(np.uint8), nifti_utils.get_affine(beginnings_path))
+                endings, flip_axis = img_utils.flip_axis_to_match_MNI_space(
+                    img_utils.load_bundle_data(output_dir + "/endings_segmentations", bundle + "_e",
+                                               cache=True).astype(np.uint8), nifti_utils.get_affine(endings_path))
+                tom_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(
+                    img_utils.load_bundle_data(output_dir + "/" + TOM_folder, bundle),
+                    nifti_utils.get_affine(tom_peaks_path))
 
                 # tracking_uncertainties = nib.load(output_dir + "/tracking_uncertainties/" + bundle + ".nii.gz").get_fdata()
                 tracking_uncertainties = None
 
                 #Get best original peaks
                 if use_best_original_peaks:
-                    orig_peaks_img = nib.load(peaks)
-                    orig_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(orig_peaks_img.get_fdata(),
+                    orig_peaks_img = nifti_utils.load(peaks)
+                    # Decoded only once for all bundles (cached by nifti_utils)
+                    orig_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(nifti_utils.get_data(peaks),
                                                                                    orig_peaks_img.affine)
                     best_orig_peaks = fiber_utils.get_best_original_peaks(tom_peaks, orig_peaks)
                     for axis in flip_axis:
@@ -205,8 +225,9 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
 
                 #Get weighted mean between best original peaks and TOMs
                 if use_as_prior:
-                    orig_peaks_img = nib.load(peaks)
-                    orig_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(orig_peaks_img.get_fdata(),
+                    orig_peaks_img = nifti_utils.load(peaks)
+                    # Decoded only once for all bundles (cached by nifti_utils)
+                    orig_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(nifti_utils.get_data(peaks),
                                                                                    orig_peaks_img.affine)
                     best_orig_peaks = fiber_utils.get_best_original_peaks(tom_peaks, orig_peaks)
                     weighted_peaks = fiber_utils.get_weighted_mean_of_peaks(best_orig_peaks, tom_peaks, weight=0.5)
@@ -216,6 +237,10 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                              output_dir + "/" + tracking_folder + "/" + bundle + "_weighted.nii.gz")
                     tom_peaks = weighted_peaks
 
+                # Random numbers of each bundle only depend on the seed and the bundle name (not on the other bundles)
+                bundle_seed = None if seed is None else \
+                    np.random.SeedSequence(seed, spawn_key=tuple(ord(c) for c in bundle))
+
                 # Takes around 6min for 1 subject (2mm resolution)
                 streamlines = tractseg_prob_tracking.track(tom_peaks, max_nr_fibers=nr_fibers, smooth=5,
                                                            compress=0.1, bundle_mask=bundle_mask, start_mask=beginnings,
@@ -225,17 +250,21 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                                            next_step_displacement_std=next_step_displacement_std,
                                                            nr_cpus=nr_cpus, affine=bundle_mask_img.affine,
                                                            spacing=bundle_mask_img.header.get_zooms()[0],
-                                                           verbose=False)
+                                                           seed=bundle_seed, seeding=seeding, verbose=False)
 
-                if output_format == "trk_legacy":
+                if output_format == "archive":
+                    tractogram_archive.save_bundle(
+                        output_dir + "/" + tracking_folder + "/" + tractogram_archive.FILENAME, bundle,
+                        streamlines, bundle_mask_img.affine, bundle_mask_img.shape[:3])
+                elif output_format == "trk_legacy":
                     fiber_utils.save_streamlines_as_trk_legacy(output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
                                                                streamlines, bundle_mask_img.affine,
-                                                               bundle_mask_img.get_fdata().shape)
+                                                               bundle_mask_img.shape)
                 else:  # tck or trk (determined by file ending)
                     fiber_utils.save_streamlines(
                         output_dir + "/" + tracking_folder + "/" + bundle + "." + output_format,
                         streamlines, bundle_mask_img.affine,
-                        bundle_mask_img.get_fdata().shape)
+                        bundle_mask_img.shape)
 
 
         # No streamline filtering
@@ -252,7 +281,7 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                             " -minlength 40 -maxlength 250 -select " + str(nr_fibers) +
                             " -force -quiet" + nthreads, shell=True)
 
-            if output_format == "trk" or output_format == "trk_legacy":
+            if output_format != "tck":
                 _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
 
 
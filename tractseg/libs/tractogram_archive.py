@@ -0,0 +1,359 @@
+"""
+Compact archive of the tractograms of all bundles of one subject (one file instead of one trk/tck file per bundle).
+
+Points are quantized (default: 0.01mm) and stored as difference to the previous point of the streamline (int16;
+int32 if a difference does not fit). The first point of each streamline is stored as absolute value (int32), so
+errors do not accumulate along the streamline (maximum error: precision / 2). The file is a zip file (deflate
+compressed) with one npy file for each array (can be opened with np.load):
+
+header/affine.npy, header/shape.npy         reference image (to convert the bundles back to trk)
+header/precision.npy                        quantization step in mm
+bundles/<bundle>/lengths.npy                number of points of each streamline
+bundles/<bundle>/starts.npy                 first point of each streamline (quantized)
+bundles/<bundle>/deltas.npy                 all other points (quantized differences)
+
+Each bundle can be read without reading the other bundles. The index (bundles and number of streamlines) is read
+from the zip directory and the npy headers.
+
+New bundles are appended to the archive (only replacing a bundle rewrites the archive). Several processes can add
+bundles to the same archive (e.g. Tracking of different bundles of one subject): writing is serialized by a file
+lock on <archive>.lock. Appending overwrites the central directory of the zip file, so it is saved in
+<archive>.journal before and restored if the process dies while appending (by the next process which opens the
+archive).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import struct
+import zipfile
+import contextlib
+from os.path import join
+from collections import OrderedDict
+
+import numpy as np
+
+from tractseg.libs import fiber_utils
+from tractseg.libs import streamline_io
+
+
+FILENAME = "tractograms.npz"  # default name in the tracking folder
+PRECISION = 0.01  # mm
+
+
+def _write_array(zip_file, name, array):
+    buffer = io.BytesIO()
+    np.lib.format.write_array(buffer, np.asarray(array), allow_pickle=False)
+    zip_file.writestr(name + ".npy", buffer.getvalue())
+
+
+def _read_array(zip_file, name):
+    with zip_file.open(name + ".npy") as f:
+        return np.lib.format.read_array(io.BytesIO(f.read()), allow_pickle=False)
+
+
+def _bundle_prefix(bundle):
+    return "bundles/" + bundle + "/"
+
+
+def _get_bundles(zip_file):
+    bundles = []
+    for name in zip_file.namelist():
+        if name.startswith("bundles/") and name.endswith("/lengths.npy"):
+            bundles.append(name[len("bundles/"):-len("/lengths.npy")])
+    return bundles
+
+
+def encode(streamlines, precision=PRECISION):
+    """
+    Quantize and delta encode streamlines.
+
+    Returns:
+        lengths (int32), starts [nr_streamlines, 3] (int32), deltas [nr_points - nr_streamlines, 3] (int16 or int32)
+    """
+    points, offsets, lengths = fiber_utils.get_points(streamlines)
+    quantized = np.round(np.asarray(points, dtype=np.float64) / precision).astype(np.int64)
+    not_empty = lengths > 0
+    starts = quantized[offsets[not_empty]]
+    deltas = fiber_utils._get_segments(quantized, offsets, lengths)[1]
+    if len(starts) > 0 and np.abs(starts).max() > np.iinfo(np.int32).max:
+        raise ValueError("Coordinates too large for precision {}".format(precision))
+    deltas_dtype = np.int16 if len(deltas) == 0 or np.abs(deltas).max() <= np.iinfo(np.int16).max else np.int32
+    return lengths.astype(np.int32), starts.astype(np.int32), deltas.astype(deltas_dtype)
+
+
+def decode(lengths, starts, deltas, precision=PRECISION):
+    """
+    Inverse of encode().
+
+    Returns:
+        ArraySequence (float32)
+    """
+    lengths = np.asarray(lengths, dtype=np.intp)
+    offsets = np.cumsum(lengths) - lengths
+    not_empty = lengths > 0
+    quantized = np.empty((lengths.sum(), 3), dtype=np.int64)
+    is_start = np.zeros(len(quantized), dtype=bool)
+    is_start[offsets[not_empty]] = True
+    quantized[is_start] = 0
+    quantized[~is_start] = deltas
+    # cumulative sum of the differences within each streamline
+    quantized = np.cumsum(quantized, axis=0)
+    quantized -= np.repeat(quantized[offsets[not_empty]], lengths[not_empty], axis=0)
+    quantized += np.repeat(starts.astype(np.int64), lengths[not_empty], axis=0)
+    return fiber_utils._from_points((quantized * precision).astype(np.float32), lengths)
+
+
+def save_bundle(filename, bundle, streamlines, affine=None, shape=None, precision=PRECISION):
+    """
+    Add the streamlines of a bundle to the archive (created if it does not exist; replaces the bundle if it already
+    exists).
+
+    Args:
+        filename: path of the archive
+        bundle: name of the bundle
+        streamlines: list of 2D arrays or ArraySequence (coordinate space)
+        affine: affine of the reference image (only used when creating the archive)
+        shape: shape of the reference image (only used when creating the archive)
+        precision: quantization step in mm (only used when creating the archive)
+    """
+    with _lock(filename):
+        _recover(filename)
+        if not os.path.exists(filename):
+            lengths, starts, deltas = encode(streamlines, precision)
+
+            def write(zip_file):
+                _write_array(zip_file, "header/affine",
+                             streamline_io.DEFAULT_AFFINE if affine is None else np.asarray(affine, dtype=np.float64))
+                _write_array(zip_file, "header/shape",
+                             np.array(streamline_io.DEFAULT_SHAPE if shape is None else shape[:3], dtype=np.int32))
+                _write_array(zip_file, "header/precision", np.array(precision, dtype=np.float64))
+                _write_bundle(zip_file, bundle, lengths, starts, deltas)
+            _write_copy(filename, write)
+            return
+
+        with zipfile.ZipFile(filename, "r") as zip_file:
+            exists = bundle in _get_bundles(zip_file)
+            precision = float(_read_array(zip_file, "header/precision"))
+        lengths, starts, deltas = encode(streamlines, precision)
+        if exists:
+            _write_copy(filename, lambda zip_file: _write_bundle(zip_file, bundle, lengths, starts, deltas),
+                        skip_bundle=bundle)
+        else:
+            _append(filename, lambda zip_file: _write_bundle(zip_file, bundle, lengths, starts, deltas))
+
+
+def _write_bundle(zip_file, bundle, lengths, starts, deltas):
+    prefix = _bundle_prefix(bundle)
+    _write_array(zip_file, prefix + "lengths", lengths)
+    _write_array(zip_file, prefix + "starts", starts)
+    _write_array(zip_file, prefix + "deltas", deltas)
+
+
+@contextlib.contextmanager
+def _lock(filename, shared=False):
+    """
+    Lock the archive (lock of the file <archive>.lock; released by the OS if the process dies).
+    """
+    import fcntl
+    try:
+        fd = os.open(filename + ".lock", os.O_RDONLY | os.O_CREAT, 0o666)
+    except OSError:
+        if not shared:
+            raise
+        yield  # reading from a read-only directory: nobody can write to the archive
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _journal_path(filename):
+    return filename + ".journal"
+
+
+def _write_file(path, content):
+    """
+    Write file atomically (the file either does not exist or is complete).
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _append(filename, write):
+    """
+    Append files to the archive with write(zip_file). The central directory (which is overwritten by the new
+    files) is saved in the journal before, so the archive can be restored if the process dies while appending.
+    """
+    with zipfile.ZipFile(filename, "r") as zip_file:
+        start_dir = zip_file.start_dir  # the new files are written from here on
+    with open(filename, "rb") as f:
+        f.seek(start_dir)
+        central_dir = f.read()
+    _write_file(_journal_path(filename), struct.pack("<Q", start_dir) + central_dir)
+    try:
+        with zipfile.ZipFile(filename, "a", compression=zipfile.ZIP_DEFLATED) as zip_file:
+            write(zip_file)
+        with open(filename, "rb+") as f:
+            os.fsync(f.fileno())
+    except BaseException:
+        _recover(filename)
+        raise
+    os.remove(_journal_path(filename))
+
+
+def _recover(filename):
+    """
+    Restore the archive as it was before an interrupted append (needs the lock).
+    """
+    journal_path = _journal_path(filename)
+    if not os.path.exists(journal_path):
+        return
+    with open(journal_path, "rb") as f:
+        start_dir = struct.unpack("<Q", f.read(8))[0]
+        central_dir = f.read()
+    with open(filename, "rb+") as f:
+        f.truncate(start_dir)
+        f.seek(start_dir)
+        f.write(central_dir)
+        f.flush()
+        os.fsync(f.fileno())
+    os.remove(journal_path)
+
+
+def _write_copy(filename, write, skip_bundle=None):
+    """
+    Write a new archive (copy of the files of the existing archive except the ones of skip_bundle plus the files
+    written by write(zip_file)) and replace the archive with it.
+    """
+    tmp_filename = filename + ".tmp"
+    try:
+        with zipfile.ZipFile(tmp_filename, "w", compression=zipfile.ZIP_DEFLATED) as zip_out:
+            if os.path.exists(filename):
+                prefix = None if skip_bundle is None else _bundle_prefix(skip_bundle)
+                with zipfile.ZipFile(filename, "r") as zip_in:
+                    for item in zip_in.infolist():
+                        if prefix is None or not item.filename.startswith(prefix):
+                            zip_out.writestr(item, zip_in.read(item.filename))
+            write(zip_out)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+
+@contextlib.contextmanager
+def _open(filename):
+    """
+    Open the archive for reading (waits for processes which are adding a bundle).
+    """
+    if os.path.exists(_journal_path(filename)):  # process died while appending (or is still appending)
+        with _lock(filename):
+            _recover(filename)
+    with _lock(filename, shared=True):
+        with zipfile.ZipFile(filename, "r") as zip_file:
+            yield zip_file
+
+
+def load_bundle(filename, bundle, idxs=None):
+    """
+    Load the streamlines of one bundle.
+
+    Args:
+        filename: path of the archive
+        bundle: name of the bundle
+        idxs: only decode these streamlines (slice, list of indices or boolean mask)
+
+    Returns:
+        ArraySequence (float32, coordinate space)
+    """
+    prefix = _bundle_prefix(bundle)
+    with _open(filename) as zip_file:
+        if bundle not in _get_bundles(zip_file):
+            raise KeyError("Bundle {} not found in {}".format(bundle, filename))
+        precision = float(_read_array(zip_file, "header/precision"))
+        lengths = _read_array(zip_file, prefix + "lengths")
+        starts = _read_array(zip_file, prefix + "starts")
+        deltas = _read_array(zip_file, prefix + "deltas")
+    if idxs is not None:
+        # select the streamlines before decoding (the deltas of each streamline are one after the other)
+        idxs = np.arange(len(lengths))[idxs]
+        all_starts = np.zeros((len(lengths), 3), dtype=starts.dtype)
+        all_starts[lengths > 0] = starts
+        deltas = fiber_utils.get_points(fiber_utils._from_points(deltas, np.maximum(lengths - 1, 0))[idxs])[0]
+        lengths = lengths[idxs]
+        starts = all_starts[idxs][lengths > 0]
+    return decode(lengths, starts, deltas, precision)
+
+
+def get_index(filename):
+    """
+    Returns:
+        OrderedDict: bundle -> number of streamlines
+    """
+    index = OrderedDict()
+    with _open(filename) as zip_file:
+        for bundle in _get_bundles(zip_file):
+            with zip_file.open(_bundle_prefix(bundle) + "lengths.npy") as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape = np.lib.format.read_array_header_1_0(f)[0]
+                else:
+                    shape = np.lib.format.read_array_header_2_0(f)[0]
+            index[bundle] = shape[0]
+    return index
+
+
+def get_reference(filename):
+    """
+    Returns:
+        affine, shape of the reference image
+    """
+    with _open(filename) as zip_file:
+        return _read_array(zip_file, "header/affine"), tuple(_read_array(zip_file, "header/shape"))
+
+
+def convert_to_archive(tractogram_files, filename, affine=None, shape=None, legacy=False, precision=PRECISION):
+    """
+    Save trk or tck files in one archive (bundle name: file name without extension).
+
+    Args:
+        tractogram_files: list of paths
+        filename: path of the archive
+        affine: affine of the reference image (default: from the first trk file)
+        shape: shape of the reference image (default: from the first trk file)
+        legacy: trk files have the format "trk_legacy"
+    """
+    for tractogram_file in tractogram_files:
+        if affine is None and tractogram_file.endswith(".trk"):
+            affine, shape = streamline_io.get_trk_reference(tractogram_file)
+        bundle = os.path.splitext(os.path.basename(tractogram_file))[0]
+        save_bundle(filename, bundle, streamline_io.load(tractogram_file, legacy=legacy), affine, shape,
+                    precision)
+
+
+def convert_from_archive(filename, output_dir, tracking_format="trk_legacy", bundles=None):
+    """
+    Save the bundles of an archive as trk or tck files (<bundle>.trk or <bundle>.tck in output_dir).
+
+    Args:
+        filename: path of the archive
+        output_dir: output directory (has to exist)
+        tracking_format: tck | trk | trk_legacy
+        bundles: list of bundles (default: all)
+    """
+    affine, shape = get_reference(filename)
+    file_ending = "tck" if tracking_format == "tck" else "trk"
+    for bundle in get_index(filename) if bundles is None else bundles:
+        streamline_io.save(join(output_dir, bundle + "." + file_ending), load_bundle(filename, bundle), affine,
+                           shape, legacy=tracking_format == "trk_legacy")
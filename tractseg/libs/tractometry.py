@@ -17,6 +17,7 @@ from dipy.tracking.streamline import values_from_volume
 import dipy.stats.analysis as dsa
 
 from tractseg.libs import fiber_utils
+from tractseg.libs import profiler
 
 
 def _get_length_best_orig_peak(predicted_img, orig_img, x, y, z):
@@ -46,6 +47,7 @@ def _orient_to_same_start_region(streamlines, beginnings):
     return streamlines_new
 
 
+@profiler.traced()
 def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, dilate=0, predicted_peaks=None,
                                affine=None):
     # Runtime:
@@ -56,7 +58,7 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
     # - AFQ:                      ?s (test),     ?s (all),      85s  (test 4 bundles, 100 points)
     # => AFQ a lot slower than others
 
-    streamlines = list(transform_streamlines(streamlines, np.linalg.inv(affine)))
+    streamlines = transform_streamlines(fiber_utils.to_array_sequence(streamlines), np.linalg.inv(affine))
 
     for i in range(dilate):
         beginnings = binary_dilation(beginnings)
@@ -1,15 +1,18 @@
 
-import psutil
 import numpy as np
 import multiprocessing
 from functools import partial
 
-from dipy.tracking.streamline import transform_streamlines
+from nibabel.affines import apply_affine
 from scipy.ndimage.morphology import binary_dilation
-from dipy.tracking.streamline import Streamlines
+from scipy.ndimage import gaussian_filter
+from dipy.tracking.metrics import spline
+from dipy.tracking.streamline import compress_streamlines
 
 from tractseg.libs import fiber_utils
 from tractseg.libs import img_utils
+from tractseg.libs import cpu_budget
+from tractseg.libs import profiler
 
 global _PEAKS
 _PEAKS = None
@@ -27,7 +30,7 @@ global _TRACKING_UNCERTAINTIES
 _TRACKING_UNCERTAINTIES = None
 
 
-def process_seedpoint(seed_point, spacing, next_step_displacement_std):
+def process_seedpoint(seed_point, spacing, next_step_displacement_std, rng=None):
     """
     Create one streamline from one seed point.
 
@@ -35,6 +38,7 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
         seed_point: 3d point
         spacing: Only one value. Assumes isotropic images.
         next_step_displacement_std: stddev for gaussian distribution
+        rng: np.random.Generator for the random displacements (default: global numpy RNG)
     Returns:
         (streamline, streamline_length)
     """
@@ -43,7 +47,7 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
 
     # Has to be sub-method otherwise not working
     def process_one_way(peaks, streamline, max_nr_steps, step_size, probabilistic, next_step_displacement_std,
-                        max_tract_len, peak_len_thr, bundle_mask, tracking_uncertainties, reverse=False):
+                        max_tract_len, peak_len_thr, bundle_mask, tracking_uncertainties, rng, reverse=False):
         last_dir = None
         sl_len = 0
         for i in range(max_nr_steps):
@@ -70,7 +74,7 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
                     displacement_std_scaled = next_step_displacement_std * uncertainty
                 else:
                     displacement_std_scaled = next_step_displacement_std
-                displacement = np.random.normal(0, displacement_std_scaled, 3)
+                displacement = rng.normal(0, displacement_std_scaled, 3)
                 dir_scaled = dir_scaled + displacement
 
                 # If step_size too small and next_step_displacement_std too big: sometimes even goes back
@@ -146,22 +150,25 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
     global _TRACKING_UNCERTAINTIES
     tracking_uncertainties = _TRACKING_UNCERTAINTIES
 
+    if rng is None:
+        rng = np.random
+
     streamline1 = []
     if probabilistic:
-        random_seedpoint_displacement = np.random.normal(0, seedpoint_displacement_std, 3)
+        random_seedpoint_displacement = rng.normal(0, seedpoint_displacement_std, 3)
         seed_point = seed_point + random_seedpoint_displacement
     streamline1.append([seed_point[0], seed_point[1], seed_point[2]])  # add first point to streamline
     streamline2 = list(streamline1)  # deep copy
 
     streamline_part1, length_1 = process_one_way(peaks, streamline1, max_nr_steps, step_size, probabilistic,
                                                  next_step_displacement_std, max_tract_len, peak_len_thr, bundle_mask,
-                                                 tracking_uncertainties, reverse=False)
+                                                 tracking_uncertainties, rng, reverse=False)
 
     # Roughly doubles execution time but also roughly doubles number of resulting streamlines
     # Makes sense because many too short if seeding in middle of streamline.
     streamline_part2, length_2 = process_one_way(peaks, streamline2, max_nr_steps, step_size, probabilistic,
                                                  next_step_displacement_std, max_tract_len, peak_len_thr, bundle_mask,
-                                                 tracking_uncertainties, reverse=True)
+                                                 tracking_uncertainties, rng, reverse=True)
 
     if len(streamline_part2) > 0:
         # remove first element of part2 otherwise we have seed_point 2 times
@@ -182,19 +189,121 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
     return []
 
 
-def seed_generator(mask_coords, nr_seeds):
+def finish_streamline(streamline, affine, smooth=None, compress=None):
+    """
+    Move one streamline to coordinate space, smooth and compress it. Runs in the tracking workers, so only the
+    final (compressed) streamline is sent back to the main process.
+
+    Args:
+        streamline: list of points in voxel space
+        affine: 4x4 matrix from voxel space to coordinate space
+        smooth: smoothing factor (see fiber_utils.smooth_streamlines)
+        compress: compress streamline (maximum error 0.1mm)
+
+    Returns:
+        2D array (float32)
+    """
+    streamline = apply_affine(affine, np.array(streamline))
+    if smooth:
+        streamline = spline(streamline, s=smooth)
+    if compress:
+        streamline = compress_streamlines(streamline, tol_error=0.1)
+    return streamline.astype(np.float32)
+
+
+def track_seedpoint(seed_point, seed_sequence, spacing, next_step_displacement_std, affine, smooth=None,
+                    compress=None):
+    """
+    Create one streamline from one seed point and finish it (see finish_streamline).
+
+    Args:
+        seed_sequence: np.random.SeedSequence of this seed point. All random displacements come from it, so the
+            streamline does not depend on which worker processes it.
+
+    Returns:
+        2D array or empty list if no valid streamline found
+    """
+    rng = np.random.default_rng(seed_sequence)
+    streamline = process_seedpoint(seed_point, spacing, next_step_displacement_std, rng=rng)
+    if len(streamline) == 0:
+        return []
+    return finish_streamline(streamline, affine, smooth=smooth, compress=compress)
+
+
+def seed_generator(mask_coords, nr_seeds, rng=None, probs=None):
     """
     Randomly select #nr_seeds voxels from mask.
+
+    Args:
+        probs: probability of each voxel (default: uniform)
+
+    Returns:
+        coordinates of the voxels, indices of the voxels in mask_coords
     """
+    if rng is None:
+        rng = np.random
     nr_voxels = mask_coords.shape[0]
-    random_indices = np.random.choice(nr_voxels, nr_seeds, replace=True)
+    random_indices = rng.choice(nr_voxels, nr_seeds, replace=True, p=probs)
     res = np.take(mask_coords, random_indices, axis=0)
-    return res
+    return res, random_indices
+
+
+def get_adaptive_seeding_probs(mask_coords, nr_seeds, nr_accepted, prune=False, min_sigma=3,
+                               uniform_fraction=0.1, min_acceptance=0.25):
+    """
+    Seeding probability of each voxel of the bundle mask based on how many of the previous seeds in this voxel
+    resulted in a valid streamline.
+
+    The acceptance rate of a voxel is estimated from the seeds in its neighbourhood (gaussian smoothing). The
+    neighbourhood is chosen large enough to contain about 10 / mean acceptance rate seeds, so it gets smaller the
+    more seeds were processed. Voxels with only few seeds in their neighbourhood get the mean acceptance rate (prior
+    of one valid streamline).
+
+    Args:
+        mask_coords: coordinates of the voxels of the bundle mask [nr_voxels, 3]
+        nr_seeds: number of seeds in each voxel [nr_voxels]
+        nr_accepted: number of valid streamlines from each voxel [nr_voxels]
+        prune: instead of seeding more in voxels with high acceptance rate, seed uniformly in all voxels except
+            the ones with a very low acceptance rate (weights 0/1). Streamlines which would have started in these
+            voxels are missing, so the streamline density is lower there than for uniform seeding.
+        min_sigma: minimal sigma of the gaussian smoothing (in voxels)
+        uniform_fraction: fraction of seeds which are still distributed uniformly (for prune=False)
+        min_acceptance: no more seeds in voxels with acceptance rate below min_acceptance * mean acceptance rate
+            (for prune=True)
+
+    Returns:
+        probabilities [nr_voxels] or None (uniform) if there are no valid streamlines yet
+    """
+    if nr_accepted.sum() == 0:
+        return None
+    mean_acceptance = nr_accepted.sum() / float(nr_seeds.sum())
+    seeds_per_voxel = nr_seeds.sum() / float(len(nr_seeds))
+    sigma = max(min_sigma, (10 / mean_acceptance / seeds_per_voxel) ** (1 / 3.) / np.sqrt(2 * np.pi))
+
+    # smoothing only in the bounding box of the mask
+    bbox_start = mask_coords.min(axis=0)
+    idxs = tuple((mask_coords - bbox_start).T)
+    smoothed = []
+    for counts in [nr_seeds, nr_accepted]:
+        counts_img = np.zeros(mask_coords.max(axis=0) - bbox_start + 1, dtype=np.float32)
+        counts_img[idxs] = counts
+        # sum instead of mean of the neighbourhood
+        smoothed.append(gaussian_filter(counts_img, sigma, mode="constant")[idxs] * (2 * np.pi * sigma ** 2) ** 1.5)
+    acceptance = (smoothed[1] + 1) / (smoothed[0] + 1 / mean_acceptance)
+
+    if prune:
+        probs = (acceptance >= min_acceptance * mean_acceptance).astype(np.float64)
+        if probs.sum() == 0:
+            return None
+    else:
+        probs = (1 - uniform_fraction) * acceptance / acceptance.sum() + uniform_fraction / len(acceptance)
+    return probs / probs.sum()
 
 
 def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None,
           start_mask=None, end_mask=None, tracking_uncertainties=None, dilation=0,
-          next_step_displacement_std=0.15, nr_cpus=-1, affine=None, spacing=None, verbose=True):
+          next_step_displacement_std=0.15, nr_cpus=-1, affine=None, spacing=None, seed=None, seeding="uniform",
+          verbose=True):
     """
     Generate streamlines.
 
@@ -202,6 +311,18 @@ def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None
     - only seeding in bundle_mask instead of entire image (seeding took very long)
     - calculating fiber length on the fly instead of using extra function which has to iterate over entire fiber a
     second time
+
+    Each batch of seeds gets its own random number stream (spawned from np.random.SeedSequence(seed)) to select
+    the seed voxels and each seed point gets a stream for its displacements (spawned from the stream of the batch).
+    With the same seed the result is identical for any number of processes; with seed=None each run is different.
+
+    Seeding:
+    - uniform: all voxels of the bundle mask
+    - adaptive: more seeds in the voxels whose seeds resulted in valid streamlines in the previous batches (fewer
+      seeds needed for thin or curved bundles; more streamlines in the voxels with high acceptance rate)
+    - adaptive_pruned: uniform seeding, but no more seeds in voxels where hardly any seeds resulted in a valid
+      streamline (streamlines from these voxels are missing)
+    See get_adaptive_seeding_probs.
     """
 
     peaks[:, :, :, 0] *= -1  # have to flip along x axis to work properly
@@ -228,68 +349,84 @@ def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None
     # Get list of coordinates of each voxel in mask to seed from those
     mask_coords = np.array(np.where(bundle_mask == 1)).transpose()
 
+    # Forked workers would all inherit the same state of the global numpy RNG (identical streamlines in each
+    # worker). Instead each batch and each seed point get a child of this SeedSequence (fresh entropy if seed is
+    # None).
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+    # Statistics for adaptive seeding: number of seeds and valid streamlines of each voxel
+    nr_seeds = np.zeros(len(mask_coords))
+    nr_accepted = np.zeros(len(mask_coords))
+    seeding_probs = None  # uniform
+
     max_nr_seeds = 100 * max_nr_fibers  # after how many seeds to abort (to avoid endless runtime)
     # How many seeds to process in each pool.map iteration
     seeds_per_batch = 5000
 
-    if nr_cpus == -1:
-        nr_processes = psutil.cpu_count()
-    else:
-        nr_processes = nr_cpus
+    nr_processes = cpu_budget.get_nr_cpus(nr_cpus)
+
+    # Move from convention "0mm is in voxel corner" to convention "0mm is in voxel center". Most toolkits use the
+    # convention "0mm is in voxel center".
+    # We have to add 0.5 before applying affine otherwise 0.5 is not half a voxel anymore. Then we would have to add
+    # half of the spacing and consider the sign of the affine (not needed here).
+    voxel_center = np.eye(4)
+    voxel_center[:3, 3] = -0.5
+    # move streamlines to coordinate space
+    #  This is doing: streamlines(coordinate_space) = affine * streamlines(voxel_space)
+    affine_final = np.dot(affine, voxel_center)
+    # If the original image was not in MNI space we have to flip back to the original space
+    # before saving the streamlines
+    for axis in img_utils.get_flip_axis_to_match_MNI_space(affine):
+        affine_final = np.dot(fiber_utils.get_invert_affine(bundle_mask.shape, affine, axis=axis), affine_final)
+
+    # All post-processing of each streamline (affine, smoothing (does not change overall results at all because is
+    # just little smoothing; just removes small unevenness), compression) is done in the workers
+    process_seed = partial(track_seedpoint, next_step_displacement_std=next_step_displacement_std, spacing=spacing,
+                           affine=affine_final, smooth=smooth, compress=compress)
 
     streamlines = []
     fiber_ctr = 0
     seed_ctr = 0
     # Processing seeds in batches so we can stop after we reached desired nr of streamlines. Not ideal. Could be
     #   optimised by more multiprocessing fanciness.
-    while fiber_ctr < max_nr_fibers:
-        pool = multiprocessing.Pool(processes=nr_processes)
-        streamlines_tmp = pool.map(partial(process_seedpoint, next_step_displacement_std=next_step_displacement_std,
-                                           spacing=spacing),
-                                   seed_generator(mask_coords, seeds_per_batch))
-        # streamlines_tmp = [process_seedpoint(seed, spacing=spacing) for seed in
-        #                    seed_generator(mask_coords, seeds_per_batch)] # single threaded for debugging
+    # One pool for all batches (started after setting the global variables, so the workers have them)
+    pool = multiprocessing.Pool(processes=nr_processes, initializer=cpu_budget.limit_threads, initargs=(1,))
+    try:
+        while fiber_ctr < max_nr_fibers:
+            with profiler.span("track_seed_batch", seeds=seeds_per_batch, processes=nr_processes):
+                batch_seed_sequence = seed_sequence.spawn(1)[0]
+                seed_points, voxel_idxs = seed_generator(mask_coords, seeds_per_batch,
+                                                         rng=np.random.default_rng(batch_seed_sequence),
+                                                         probs=seeding_probs)
+                streamlines_tmp = pool.starmap(process_seed,
+                                               zip(seed_points, batch_seed_sequence.spawn(seeds_per_batch)))
+                # single threaded for debugging:
+                # streamlines_tmp = [process_seed(*seed) for seed in
+                #                    zip(seed_points, batch_seed_sequence.spawn(seeds_per_batch))]
+
+            if seeding != "uniform":
+                accepted = np.array([len(sl) > 0 for sl in streamlines_tmp])
+                nr_seeds += np.bincount(voxel_idxs, minlength=len(mask_coords))
+                nr_accepted += np.bincount(voxel_idxs[accepted], minlength=len(mask_coords))
+                seeding_probs = get_adaptive_seeding_probs(mask_coords, nr_seeds, nr_accepted,
+                                                           prune=seeding == "adaptive_pruned")
+
+            streamlines_tmp = [sl for sl in streamlines_tmp if len(sl) > 0]  # filter empty ones
+            streamlines += streamlines_tmp
+            fiber_ctr = len(streamlines)
+            if verbose:
+                print("nr_fibs: {}".format(fiber_ctr))
+            seed_ctr += seeds_per_batch
+            if seed_ctr > max_nr_seeds:
+                if verbose:
+                    print("Early stopping because max nr of seeds reached.")
+                break
+    finally:
         pool.close()
         pool.join()
 
-        streamlines_tmp = [sl for sl in streamlines_tmp if len(sl) > 0]  # filter empty ones
-        streamlines += streamlines_tmp
-        fiber_ctr = len(streamlines)
-        if verbose:
-            print("nr_fibs: {}".format(fiber_ctr))
-        seed_ctr += seeds_per_batch
-        if seed_ctr > max_nr_seeds:
-            if verbose:
-                print("Early stopping because max nr of seeds reached.")
-            break
-
     if verbose:
         print("final nr streamlines: {}".format(len(streamlines)))
 
     streamlines = streamlines[:max_nr_fibers]   # remove surplus of fibers (comes from multiprocessing)
-    streamlines = Streamlines(streamlines)  # Generate streamlines object
-
-    # Move from convention "0mm is in voxel corner" to convention "0mm is in voxel center". Most toolkits use the
-    # convention "0mm is in voxel center".
-    # We have to add 0.5 before applying affine otherwise 0.5 is not half a voxel anymore. Then we would have to add
-    # half of the spacing and consider the sign of the affine (not needed here).
-    streamlines = fiber_utils.add_to_each_streamline(streamlines, -0.5)
-
-    # move streamlines to coordinate space
-    #  This is doing: streamlines(coordinate_space) = affine * streamlines(voxel_space)
-    streamlines = list(transform_streamlines(streamlines, affine))
-
-    # If the original image was not in MNI space we have to flip back to the original space
-    # before saving the streamlines
-    flip_axes = img_utils.get_flip_axis_to_match_MNI_space(affine)
-    for axis in flip_axes:
-        streamlines = fiber_utils.invert_streamlines(streamlines, bundle_mask, affine, axis=axis)
-
-    # Smoothing does not change overall results at all because is just little smoothing. Just removes small unevenness.
-    if smooth:
-        streamlines = fiber_utils.smooth_streamlines(streamlines, smoothing_factor=smooth)
-
-    if compress:
-        streamlines = fiber_utils.compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=nr_cpus)
-
-    return streamlines
+    return fiber_utils.to_array_sequence(streamlines, dtype=np.float32)  # Generate streamlines object
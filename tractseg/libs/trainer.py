@@ -17,6 +17,7 @@ import nibabel as nib
 
 from tractseg.libs import exp_utils
 from tractseg.libs import metric_utils
+from tractseg.libs import profiler
 from tractseg.libs import plot_utils
 from tractseg.data.data_loader_inference import DataLoaderInference
 from tractseg.data import dataset_specific_utils
@@ -206,8 +207,9 @@ def train_model(Config, model, data_loader):
         f.write("\n\nAverage Epoch time: {}s".format(sum(epoch_times) / float(len(epoch_times))))
 
 
+@profiler.traced()
 def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=True, only_prediction=False,
-                batch_size=1, unit_test=False):
+                batch_size=1, unit_test=False, channel_idxs=None, dtype=np.float32):
     """
     Return predictions for one 3D image.
 
@@ -217,9 +219,15 @@ def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=Tr
           bs=48 -> 6.5min    ~30GB RAM
     - python 3 + pytorch 1.0:
           bs=1  -> 2.7min    ~7GB RAM
+
+    If channel_idxs is set only these output channels are kept (directly after each forward pass, so the full
+    image is never allocated for all channels).
+
+    dtype is the dtype of the returned prediction. np.float16 halves the memory needed for the probabilities
+    (used by low memory mode).
     """
     def _finalize_data(layers):
-        layers = np.array(layers)
+        layers = np.asarray(layers)
 
         if Config.DIM == "2D":
             # Get in right order (x,y,z) and
@@ -235,18 +243,19 @@ def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=Tr
         if scale_to_world_shape:
             layers = dataset_specific_utils.scale_input_to_original_shape(layers, Config.DATASET, Config.RESOLUTION)
 
-        assert (layers.dtype == np.float32)
+        assert (layers.dtype == np.float32 or layers.dtype == np.float16)
         return layers
 
-    img_shape = [Config.INPUT_DIM[0], Config.INPUT_DIM[0], Config.INPUT_DIM[0], Config.NR_OF_CLASSES]
-    layers_seg = np.empty(img_shape).astype(np.float32)
-    layers_y = None if only_prediction else np.empty(img_shape).astype(np.float32)
+    nr_channels = Config.NR_OF_CLASSES if channel_idxs is None else len(channel_idxs)
+    img_shape = [Config.INPUT_DIM[0], Config.INPUT_DIM[0], Config.INPUT_DIM[0], nr_channels]
+    layers_seg = np.empty(img_shape, dtype=dtype)
+    layers_y = None if only_prediction else np.empty(img_shape, dtype=np.float32)
 
     if unit_test:
         # Return some mockup data to test different input arguments end 2 end and to test the postprocessing of the
         # segmentations (using real segmentations on DWI test image would take too much time if we run it for
         # different configurations)
-        probs = np.zeros(img_shape).astype(np.float32)
+        probs = np.zeros(img_shape[:3] + [Config.NR_OF_CLASSES]).astype(np.float32)
 
         # CA (bundle specific postprocessing)
         probs[10:30, 10:30, 10:30, 4] = 0.7  # big blob 1
@@ -266,17 +275,28 @@ def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=Tr
         probs[60:63, 60:63, 60:63, 5] = 0.9  # small blob -> will get removed by postprocessing
         # should not restore the bridge
 
+        if channel_idxs is not None:
+            probs = probs[..., channel_idxs]
         return probs, layers_y
 
     batch_generator = data_loader.get_batch_generator(batch_size=batch_size)
-    batch_generator = list(batch_generator)
+
+    # Sliding window inference (3D): predictions of overlapping tiles are blended with gaussian weights
+    tiled = hasattr(batch_generator, "tiles")
+    if tiled:
+        layers_seg = np.zeros(img_shape, dtype=np.float32)
+        weights_sum = np.zeros(img_shape[:3], dtype=np.float32)
+        if not only_prediction:
+            layers_y = np.zeros(img_shape, dtype=np.float32)
+
     idx = 0
     for batch in tqdm(batch_generator):
         x = batch["data"]   # (bs, nr_channels, x, y)
         y = batch["seg"]    # (bs, nr_classes, x, y)
-        y = y.numpy()
 
         if not only_prediction:
+            if channel_idxs is not None:
+                y = y[:, channel_idxs]
             y = y.astype(Config.LABELS_TYPE)
             if Config.DIM == "2D":
                 y = y.transpose(0, 2, 3, 1) # (bs, x, y, nr_classes)
@@ -289,13 +309,28 @@ def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=Tr
             samples = []
             for i in range(NR_SAMPLING):
                 layer_probs = model.predict(x)  # (bs, x, y, nr_classes)
+                if channel_idxs is not None:
+                    layer_probs = layer_probs[..., channel_idxs]
                 samples.append(layer_probs)
 
             samples = np.array(samples)  # (NR_SAMPLING, bs, x, y, nr_classes)
             layer_probs = np.std(samples, axis=0)    # (bs, x, y, nr_classes)
         else:
             # For normal prediction
-            layer_probs = model.predict(x)  # (bs, x, y, nr_classes)
+            with profiler.span("forward"):
+                layer_probs = model.predict(x)  # (bs, x, y, nr_classes)
+            if channel_idxs is not None:
+                layer_probs = layer_probs[..., channel_idxs]
+
+        if tiled:
+            tx, ty, tz = batch_generator.tile_size
+            for tile_idx, (x_start, y_start, z_start) in enumerate(batch["tiles"]):
+                tile = (slice(x_start, x_start + tx), slice(y_start, y_start + ty), slice(z_start, z_start + tz))
+                layers_seg[tile] += layer_probs[tile_idx] * batch_generator.importance_map[..., None]
+                weights_sum[tile] += batch_generator.importance_map
+                if not only_prediction:
+                    layers_y[tile] = y[tile_idx]
+            continue
 
         if probs:
             seg = layer_probs   # (x, y, nr_classes)
@@ -310,12 +345,20 @@ def predict_img(Config, model, data_loader, probs=False, scale_to_world_shape=Tr
             if not only_prediction:
                 layers_y[idx*batch_size:(idx+1)*batch_size, :, :, :] = y
         else:
-            layers_seg = np.squeeze(seg)
+            layers_seg = seg[0]  # batch_size is always 1 for 3D
             if not only_prediction:
-                layers_y = np.squeeze(y)
+                layers_y = y[0]
 
         idx += 1
 
+    if tiled:
+        # voxels which are not covered by any tile (outside of brain) stay 0
+        layers_seg /= np.maximum(weights_sum, 1e-8)[..., None]
+        if not probs:
+            layers_seg[layers_seg >= Config.THRESHOLD] = 1
+            layers_seg[layers_seg < Config.THRESHOLD] = 0
+        layers_seg = layers_seg.astype(dtype, copy=False)
+
     layers_seg = _finalize_data(layers_seg)
     if not only_prediction:
         layers_y = _finalize_data(layers_y)
@@ -4,6 +4,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import sys
 import numpy as np
 
 from tractseg.libs.system_config import SystemConfig as C
@@ -94,6 +95,24 @@ def mem_usage(print_usage=True):
     return gb
 
 
+def peak_mem_usage(print_usage=True):
+    """
+    Maximum memory (RSS) this process used so far in GB. Falls back to the current memory usage (mem_usage)
+    on platforms without the resource module (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return mem_usage(print_usage)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    gb = max_rss / 1e9 if sys.platform == "darwin" else max_rss * 1024 / 1e9
+    gb = round(gb, 3)
+    if print_usage:
+        print("PID {} peak memory usage {} GB".format(os.getpid(), gb))
+    return gb
+
+
 def download_pretrained_weights(experiment_type, dropout_sampling=False,
                                 part="Part1", tract_definition="TractQuerier+"):
 
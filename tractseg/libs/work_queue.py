@@ -0,0 +1,272 @@
+"""
+Work queue for processing a cohort on several nodes which only share a (POSIX) filesystem. Every process which works
+on the same queue directory claims one subject at a time, so any number of nodes can join or leave at any time:
+
+- a subject is claimed by atomically creating <queue_dir>/<subject_id>.lock (hard link, also works on NFS)
+- while a subject is processed, a heartbeat thread touches the lock file. If a node dies the lock expires after
+  lease_time seconds and the subject is claimed by another node.
+- when a subject is done the status (done|failed), host and timings are saved in <queue_dir>/<subject_id>.json
+
+The clocks of the nodes should roughly agree (lease_time has to be much larger than the difference).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import uuid
+import errno
+import socket
+import hashlib
+import threading
+from os.path import join
+
+
+def get_subject_id(input_path):
+    """
+    Name of subject in queue: name of directory of input file + hash of path (unique for each input file).
+    """
+    input_path = os.path.abspath(input_path)
+    name = os.path.basename(os.path.dirname(input_path)) or "subject"
+    return "{}_{}".format(name, hashlib.sha1(input_path.encode("utf-8")).hexdigest()[:8])
+
+
+class WorkQueue(object):
+
+    def __init__(self, queue_dir, lease_time=600, retry_failed=False):
+        """
+        Args:
+            queue_dir: directory on shared filesystem (created if not existing)
+            lease_time: seconds after which the lock of a subject expires if it is not refreshed
+            retry_failed: also claim subjects which had failed before this queue was opened (subjects which fail
+                during this run are not claimed again)
+        """
+        self.queue_dir = queue_dir
+        self.lease_time = lease_time
+        self.retry_failed = retry_failed
+        self.start_time = time.time()
+        self.owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._claimed = {}  # subject_id -> claim time
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+        if not os.path.exists(queue_dir):
+            try:
+                os.makedirs(queue_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:  # created by other node at the same time
+                    raise
+
+    def _lock_path(self, subject_id):
+        return join(self.queue_dir, subject_id + ".lock")
+
+    def _status_path(self, subject_id):
+        return join(self.queue_dir, subject_id + ".json")
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def _is_expired(self, lock_path):
+        try:
+            return time.time() - os.stat(lock_path).st_mtime > self.lease_time
+        except OSError:
+            return False  # removed in the meantime
+
+    def get_status(self, subject_id):
+        """
+        Returns:
+            'done', 'failed', 'running', 'expired' (claimed by a node which died) or 'todo'
+        """
+        status = self._read(self._status_path(subject_id))
+        if status is not None:
+            return json.loads(status)["status"]
+        if os.path.exists(self._lock_path(subject_id)):
+            return "expired" if self._is_expired(self._lock_path(subject_id)) else "running"
+        return "todo"
+
+    def _is_finished(self, subject_id):
+        status = self._read(self._status_path(subject_id))
+        if status is None:
+            return False
+        status = json.loads(status)
+        if status["status"] == "done" or not self.retry_failed:
+            return True
+        # Only retry failures from previous runs, otherwise a subject which fails again would be claimed forever
+        return status["owner"] == self.owner or status.get("finished", 0) >= self.start_time
+
+    def claim(self, subject_id):
+        """
+        Try to claim subject.
+
+        Returns:
+            True if this process now owns the subject
+        """
+        if self._is_finished(subject_id):
+            return False
+
+        lock_path = self._lock_path(subject_id)
+        if os.path.exists(lock_path):
+            if not self._is_expired(lock_path):
+                return False
+            self._remove_expired_lock(lock_path)
+
+        # Creating a hard link is atomic (also on NFS): fails if lock exists already
+        tmp_path = "{}.{}.tmp".format(lock_path, self.owner.replace(":", "_"))
+        with open(tmp_path, "w") as f:
+            f.write(self.owner)
+        try:
+            os.link(tmp_path, lock_path)
+            claimed = True
+        except OSError:
+            claimed = False
+        finally:
+            os.remove(tmp_path)
+        if claimed and self._is_finished(subject_id):
+            os.remove(lock_path)  # finished by other node since the first check
+            claimed = False
+        if claimed:
+            with self._lock:
+                self._claimed[subject_id] = time.time()
+            self._start_heartbeat()
+        return claimed
+
+    def _remove_expired_lock(self, lock_path):
+        """
+        Remove expired lock. Only one of the nodes which try this at the same time succeeds (rename is atomic).
+        """
+        expired_owner = self._read(lock_path)
+        moved_path = "{}.{}.expired".format(lock_path, self.owner.replace(":", "_"))
+        try:
+            os.rename(lock_path, moved_path)
+        except OSError:
+            return  # other node was faster
+        if self._read(moved_path) != expired_owner:
+            # Moved the new lock of another node (it claimed the subject in the meantime) -> put it back
+            try:
+                os.link(moved_path, lock_path)
+            except OSError:
+                pass
+        else:
+            print("Lock of {} by {} expired".format(os.path.basename(lock_path), expired_owner))
+        os.remove(moved_path)
+
+    def claim_next(self, subject_ids):
+        """
+        Claim the first subject which is not done or claimed by another node.
+
+        Returns:
+            subject_id or None if no subject is left
+        """
+        for subject_id in subject_ids:
+            if self.claim(subject_id):
+                return subject_id
+        return None
+
+    def finish(self, subject_id, timings=None, error=None):
+        """
+        Save status of subject and release it.
+        """
+        with self._lock:
+            claim_time = self._claimed.pop(subject_id, None)
+        status = {"status": "failed" if error is not None else "done", "owner": self.owner,
+                  "started": claim_time, "finished": time.time(), "timings": timings or {},
+                  "error": None if error is None else str(error)}
+        status_path = self._status_path(subject_id)
+        tmp_path = "{}.{}.tmp".format(status_path, self.owner.replace(":", "_"))
+        with open(tmp_path, "w") as f:
+            json.dump(status, f, indent=2)
+        os.rename(tmp_path, status_path)
+
+        lock_path = self._lock_path(subject_id)
+        if self._read(lock_path) == self.owner:
+            os.remove(lock_path)
+        else:
+            print("WARNING: Lock of {} was taken over by another node (heartbeat too slow?)".format(subject_id))
+
+    def _start_heartbeat(self):
+        if self._heartbeat is not None:
+            return
+        self._heartbeat = threading.Thread(target=self._refresh_locks)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def _refresh_locks(self):
+        while not self._stop.wait(max(self.lease_time / 4.0, 0.1)):
+            with self._lock:
+                subject_ids = list(self._claimed.keys())
+            for subject_id in subject_ids:
+                try:
+                    os.utime(self._lock_path(subject_id), None)
+                except OSError:
+                    pass
+
+    def close(self):
+        """
+        Stop heartbeat (subjects which are still claimed will expire).
+        """
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def summary(self, subject_ids):
+        """
+        Returns:
+            dict: status -> number of subjects
+        """
+        counts = {}
+        for subject_id in subject_ids:
+            status = self.get_status(subject_id)
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+
+def run_commands(subjects, work_queue, commands):
+    """
+    Run shell commands for all subjects which can be claimed (e.g. TractSeg, Tracking and Tractometry). In the
+    commands {input}, {output} and {dir} (directory of input) are replaced by the paths of the subject. The
+    commands of a subject are stopped at the first command which fails.
+
+    Args:
+        subjects: list of (input_path, output_dir) (see cohort.read_subjects_file)
+        work_queue: WorkQueue
+        commands: list of commands
+
+    Returns:
+        number of subjects processed by this process
+    """
+    import shlex
+    import subprocess
+
+    subject_ids = {get_subject_id(input_path): (input_path, output_dir) for input_path, output_dir in subjects}
+    nr_processed = 0
+    while True:
+        subject_id = work_queue.claim_next(list(subject_ids.keys()))
+        if subject_id is None:
+            break
+        input_path, output_dir = subject_ids[subject_id]
+        print("Processing {} ({})".format(input_path, subject_id))
+        timings = {}
+        error = None
+        for idx, command in enumerate(commands):
+            # Split before replacing the paths, so paths containing spaces or quotes stay one argument
+            args = [arg.format(input=input_path, output=output_dir, dir=os.path.dirname(input_path))
+                    for arg in shlex.split(command)]
+            command = " ".join(shlex.quote(arg) for arg in args)
+            start_time = time.time()
+            returncode = subprocess.call(args)
+            timings["command_{}".format(idx + 1)] = round(time.time() - start_time, 2)
+            if returncode != 0:
+                error = "'{}' failed with exit code {}".format(command, returncode)
+                print("ERROR: " + error)
+                break
+        work_queue.finish(subject_id, timings=timings, error=error)
+        nr_processed += 1
+    return nr_processed
@@ -5,6 +5,7 @@ from __future__ import print_function
 
 import os
 import glob
+import contextlib
 from os.path import join
 import importlib
 import numpy as np
@@ -25,6 +26,7 @@ except ImportError:
 from tractseg.libs import pytorch_utils
 from tractseg.libs import exp_utils
 from tractseg.libs import metric_utils
+from tractseg.libs import cpu_budget
 
 
 class BaseModel:
@@ -35,15 +37,14 @@ class BaseModel:
         if not inference:
             torch.backends.cudnn.benchmark = True
 
-        if self.Config.NR_CPUS > 0:
-            torch.set_num_threads(self.Config.NR_CPUS)
+        # pytorch would use all cores of the host (also in containers with fewer CPUs). Only has an effect the
+        # first time, so models which are used by other threads are not affected.
+        cpu_budget.init_torch_threads(self.Config.NR_CPUS)
 
-        if self.Config.SEG_INPUT == "Peaks" and self.Config.TYPE == "single_direction":
-            NR_OF_GRADIENTS = self.Config.NR_OF_GRADIENTS
-        elif self.Config.SEG_INPUT == "Peaks" and self.Config.TYPE == "combined":
-            self.Config.NR_OF_GRADIENTS = 3 * self.Config.NR_OF_CLASSES
-        else:
-            self.Config.NR_OF_GRADIENTS = 33
+        NR_OF_GRADIENTS = exp_utils.get_nr_of_gradients(self.Config)
+        if self.Config.NR_OF_GRADIENTS != NR_OF_GRADIENTS:
+            # only for training (InferenceConfig from get_inference_config already has the correct value)
+            self.Config.NR_OF_GRADIENTS = NR_OF_GRADIENTS
 
         if self.Config.LOSS_FUNCTION == "soft_sample_dice":
             self.criterion = pytorch_utils.soft_sample_dice
@@ -62,11 +63,19 @@ class BaseModel:
         else:
             self.criterion = nn.BCEWithLogitsLoss()
 
+        weights_path = join(self.Config.EXP_PATH, self.Config.WEIGHTS_PATH)
+        # During inference the memory mapped weights are used directly (if converted with
+        # convert_pretrained_weights). Then the network is created on the meta device: the parameters are not
+        # allocated and initialized because they are replaced by the weights anyway.
+        assign_weights = inference and self.Config.LOAD_WEIGHTS and not self.Config.RESET_LAST_LAYER and \
+                         pytorch_utils.can_assign_checkpoint(weights_path)
+
         NetworkClass = getattr(importlib.import_module("tractseg.models." + self.Config.MODEL.lower()),
                                self.Config.MODEL)
-        self.net = NetworkClass(n_input_channels=NR_OF_GRADIENTS, n_classes=self.Config.NR_OF_CLASSES,
-                                n_filt=self.Config.UNET_NR_FILT, batchnorm=self.Config.BATCH_NORM,
-                                dropout=self.Config.USE_DROPOUT, upsample=self.Config.UPSAMPLE_TYPE)
+        with torch.device("meta") if assign_weights else contextlib.nullcontext():
+            self.net = NetworkClass(n_input_channels=NR_OF_GRADIENTS, n_classes=self.Config.NR_OF_CLASSES,
+                                    n_filt=self.Config.UNET_NR_FILT, batchnorm=self.Config.BATCH_NORM,
+                                    dropout=self.Config.USE_DROPOUT, upsample=self.Config.UPSAMPLE_TYPE)
 
         # MultiGPU setup
         # (Not really faster (max 10% speedup): GPU and CPU utility low)
@@ -74,10 +83,17 @@ class BaseModel:
         # exp_utils.print_and_save(self.Config.EXP_PATH, "nr of gpus: {}".format(nr_gpus))
         # self.net = nn.DataParallel(self.net)
 
+        # Load before moving to the device and creating the optimizer (parameters might be replaced)
+        if self.Config.LOAD_WEIGHTS:
+            exp_utils.print_verbose(self.Config.VERBOSE, "Loading weights ... ({})".format(weights_path))
+            self.load_model(weights_path, assign=assign_weights)
+
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         net = self.net.to(self.device)
 
-        if self.Config.OPTIMIZER == "Adamax":
+        if inference:
+            self.optimizer = None  # only needed for training (creating it is slow with recent pytorch versions)
+        elif self.Config.OPTIMIZER == "Adamax":
             self.optimizer = Adamax(net.parameters(), lr=self.Config.LEARNING_RATE,
                                     weight_decay=self.Config.WEIGHT_DECAY)
         elif self.Config.OPTIMIZER == "Adam":
@@ -88,22 +104,22 @@ class BaseModel:
 
         if APEX_AVAILABLE and self.Config.FP16:
             # Use O0 to disable fp16 (might be a little faster on TitanX)
-            self.net, self.optimizer = amp.initialize(self.net, self.optimizer, verbosity=0, opt_level="O1")
-            if not inference:
+            if inference:
+                self.net = amp.initialize(self.net, verbosity=0, opt_level="O1")
+            else:
+                self.net, self.optimizer = amp.initialize(self.net, self.optimizer, verbosity=0, opt_level="O1")
                 print("INFO: Using fp16 training")
         else:
             if not inference:
                 print("INFO: Did not find APEX, defaulting to fp32 training")
 
-        if self.Config.LR_SCHEDULE:
+        if self.Config.LR_SCHEDULE and not inference:
             self.scheduler = lr_scheduler.ReduceLROnPlateau(self.optimizer,
                                                             mode=self.Config.LR_SCHEDULE_MODE,
                                                             patience=self.Config.LR_SCHEDULE_PATIENCE)
 
-        if self.Config.LOAD_WEIGHTS:
-            exp_utils.print_verbose(self.Config.VERBOSE, "Loading weights ... ({})".format(join(self.Config.EXP_PATH,
-                                                                                        self.Config.WEIGHTS_PATH)))
-            self.load_model(join(self.Config.EXP_PATH, self.Config.WEIGHTS_PATH))
+        if inference:
+            self.net.train(bool(self.Config.DROPOUT_SAMPLING))  # dropout sampling needs dropout to be active
 
         # Reset weights of last layer for transfer learning
         # if self.Config.RESET_LAST_LAYER:
@@ -230,12 +246,15 @@ class BaseModel:
 
     def predict(self, X):
         with torch.no_grad():
-            X = torch.tensor(X, dtype=torch.float32).contiguous().to(self.device)
+            if isinstance(X, torch.Tensor):
+                X = X.to(self.device, dtype=torch.float32).contiguous()  # avoid copy of input batch
+            else:
+                X = torch.tensor(X, dtype=torch.float32).contiguous().to(self.device)
 
-        if self.Config.DROPOUT_SAMPLING:
-            self.net.train()
-        else:
-            self.net.train(False)
+        # Only change mode if needed: changing the mode is not thread-safe (for inference the mode is already set
+        # in __init__, so the same model can be used by several threads at the same time)
+        if self.net.training != bool(self.Config.DROPOUT_SAMPLING):
+            self.net.train(bool(self.Config.DROPOUT_SAMPLING))
         outputs = self.net(X)  # forward
         if self.Config.EXPERIMENT_TYPE == "peak_regression" or self.Config.EXPERIMENT_TYPE == "dm_regression":
             probs = outputs.detach().cpu().numpy()
@@ -273,11 +292,11 @@ class BaseModel:
             self.Config.BEST_EPOCH = epoch_nr
 
 
-    def load_model(self, path):
+    def load_model(self, path, assign=False):
         if self.Config.RESET_LAST_LAYER:
             pytorch_utils.load_checkpoint_selectively(path, unet=self.net)
         else:
-            pytorch_utils.load_checkpoint(path, unet=self.net)
+            pytorch_utils.load_checkpoint(path, assign=assign, unet=self.net)
 
     def print_current_lr(self):
         for param_group in self.optimizer.param_groups:
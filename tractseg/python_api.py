@@ -7,6 +7,9 @@ import warnings
 import importlib
 import time
 import os
+import shutil
+import tempfile
+import threading
 from os.path import join
 import numpy as np
 
@@ -18,6 +21,8 @@ from tractseg.libs import data_utils
 from tractseg.libs import direction_merger
 from tractseg.libs import peak_utils
 from tractseg.libs import img_utils
+from tractseg.libs import autotune
+from tractseg.libs import profiler
 from tractseg.data.data_loader_inference import DataLoaderInference
 from tractseg.data import dataset_specific_utils
 from tractseg.libs import trainer
@@ -27,13 +32,70 @@ warnings.simplefilter("ignore", UserWarning)    #hide scipy warnings
 warnings.simplefilter("ignore", FutureWarning)    #hide h5py warnings
 
 
+_MODEL_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+
+def _get_model(Config, cache_models=False):
+    """
+    Load model. If cache_models is True the model is only loaded once and then shared by all calls.
+    """
+    if not cache_models:
+        return BaseModel(Config, inference=True)
+    key = (Config.WEIGHTS_PATH, Config.MODEL, Config.NR_OF_CLASSES, Config.DROPOUT_SAMPLING)
+    with _MODEL_CACHE_LOCK:
+        if key not in _MODEL_CACHE:
+            _MODEL_CACHE[key] = BaseModel(Config, inference=True)
+        return _MODEL_CACHE[key]
+
+
+# Rough memory estimates for low memory mode (measured for the 2D UNet on CPU)
+_BASE_MEMORY_GB = 0.9  # python, pytorch and model weights
+_ACTIVATION_BYTES_PER_PIXEL_AND_FILTER = 90  # memory of forward pass for one slice: pixels * UNET_NR_FILT * this
+_OUTPUT_BUNDLE_GROUP_SIZE = 8  # number of bundles postprocessed at a time
+
+
+def _get_low_memory_batch_size(Config, max_memory, nr_channels, batch_size=None, max_batch_size=32):
+    """
+    Estimate the largest inference batch size for which run_tractseg in low memory mode stays below max_memory.
+    Prints a warning if max_memory is probably too low even for batch size 1.
+
+    Args:
+        Config: config of model
+        max_memory: memory budget in GB
+        nr_channels: number of output channels
+        batch_size: if set, this is used as upper limit for the batch size
+        max_batch_size: larger batch sizes do not make inference faster
+
+    Returns:
+        batch size
+    """
+    if Config.DIM == "3D":
+        return 1
+    nr_voxels = Config.INPUT_DIM[0] ** 3
+    fixed_gb = _BASE_MEMORY_GB + \
+               nr_voxels * Config.NR_OF_GRADIENTS * 4 * 2 / 1e9 + \
+               nr_voxels * nr_channels * 2 * 2 / 1e9  # input (+copy of data loader) + float16 probs (+fusion)
+    slice_gb = Config.INPUT_DIM[0] ** 2 * Config.UNET_NR_FILT * _ACTIVATION_BYTES_PER_PIXEL_AND_FILTER / 1e9
+    if Config.DROPOUT_SAMPLING:
+        slice_gb += Config.INPUT_DIM[0] ** 2 * nr_channels * 4 * 30 * 2 / 1e9  # 30 samples (+std)
+    max_batch_size = max_batch_size if batch_size is None else min(batch_size, max_batch_size)
+
+    if max_memory < fixed_gb + slice_gb:
+        print("WARNING: max_memory of {} GB is probably too low (needs at least ~{:.1f} GB). "
+              "Trying anyway.".format(max_memory, fixed_gb + slice_gb))
+    return int(max(1, min(max_batch_size, (max_memory - fixed_gb) // slice_gb)))
+
+
+@profiler.traced()
 def run_tractseg(data, output_type="tract_segmentation",
                  single_orientation=False, dropout_sampling=False, threshold=0.5,
                  bundle_specific_postprocessing=True, get_probs=False, peak_threshold=0.1,
                  postprocess=False, peak_regression_part="All", input_type="peaks",
                  blob_size_thr=50, nr_cpus=-1, verbose=False, manual_exp_name=None,
-                 inference_batch_size=1, tract_definition="TractQuerier+", bedpostX_input=False,
-                 tract_segmentations_path=None, TOM_dilation=1, unit_test=False):
+                 inference_batch_size=None, tract_definition="TractQuerier+", bedpostX_input=False,
+                 tract_segmentations_path=None, TOM_dilation=1, bundles=None, cache_models=False,
+                 max_memory=None, output_callback=None, unit_test=False):
     """
     Run TractSeg
 
@@ -57,22 +119,42 @@ def run_tractseg(data, output_type="tract_segmentation",
         input_type: Always set to "peaks"
         blob_size_thr: If setting postprocess to True, all blobs having a smaller number of voxels than specified in
             this threshold will be removed.
-        nr_cpus: Number of CPUs to use. -1 means all available CPUs.
+        nr_cpus: Number of CPUs to use. -1 means all available CPUs (or the settings of the autotune profile if
+            `TractSeg --autotune` was run on this machine).
         verbose: Show debugging infos
         manual_exp_name: Name of experiment if do not want to use pretrained model but your own one
-        inference_batch_size: batch size (higher: a bit faster but needs more RAM)
+        inference_batch_size: batch size (higher: a bit faster but needs more RAM). If None the batch size of the
+            autotune profile is used (or 1 if there is no profile). If max_memory is set, this is the upper limit for
+            the batch size chosen according to max_memory.
         tract_definition: Select which tract definitions to use. 'TractQuerier+' defines tracts mainly by their
             cortical start and end region. 'xtract' defines tracts mainly by ROIs in white matter.
         bedpostX_input: Input peaks are generated by bedpostX
         tract_segmentations_path: path to the bundle_segmentations (only needed for peak regression to remove peaks
             outside of the segmentation mask)
         TOM_dilation: Dilation applied to the tract segmentations before using them to mask the TOMs.
+        bundles: List of bundle names (e.g. ["CST_right", "AF_left"]). If set only these bundles will be processed
+            after the network (and for TOM only the models containing these bundles will be run). If None (default)
+            all bundles are processed.
+        cache_models: Keep the loaded models in memory and reuse them in later calls of run_tractseg. The models
+            can be shared between threads, so run_tractseg can be called from several threads at the same time
+            without loading the weights several times.
+        max_memory: Memory budget in GB. If set, TractSeg runs in low memory mode: probabilities are stored as
+            float16, the predictions of the 3 directions are stored in scratch files (in the temp directory) and
+            merged in groups of bundles and the inference batch size is chosen to fit into the budget. Slightly
+            slower. The peak memory usage is printed at the end (with verbose=True).
+        output_callback: Function called with (seg, bundle_names) for each group of bundles as soon as it is
+            postprocessed (seg has the shape of the original image and contains the channels of the bundles in
+            bundle_names). Can be used to save the bundles while the next ones are still being processed. If set,
+            the full output is never allocated and run_tractseg returns None.
 
     Returns:
         4D numpy array with the output of tractseg
         for tract_segmentation:     [x, y, z, nr_of_bundles]
         for endings_segmentation:   [x, y, z, 2*nr_of_bundles]
         for TOM:                    [x, y, z, 3*nr_of_bundles]
+        If bundles is set nr_of_bundles is the number of selected bundles (in the order of
+        dataset_specific_utils.get_bundle_names()).
+        None if output_callback is set.
     """
     start_time = time.time()
 
@@ -100,6 +182,15 @@ def run_tractseg(data, output_type="tract_segmentation",
     Config.DROPOUT_SAMPLING = dropout_sampling
     Config.THRESHOLD = threshold
     Config.NR_CPUS = nr_cpus
+
+    profile = autotune.load_profile()
+    if inference_batch_size is None and profile is not None:
+        inference_batch_size = profile["inference_batch_size"]
+    if inference_batch_size is None and max_memory is None:
+        inference_batch_size = 1  # in low memory mode chosen according to max_memory later
+    if nr_cpus == -1 and profile is not None:
+        Config.NR_CPUS = profile["nr_threads"]
+        nr_cpus = profile["nr_workers"]
     Config.INPUT_DIM = dataset_specific_utils.get_correct_input_dim(Config)
     Config.RESET_LAST_LAYER = False
 
@@ -139,41 +230,77 @@ def run_tractseg(data, output_type="tract_segmentation",
         print("Hyperparameters:")
         exp_utils.print_Configs(Config)
 
-    data = np.nan_to_num(data)
+    low_memory = max_memory is not None
+    if low_memory:
+        # float32 is enough for the input of the model (resampling of input uses nearest neighbour)
+        data = np.nan_to_num(data.astype(np.float32, copy=False))
+    else:
+        data = np.nan_to_num(data)
 
-    #runtime on HCP data: 0.9s
-    data, seg_None, bbox, original_shape = data_utils.crop_to_nonzero(data)
-    # runtime on HCP data: 0.5s
-    data, transformation = data_utils.pad_and_scale_img_to_square_img(data, target_size=Config.INPUT_DIM[0],
-                                                                      nr_cpus=nr_cpus)
+    with profiler.span("crop_pad"):
+        #runtime on HCP data: 0.9s
+        data, seg_None, bbox, original_shape = data_utils.crop_to_nonzero(data)
+        # runtime on HCP data: 0.5s
+        data, transformation = data_utils.pad_and_scale_img_to_square_img(data, target_size=Config.INPUT_DIM[0],
+                                                                          nr_cpus=nr_cpus)
 
     if Config.EXPERIMENT_TYPE == "tract_segmentation" or Config.EXPERIMENT_TYPE == "endings_segmentation" or \
             Config.EXPERIMENT_TYPE == "dm_regression":
         print("Loading weights from: {}".format(Config.WEIGHTS_PATH))
-        Config.NR_OF_CLASSES = len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
+        # Read-only from here on (the model and the data loaders can be used by several threads)
+        Config = exp_utils.get_inference_config(
+            Config, NR_OF_CLASSES=len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:]))
+        bundle_names = dataset_specific_utils.get_bundle_names_subset(Config.CLASSES, bundles)
+        if bundles is not None:
+            if len(bundle_names) == 0:
+                raise ValueError("None of the selected bundles is part of {}".format(Config.CLASSES))
+            channel_idxs = dataset_specific_utils.get_bundle_idxs(Config.CLASSES, bundles)
+        else:
+            channel_idxs = None
         utils.download_pretrained_weights(experiment_type=Config.EXPERIMENT_TYPE,
                                           dropout_sampling=Config.DROPOUT_SAMPLING,
                                           tract_definition=tract_definition)
-        model = BaseModel(Config, inference=True)
+        with profiler.span("load_model"):
+            model = _get_model(Config, cache_models)
+        if low_memory:
+            nr_channels = Config.NR_OF_CLASSES if channel_idxs is None else len(channel_idxs)
+            inference_batch_size = _get_low_memory_batch_size(Config, max_memory, nr_channels,
+                                                              batch_size=inference_batch_size)
+            exp_utils.print_verbose(Config.VERBOSE, "Low memory mode: using inference_batch_size {}".format(
+                inference_batch_size))
+        probs_dtype = np.float16 if low_memory else np.float32
         if single_orientation:  # mainly needed for testing because of less RAM requirements
             data_loder_inference = DataLoaderInference(Config, data=data)
             if Config.DROPOUT_SAMPLING or Config.EXPERIMENT_TYPE == "dm_regression" or Config.GET_PROBS:
                 seg, _ = trainer.predict_img(Config, model, data_loder_inference, probs=True,
                                                  scale_to_world_shape=False, only_prediction=True,
-                                                 batch_size=inference_batch_size, unit_test=unit_test)
+                                                 batch_size=inference_batch_size, unit_test=unit_test,
+                                                 channel_idxs=channel_idxs, dtype=probs_dtype)
             else:
                 seg, _ = trainer.predict_img(Config, model, data_loder_inference, probs=False,
                                                  scale_to_world_shape=False, only_prediction=True,
-                                                 batch_size=inference_batch_size)
+                                                 batch_size=inference_batch_size, channel_idxs=channel_idxs,
+                                                 dtype=probs_dtype)
+        elif low_memory:
+            scratch_dir = tempfile.mkdtemp(prefix="tractseg_")
+            try:
+                paths = direction_merger.get_seg_single_img_3_directions_to_disk(Config, model, data, scratch_dir,
+                                                                                 batch_size=inference_batch_size,
+                                                                                 channel_idxs=channel_idxs)
+                probs = Config.DROPOUT_SAMPLING or Config.EXPERIMENT_TYPE == "dm_regression" or Config.GET_PROBS
+                with profiler.span("fusion"):
+                    seg = direction_merger.mean_fusion_from_disk(Config.THRESHOLD, paths, probs=probs)
+            finally:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
         else:
             seg_xyz, _ = direction_merger.get_seg_single_img_3_directions(Config, model, data=data,
                                                                            scale_to_world_shape=False,
                                                                            only_prediction=True,
-                                                                           batch_size=inference_batch_size)
-            if Config.DROPOUT_SAMPLING or Config.EXPERIMENT_TYPE == "dm_regression" or Config.GET_PROBS:
-                seg = direction_merger.mean_fusion(Config.THRESHOLD, seg_xyz, probs=True)
-            else:
-                seg = direction_merger.mean_fusion(Config.THRESHOLD, seg_xyz, probs=False)
+                                                                           batch_size=inference_batch_size,
+                                                                           channel_idxs=channel_idxs)
+            with profiler.span("fusion"):
+                probs = Config.DROPOUT_SAMPLING or Config.EXPERIMENT_TYPE == "dm_regression" or Config.GET_PROBS
+                seg = direction_merger.mean_fusion(Config.THRESHOLD, seg_xyz, probs=probs)
 
     elif Config.EXPERIMENT_TYPE == "peak_regression":
         weights = {
@@ -184,70 +311,134 @@ def run_tractseg(data, output_type="tract_segmentation",
         }
         if peak_regression_part == "All":
             parts = ["Part1", "Part2", "Part3", "Part4"]
-            seg_all = np.zeros((data.shape[0], data.shape[1], data.shape[2], Config.NR_OF_CLASSES * 3))
         else:
             parts = [peak_regression_part]
-            Config.CLASSES = "All_" + peak_regression_part
-            Config.NR_OF_CLASSES = 3 * len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
+
+        # Only run the models of the parts which contain any of the selected bundles
+        bundle_names = []
+        for part in parts:
+            bundle_names += dataset_specific_utils.get_bundle_names_subset("All_" + part, bundles)
+        if bundles is not None:
+            parts = [part for part in parts
+                     if len(dataset_specific_utils.get_bundle_idxs("All_" + part, bundles)) > 0]
+            if len(parts) == 0:
+                raise ValueError("None of the selected bundles is part of the TOM bundles")
+        if peak_regression_part == "All":
+            seg_all = np.zeros((data.shape[0], data.shape[1], data.shape[2], len(bundle_names) * 3),
+                               dtype=np.float32 if low_memory else np.float64)
+            seg_all_offset = 0
 
         for idx, part in enumerate(parts):
             if manual_exp_name is not None:
                 manual_exp_name_peaks = exp_utils.get_manual_exp_name_peaks(manual_exp_name, part)
-                Config.WEIGHTS_PATH = exp_utils.get_best_weights_path(
-                    join(C.EXP_PATH, manual_exp_name_peaks), True)
+                weights_path = exp_utils.get_best_weights_path(join(C.EXP_PATH, manual_exp_name_peaks), True)
             else:
-                Config.WEIGHTS_PATH = join(C.TRACT_SEG_HOME, weights[part])
-            print("Loading weights from: {}".format(Config.WEIGHTS_PATH))
-            Config.CLASSES = "All_" + part
-            Config.NR_OF_CLASSES = 3 * len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
-            utils.download_pretrained_weights(experiment_type=Config.EXPERIMENT_TYPE,
-                                              dropout_sampling=Config.DROPOUT_SAMPLING, part=part,
+                weights_path = join(C.TRACT_SEG_HOME, weights[part])
+            print("Loading weights from: {}".format(weights_path))
+            # Separate read-only Config for each part (instead of changing the Config of this call)
+            Config_part = exp_utils.get_inference_config(
+                Config, WEIGHTS_PATH=weights_path, CLASSES="All_" + part,
+                NR_OF_CLASSES=3 * len(dataset_specific_utils.get_bundle_names("All_" + part)[1:]))
+            utils.download_pretrained_weights(experiment_type=Config_part.EXPERIMENT_TYPE,
+                                              dropout_sampling=Config_part.DROPOUT_SAMPLING, part=part,
                                               tract_definition=tract_definition)
-            model = BaseModel(Config, inference=True)
+            with profiler.span("load_model", part=part):
+                model = _get_model(Config_part, cache_models)
+
+            if bundles is not None:
+                bundle_idxs = dataset_specific_utils.get_bundle_idxs(Config_part.CLASSES, bundles)
+                channel_idxs = [bundle_idx * 3 + i for bundle_idx in bundle_idxs for i in range(3)]
+            else:
+                channel_idxs = None
+
+            if low_memory:
+                nr_channels = Config_part.NR_OF_CLASSES if channel_idxs is None else len(channel_idxs)
+                batch_size_part = _get_low_memory_batch_size(Config_part, max_memory, nr_channels,
+                                                             batch_size=inference_batch_size)
+            else:
+                batch_size_part = inference_batch_size
 
             if single_orientation:
-                data_loder_inference = DataLoaderInference(Config, data=data)
-                seg, _ = trainer.predict_img(Config, model, data_loder_inference, probs=True,
+                data_loder_inference = DataLoaderInference(Config_part, data=data)
+                seg, _ = trainer.predict_img(Config_part, model, data_loder_inference, probs=True,
                                                  scale_to_world_shape=False, only_prediction=True,
-                                                 batch_size=inference_batch_size)
+                                                 batch_size=batch_size_part, channel_idxs=channel_idxs)
+            elif low_memory:
+                scratch_dir = tempfile.mkdtemp(prefix="tractseg_")
+                try:
+                    paths = direction_merger.get_seg_single_img_3_directions_to_disk(Config_part, model, data,
+                                                                                     scratch_dir,
+                                                                                     batch_size=batch_size_part,
+                                                                                     channel_idxs=channel_idxs)
+                    with profiler.span("fusion"):
+                        seg = direction_merger.mean_fusion_peaks_from_disk(paths)
+                finally:
+                    shutil.rmtree(scratch_dir, ignore_errors=True)
             else:
                 # 3 dir for Peaks -> bad results
-                seg_xyz, _ = direction_merger.get_seg_single_img_3_directions(Config, model, data=data,
+                seg_xyz, _ = direction_merger.get_seg_single_img_3_directions(Config_part, model, data=data,
                                                                                   scale_to_world_shape=False,
                                                                                   only_prediction=True,
-                                                                                  batch_size=inference_batch_size)
-                seg = direction_merger.mean_fusion_peaks(seg_xyz, nr_cpus=nr_cpus)
+                                                                                  batch_size=inference_batch_size,
+                                                                                  channel_idxs=channel_idxs)
+                with profiler.span("fusion"):
+                    seg = direction_merger.mean_fusion_peaks(seg_xyz, nr_cpus=nr_cpus)
 
             if peak_regression_part == "All":
-                seg_all[:, :, :, (idx*Config.NR_OF_CLASSES) : (idx*Config.NR_OF_CLASSES+Config.NR_OF_CLASSES)] = seg
+                seg_all[:, :, :, seg_all_offset:seg_all_offset + seg.shape[3]] = seg
+                seg_all_offset += seg.shape[3]
 
         if peak_regression_part == "All":
-            Config.CLASSES = "All"
-            Config.NR_OF_CLASSES = 3 * len(dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
             seg = seg_all
 
 
-    if Config.EXPERIMENT_TYPE == "tract_segmentation" and bundle_specific_postprocessing and not dropout_sampling:
-        # Runtime ~4s
-        seg = img_utils.bundle_specific_postprocessing(seg, dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:])
+    def _process_output(seg, bundle_names):
+        if Config.EXPERIMENT_TYPE == "tract_segmentation" and bundle_specific_postprocessing and not dropout_sampling:
+            # Runtime ~4s
+            with profiler.span("bundle_specific_postprocessing"):
+                seg = img_utils.bundle_specific_postprocessing(seg, bundle_names)
+
+        with profiler.span("inverse_transform"):
+            # runtime on HCP data: 5.1s
+            seg = data_utils.cut_and_scale_img_back_to_original_img(seg, transformation, nr_cpus=nr_cpus)
+            # runtime on HCP data: 1.6s
+            seg = data_utils.add_original_zero_padding_again(seg, bbox, original_shape, seg.shape[3])
 
-    # runtime on HCP data: 5.1s
-    seg = data_utils.cut_and_scale_img_back_to_original_img(seg, transformation, nr_cpus=nr_cpus)
-    # runtime on HCP data: 1.6s
-    seg = data_utils.add_original_zero_padding_again(seg, bbox, original_shape, Config.NR_OF_CLASSES)
+        if Config.EXPERIMENT_TYPE == "peak_regression":
+            with profiler.span("postprocessing"):
+                seg = peak_utils.mask_and_normalize_peaks(seg, tract_segmentations_path, bundle_names,
+                                                          TOM_dilation, nr_cpus=nr_cpus)
 
-    if Config.EXPERIMENT_TYPE == "peak_regression":
-        seg = peak_utils.mask_and_normalize_peaks(seg, tract_segmentations_path,
-                                                  dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:],
-                                                  TOM_dilation, nr_cpus=nr_cpus)
+        if Config.EXPERIMENT_TYPE == "tract_segmentation" and postprocess and not dropout_sampling:
+            # Runtime ~7s for 1.25mm resolution
+            # Runtime ~1.5s for  2mm resolution
+            with profiler.span("postprocessing"):
+                seg = img_utils.postprocess_segmentations(seg, bundle_names, blob_thr=blob_size_thr,
+                                                          hole_closing=None)
+        return seg
 
-    if Config.EXPERIMENT_TYPE == "tract_segmentation" and postprocess and not dropout_sampling:
-        # Runtime ~7s for 1.25mm resolution
-        # Runtime ~1.5s for  2mm resolution
-        st = time.time()
-        seg = img_utils.postprocess_segmentations(seg, dataset_specific_utils.get_bundle_names(Config.CLASSES)[1:],
-                                                  blob_thr=blob_size_thr, hole_closing=None)
+    # Process output in groups of bundles (streaming): the intermediate results of the postprocessing are only
+    # needed for one group at a time and each group can be saved as soon as it is done (output_callback)
+    channels_per_bundle = seg.shape[3] // len(bundle_names)
+    seg_out = None
+    for start in range(0, len(bundle_names), _OUTPUT_BUNDLE_GROUP_SIZE):
+        bundle_names_group = bundle_names[start:start + _OUTPUT_BUNDLE_GROUP_SIZE]
+        channels = slice(start * channels_per_bundle, (start + len(bundle_names_group)) * channels_per_bundle)
+        seg_group = seg[..., channels]
+        if seg_group.dtype == np.float16:
+            seg_group = seg_group.astype(np.float32)  # float16 is not supported by scipy.ndimage
+        seg_group = _process_output(seg_group, bundle_names_group)
+        if output_callback is not None:
+            output_callback(seg_group, bundle_names_group)
+            continue
+        if seg_out is None:
+            seg_out = np.empty(original_shape[:3] + (seg.shape[3],), dtype=seg_group.dtype)
+        seg_out[..., channels] = seg_group
+    seg = seg_out
 
+    if low_memory:
+        exp_utils.print_verbose(Config.VERBOSE, "Peak memory usage: {} GB (max_memory: {} GB)".format(
+            utils.peak_mem_usage(print_usage=False), max_memory))
     exp_utils.print_verbose(Config.VERBOSE, "Took {}s".format(round(time.time() - start_time, 2)))
     return seg
 